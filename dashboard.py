@@ -1,3 +1,18 @@
+import argparse
+
+from src.settings import load_settings
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument(
+    "settings", type=str, help="Path to the configuration file.", nargs="?"
+)
+args = parser.parse_args()
+
+if args.settings is not None:
+    load_settings(args.settings)
+
+
 from src.monitoring import dashboard
 
 dashboard.app.run_server()
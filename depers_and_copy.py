@@ -0,0 +1,190 @@
+import argparse
+import logging
+import multiprocessing
+import psycopg2
+import secrets
+from dotenv import load_dotenv, find_dotenv
+
+import src.log_config
+from src.settings import load_settings, get_processing_settings
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("settings", type=str, help="Path to the configuration file.")
+    parser.add_argument("--env", type=str, help="Path to the env file.", nargs="?")
+    args = parser.parse_args()
+
+    if args.env is None:
+        load_dotenv(find_dotenv(usecwd=True))
+    else:
+        load_dotenv(args.env)
+
+    load_settings(args.settings)
+    src.log_config.setup_logger_settings()
+
+
+from src import names, planning, transform
+from src import utils
+from src.delivery import copy_fanout
+from src.monitoring import source_cost
+from src.monitoring.metrics import start_metrics_writer, stop_metrics_writer
+from src.preparations import cleanup_helpers, preparations
+
+
+logger = logging.getLogger(__name__)
+
+
+def build_transformer(
+    conn: psycopg2.extensions.connection,
+    connector: utils.db_connector.DatabaseConnector,
+):
+    settings = get_processing_settings()
+
+    common_settings = {
+        "conn": conn,
+        "src_table": names.SRC_TABLE,
+        "transfer_table": names.TRANSFER_TABLE,
+        "processed_column": names.PROCCESED_COLUMN,
+        "continuous_mode": settings.get("continuous_mode", False),
+        "batch_size": settings["batch_size"],
+        "sleep_ms": settings["batch_sleep_ms"],
+    }
+
+    method = settings["method"]
+
+    if method == "copy":
+        common_settings["columns"] = settings["columns"]
+        transformer = transform.copier.Copier(**common_settings)
+    elif method == "aggr":
+        common_settings["column_operations"] = settings["column_operations"]
+        transformer = transform.aggregator.Aggregator(**common_settings)
+    elif method == "reduce_aggr":
+        common_settings["column_operations"] = settings["column_operations"]
+        transformer = transform.reduce_aggregator.ReduceAggregator(**common_settings)
+    elif method == "shuffle":
+        common_settings["groups"] = settings["groups"]
+        transformer = transform.shuffler.Shuffler(**common_settings)
+    elif method == "select_random":
+        common_settings["groups"] = settings["groups"]
+        transformer = transform.random_selector.RandomSelector(**common_settings)
+    elif method == "uuid":
+        common_settings["column_operations"] = settings["column_operations"]
+        transformer = transform.uuid_replacer.UuidReplacer(**common_settings)
+    elif method == "mask":
+        common_settings["column_patterns"] = settings["column_patterns"]
+        transformer = transform.masker.Masker(**common_settings)
+    elif method == "synthesize":
+        common_settings["column_operations"] = settings["column_operations"]
+        common_settings["pools_dir"] = settings["pools_dir"]
+        common_settings["pool_size"] = settings.get("pool_size", 100000)
+        common_settings["build_processes"] = settings.get(
+            "pool_build_processes", multiprocessing.cpu_count()
+        )
+        common_settings["key"] = settings.get("synthesize_key") or secrets.token_hex(
+            16
+        )
+        common_settings["locale"] = settings.get("locale", "en_US")
+        transformer = transform.synthesizer.Synthesizer(**common_settings)
+    else:
+        raise Exception(f"Unknown method '{method}'")
+
+    transformer.set_reconnect(
+        connector.reconnect, settings.get("max_reconnect_attempts", 5)
+    )
+
+    with conn.cursor() as cur:
+        total_rows, _ = planning.planner.get_table_stats(cur, names.SRC_TABLE)
+    transformer.set_eta_model(
+        planning.planner.ThroughputModel(total_rows, settings["batch_sleep_ms"])
+    )
+
+    if settings.get("source_cost") is not None:
+        transformer.set_cost_collector(
+            source_cost.SourceCostCollector(method, **settings["source_cost"])
+        )
+    return transformer
+
+
+def cleanup(src_conn, after_except=False):
+    cleanup_helpers.direct_cleanup_script_helpers(
+        src_conn,
+        names.SRC_TABLE,
+        names.PROCCESED_COLUMN,
+        after_except,
+    )
+
+
+def prepare_all_tables(src_conn, dst_conn, transfer_table_schema):
+    preparations.prepare_direct_tables(
+        src_conn,
+        dst_conn,
+        names.SRC_TABLE,
+        names.TRANSFER_TABLE,
+        names.PROCCESED_COLUMN,
+        transfer_table_schema,
+    )
+
+
+def process():
+    logger.info("Start of work")
+
+    settings = get_processing_settings()
+    start_metrics_writer()
+
+    connector = utils.db_connector.DatabaseConnector(
+        dst_timeout_s=settings.get("dst_timeout_s"),
+        connection_settings=settings.get("connection"),
+    )
+    src_conn = connector.get_src_connection()
+    dst_conn = connector.get_dst_connection()
+    transform = None
+
+    try:
+        logger.info("Starting preparations")
+
+        transform = build_transformer(src_conn, connector)
+        transfer_table_schema = transform.get_transfer_table_schema()
+
+        prepare_all_tables(src_conn, dst_conn, transfer_table_schema)
+
+        delivery = copy_fanout.CopyFanOut(
+            dst_conn,
+            names.TRANSFER_TABLE,
+            [column[0] for column in transfer_table_schema],
+            settings.get("max_buffer_bytes", 64 * 1024 * 1024),
+            settings.get("shard_key"),
+        )
+        transform.set_delivery(delivery)
+        logger.info("Preparations completed successfully")
+
+        transform.process()
+        src_conn = transform.conn
+
+        logger.info("Starting final cleanup")
+        cleanup(src_conn)
+        logger.info("Final cleanup completed successfully")
+
+    except KeyboardInterrupt as err:
+        logger.info("Get KeyboardInterrupt")
+        if transform is not None:
+            src_conn = transform.conn
+
+        logger.info("Starting cleanup after KeyboardInterrupt")
+        cleanup(src_conn, after_except=True)
+        logger.info("Cleanup after KeyboardInterrupt completed successfully")
+
+    except Exception as err:
+        logger.error(f"Error during execution: {err}")
+        if transform is not None:
+            src_conn = transform.conn
+
+        logger.info("Starting cleanup after error")
+        cleanup(src_conn, after_except=True)
+        logger.info("Cleanup after error completed successfully")
+
+    stop_metrics_writer()
+
+
+if __name__ == "__main__":
+    process()
@@ -2,6 +2,7 @@ import argparse
 import logging
 import multiprocessing
 import psycopg2
+import secrets
 from dotenv import load_dotenv, find_dotenv
 
 import src.log_config
@@ -23,8 +24,10 @@ if __name__ == "__main__":
     src.log_config.setup_logger_settings()
 
 
-from src import names, transform
+from src import names, planning, transform
 from src import utils
+from src.monitoring import source_cost
+from src.monitoring.metrics import start_metrics_writer, stop_metrics_writer
 from src.preparations import cleanup_helpers, preparations
 from src.replication_cleanup import replication_cleanup
 
@@ -32,7 +35,10 @@ from src.replication_cleanup import replication_cleanup
 logger = logging.getLogger(__name__)
 
 
-def build_transformer(conn: psycopg2.extensions.connection):
+def build_transformer(
+    conn: psycopg2.extensions.connection,
+    connector: utils.db_connector.DatabaseConnector,
+):
     settings = get_processing_settings()
 
     common_settings = {
@@ -49,22 +55,74 @@ def build_transformer(conn: psycopg2.extensions.connection):
 
     if method == "copy":
         common_settings["columns"] = settings["columns"]
-        return transform.copier.Copier(**common_settings)
+        transformer = transform.copier.Copier(**common_settings)
     elif method == "aggr":
         common_settings["column_operations"] = settings["column_operations"]
-        return transform.aggregator.Aggregator(**common_settings)
+        transformer = transform.aggregator.Aggregator(**common_settings)
     elif method == "reduce_aggr":
         common_settings["column_operations"] = settings["column_operations"]
-        return transform.reduce_aggregator.ReduceAggregator(**common_settings)
+        transformer = transform.reduce_aggregator.ReduceAggregator(**common_settings)
     elif method == "shuffle":
         common_settings["groups"] = settings["groups"]
-        return transform.shuffler.Shuffler(**common_settings)
+        transformer = transform.shuffler.Shuffler(**common_settings)
     elif method == "select_random":
         common_settings["groups"] = settings["groups"]
-        return transform.random_selector.RandomSelector(**common_settings)
+        transformer = transform.random_selector.RandomSelector(**common_settings)
     elif method == "uuid":
         common_settings["column_operations"] = settings["column_operations"]
-        return transform.uuid_replacer.UuidReplacer(**common_settings)
+        transformer = transform.uuid_replacer.UuidReplacer(**common_settings)
+    elif method == "mask":
+        common_settings["column_patterns"] = settings["column_patterns"]
+        transformer = transform.masker.Masker(**common_settings)
+    elif method == "synthesize":
+        common_settings["column_operations"] = settings["column_operations"]
+        common_settings["pools_dir"] = settings["pools_dir"]
+        common_settings["pool_size"] = settings.get("pool_size", 100000)
+        common_settings["build_processes"] = settings.get(
+            "pool_build_processes", multiprocessing.cpu_count()
+        )
+        common_settings["key"] = settings.get("synthesize_key") or secrets.token_hex(
+            16
+        )
+        common_settings["locale"] = settings.get("locale", "en_US")
+        transformer = transform.synthesizer.Synthesizer(**common_settings)
+    else:
+        raise Exception(f"Unknown method '{method}'")
+
+    transformer.set_reconnect(
+        connector.reconnect, settings.get("max_reconnect_attempts", 5)
+    )
+
+    with conn.cursor() as cur:
+        total_rows, _ = planning.planner.get_table_stats(cur, names.SRC_TABLE)
+    transformer.set_eta_model(
+        planning.planner.ThroughputModel(total_rows, settings["batch_sleep_ms"])
+    )
+
+    if settings.get("source_cost") is not None:
+        transformer.set_cost_collector(
+            source_cost.SourceCostCollector(method, **settings["source_cost"])
+        )
+
+    if settings.get("transfer_partition_size") is not None:
+        transformer.set_partitioning(
+            names.ID_COLUMN,
+            settings["transfer_partition_size"],
+            settings.get("transfer_partitions_ahead", 4),
+        )
+
+    backpressure = settings.get("backpressure")
+    if backpressure is not None:
+        transformer.set_backpressure(
+            names.ID_COLUMN,
+            backpressure["high"],
+            backpressure["low"],
+            backpressure.get("unit", "rows"),
+            backpressure.get("poll_ms", 1000),
+            settings.get("transfer_partition_size") is not None,
+            backpressure.get("max_pause_s"),
+        )
+    return transformer
 
 
 def cleanup(src_conn, dst_conn, after_except=False):
@@ -79,10 +137,15 @@ def cleanup(src_conn, dst_conn, after_except=False):
         names.SUBSCRIPTION,
         True,
         after_except=after_except,
+        shard_key=get_processing_settings().get("shard_key"),
+        apply_workers=get_processing_settings().get("apply_workers", 1),
+        bulk_load=get_processing_settings().get("bulk_load", False),
     )
 
 
 def prepare_all_tables(src_conn, dst_conn, connector, transfer_table_schema):
+    settings = get_processing_settings()
+
     preparations.prepare_all_tables(
         src_conn,
         dst_conn,
@@ -95,6 +158,11 @@ def prepare_all_tables(src_conn, dst_conn, connector, transfer_table_schema):
         names.SUBSCRIPTION,
         transfer_table_schema,
         True,
+        settings.get("transfer_partition_size"),
+        settings.get("transfer_partitions_ahead", 4),
+        settings.get("shard_key"),
+        settings.get("apply_workers", 1),
+        settings.get("bulk_load", False),
     )
 
 
@@ -102,17 +170,22 @@ def process():
     logger.info("Start of work")
 
     settings = get_processing_settings()
+    start_metrics_writer()
 
-    connector = utils.db_connector.DatabaseConnector()
+    connector = utils.db_connector.DatabaseConnector(
+        dst_timeout_s=settings.get("dst_timeout_s"),
+        connection_settings=settings.get("connection"),
+    )
     src_conn = connector.get_src_connection()
     dst_conn = connector.get_dst_connection()
 
     stop_event = multiprocessing.Event()
+    transform = None
 
     try:
         logger.info("Starting preparations")
 
-        transform = build_transformer(src_conn)
+        transform = build_transformer(src_conn, connector)
         transfer_table_schema = transform.get_transfer_table_schema()
 
         prepare_all_tables(
@@ -124,20 +197,31 @@ def process():
         logger.info("Preparations completed successfully")
 
         proc_to_remove = multiprocessing.Process(
-            target=replication_cleanup.remove_replicated_records,
+            target=replication_cleanup.run_remove_replicated_records,
             args=(
-                connector.get_src_connection(),
-                connector.get_dst_connection(),
+                connector.get_settings(),
                 names.TRANSFER_TABLE,
                 names.ID_COLUMN,
                 settings["delete_sleep_s"],
                 stop_event,
+                settings.get("cleanup_mode", "max_id"),
+                settings.get("transfer_partition_size"),
+                settings.get("transfer_partitions_ahead", 4),
             ),
+            kwargs={
+                "apply_workers": settings.get("apply_workers", 1),
+                "bulk_load": settings.get("bulk_load", False),
+                # a few batches behind is close enough for the concurrent build
+                "catchup_rows": settings.get(
+                    "bulk_load_catchup_rows", 10 * settings["batch_size"]
+                ),
+            },
         )
         proc_to_remove.start()
         logger.info("Starting remove replicated process")
 
         transform.process()
+        src_conn = transform.conn
 
         stop_event.set()
         proc_to_remove.join()
@@ -149,6 +233,8 @@ def process():
     except KeyboardInterrupt as err:
         logger.info("Get KeyboardInterrupt")
         proc_to_remove.kill()
+        if transform is not None:
+            src_conn = transform.conn
 
         logger.info("Starting cleanup after KeyboardInterrupt")
         cleanup(src_conn, dst_conn, after_except=True)
@@ -157,11 +243,15 @@ def process():
     except Exception as err:
         logger.error(f"Error during execution: {err}")
         proc_to_remove.kill()
+        if transform is not None:
+            src_conn = transform.conn
 
         logger.info("Starting cleanup after error")
         cleanup(src_conn, dst_conn, after_except=True)
         logger.info("Cleanup after error completed successfully")
 
+    stop_metrics_writer()
+
 
 if __name__ == "__main__":
     process()
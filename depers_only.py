@@ -1,6 +1,8 @@
 import argparse
 import logging
+import multiprocessing
 import psycopg2
+import secrets
 from dotenv import load_dotenv, find_dotenv
 
 import src.log_config
@@ -22,15 +24,20 @@ if __name__ == "__main__":
     src.log_config.setup_logger_settings()
 
 
-from src import names, transform
+from src import names, planning, transform
 from src import utils
+from src.monitoring import source_cost
+from src.monitoring.metrics import start_metrics_writer, stop_metrics_writer
 from src.preparations import cleanup_helpers, preparations
 
 
 logger = logging.getLogger(__name__)
 
 
-def build_transformer(conn: psycopg2.extensions.connection):
+def build_transformer(
+    conn: psycopg2.extensions.connection,
+    connector: utils.db_connector.DatabaseConnector,
+):
     settings = get_processing_settings()
 
     common_settings = {
@@ -47,22 +54,55 @@ def build_transformer(conn: psycopg2.extensions.connection):
 
     if method == "copy":
         common_settings["columns"] = settings["columns"]
-        return transform.copier.Copier(**common_settings)
+        transformer = transform.copier.Copier(**common_settings)
     elif method == "aggr":
         common_settings["column_operations"] = settings["column_operations"]
-        return transform.aggregator.Aggregator(**common_settings)
+        transformer = transform.aggregator.Aggregator(**common_settings)
     elif method == "reduce_aggr":
         common_settings["column_operations"] = settings["column_operations"]
-        return transform.reduce_aggregator.ReduceAggregator(**common_settings)
+        transformer = transform.reduce_aggregator.ReduceAggregator(**common_settings)
     elif method == "shuffle":
         common_settings["groups"] = settings["groups"]
-        return transform.shuffler.Shuffler(**common_settings)
+        transformer = transform.shuffler.Shuffler(**common_settings)
     elif method == "select_random":
         common_settings["groups"] = settings["groups"]
-        return transform.random_selector.RandomSelector(**common_settings)
+        transformer = transform.random_selector.RandomSelector(**common_settings)
     elif method == "uuid":
         common_settings["column_operations"] = settings["column_operations"]
-        return transform.uuid_replacer.UuidReplacer(**common_settings)
+        transformer = transform.uuid_replacer.UuidReplacer(**common_settings)
+    elif method == "mask":
+        common_settings["column_patterns"] = settings["column_patterns"]
+        transformer = transform.masker.Masker(**common_settings)
+    elif method == "synthesize":
+        common_settings["column_operations"] = settings["column_operations"]
+        common_settings["pools_dir"] = settings["pools_dir"]
+        common_settings["pool_size"] = settings.get("pool_size", 100000)
+        common_settings["build_processes"] = settings.get(
+            "pool_build_processes", multiprocessing.cpu_count()
+        )
+        common_settings["key"] = settings.get("synthesize_key") or secrets.token_hex(
+            16
+        )
+        common_settings["locale"] = settings.get("locale", "en_US")
+        transformer = transform.synthesizer.Synthesizer(**common_settings)
+    else:
+        raise Exception(f"Unknown method '{method}'")
+
+    transformer.set_reconnect(
+        connector.reconnect, settings.get("max_reconnect_attempts", 5)
+    )
+
+    with conn.cursor() as cur:
+        total_rows, _ = planning.planner.get_table_stats(cur, names.SRC_TABLE)
+    transformer.set_eta_model(
+        planning.planner.ThroughputModel(total_rows, settings["batch_sleep_ms"])
+    )
+
+    if settings.get("source_cost") is not None:
+        transformer.set_cost_collector(
+            source_cost.SourceCostCollector(method, **settings["source_cost"])
+        )
+    return transformer
 
 
 def cleanup(src_conn, after_except=False):
@@ -97,13 +137,19 @@ def prepare_all_tables(src_conn, transfer_table_schema):
 def process():
     logger.info("Start of work")
 
-    connector = utils.db_connector.DatabaseConnector(only_src=True)
+    settings = get_processing_settings()
+    start_metrics_writer()
+
+    connector = utils.db_connector.DatabaseConnector(
+        only_src=True, connection_settings=settings.get("connection")
+    )
     src_conn = connector.get_src_connection()
+    transform = None
 
     try:
         logger.info("Starting preparations")
 
-        transform = build_transformer(src_conn)
+        transform = build_transformer(src_conn, connector)
         transfer_table_schema = transform.get_transfer_table_schema()
 
         prepare_all_tables(
@@ -113,6 +159,7 @@ def process():
         logger.info("Preparations completed successfully")
 
         transform.process()
+        src_conn = transform.conn
 
         logger.info("Starting final cleanup")
         cleanup(src_conn)
@@ -120,6 +167,8 @@ def process():
 
     except KeyboardInterrupt as err:
         logger.info("Get KeyboardInterrupt")
+        if transform is not None:
+            src_conn = transform.conn
 
         logger.info("Starting cleanup after KeyboardInterrupt")
         cleanup(src_conn, after_except=True)
@@ -127,11 +176,15 @@ def process():
 
     except Exception as err:
         logger.error(f"Error during execution: {err}")
+        if transform is not None:
+            src_conn = transform.conn
 
         logger.info("Starting cleanup after error")
         cleanup(src_conn, after_except=True)
         logger.info("Cleanup after error completed successfully")
 
+    stop_metrics_writer()
+
 
 if __name__ == "__main__":
     process()
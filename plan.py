@@ -0,0 +1,65 @@
+import argparse
+import logging
+from dotenv import load_dotenv, find_dotenv
+
+import src.log_config
+from src.settings import load_settings, get_processing_settings
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("settings", type=str, help="Path to the configuration file.")
+    parser.add_argument("--env", type=str, help="Path to the env file.", nargs="?")
+    parser.add_argument(
+        "--batches",
+        type=int,
+        default=5,
+        help="Number of sample batches to run on a copy of source table rows, "
+        "0 reads only the table statistics.",
+    )
+    args = parser.parse_args()
+
+    if args.env is None:
+        load_dotenv(find_dotenv(usecwd=True))
+    else:
+        load_dotenv(args.env)
+
+    load_settings(args.settings)
+    src.log_config.setup_logger_settings()
+
+
+from src import names, planning
+from src import utils
+from depers_only import build_transformer
+
+
+logger = logging.getLogger(__name__)
+
+
+def plan(sample_batches: int):
+    logger.info("Start of planning")
+
+    settings = get_processing_settings()
+
+    connector = utils.db_connector.DatabaseConnector(only_src=True)
+    src_conn = connector.get_src_connection()
+
+    transform = build_transformer(src_conn, connector)
+
+    backpressure = settings.get("backpressure") or {}
+    result = planning.planner.build_plan(
+        src_conn,
+        transform,
+        names.SRC_TABLE,
+        names.TRANSFER_TABLE,
+        names.PROCCESED_COLUMN,
+        names.ID_COLUMN,
+        sample_batches,
+        backpressure.get("high"),
+        backpressure.get("unit", "rows"),
+    )
+    logger.info(f"Planning completed:\n{planning.planner.format_plan(result)}")
+
+
+if __name__ == "__main__":
+    plan(args.batches)
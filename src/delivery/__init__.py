@@ -0,0 +1 @@
+from . import copy_fanout
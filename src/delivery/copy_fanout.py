@@ -0,0 +1,209 @@
+import functools
+import io
+import logging
+import psycopg2
+import typing
+
+from src.monitoring.metrics import get_metrics_collector
+from src.utils import db_connector, utils
+
+
+logger = logging.getLogger(__name__)
+metrics = get_metrics_collector()
+
+
+class BufferOverflow(Exception):
+    pass
+
+
+class BoundedBuffer(io.RawIOBase):
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.data = bytearray()
+        self.size = 0
+        self.overflowed = False
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        # past the limit the rest of COPY is drained and dropped, aborting it
+        # from the callback would leave the source connection mid-COPY
+        self.size += len(data)
+        if self.size > self.max_bytes:
+            self.overflowed = True
+            self.data = bytearray()
+        if not self.overflowed:
+            self.data += data
+        return len(data)
+
+    def getvalue(self):
+        return self.data
+
+
+class ShardedBuffer(BoundedBuffer):
+    # rows go to their shard as COPY writes them, so the batch is held once;
+    # the shard number is the last field and COPY text format escapes tabs
+    # and newlines inside values, so splitting on them is safe
+    def __init__(self, max_bytes: int, shard_count: int):
+        super().__init__(max_bytes)
+        self.shards = [bytearray() for _ in range(shard_count)]
+
+    def write(self, data):
+        size = super().write(data)
+        if self.overflowed:
+            self.shards = []
+            return size
+
+        end = self.data.rfind(b"\n") + 1
+        if end:
+            for line in self.data[:end].splitlines():
+                row, shard = line.rsplit(b"\t", 1)
+                self.shards[int(shard)] += row + b"\n"
+            del self.data[:end]
+        return size
+
+    def get_shards(self):
+        return self.shards
+
+
+class _ViewReader(io.RawIOBase):
+    # io.BytesIO would copy the batch for every destination
+    def __init__(self, data):
+        self.view = memoryview(data)
+        self.pos = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        size = min(len(b), len(self.view) - self.pos)
+        b[:size] = self.view[self.pos : self.pos + size]
+        self.pos += size
+        return size
+
+
+class CopyFanOut:
+    def __init__(
+        self,
+        dst_conn: db_connector.MultiClusterConnection,
+        dst_table: str,
+        columns: typing.List[str],
+        max_buffer_bytes: int,
+        shard_key: typing.Optional[str] = None,
+    ):
+        self.dst_conn = dst_conn
+        self.dst_table = dst_table
+        self.columns = columns
+        self.max_buffer_bytes = max_buffer_bytes
+        self.shard_key = shard_key
+
+        self.hosts = dst_conn.get_hosts()
+        self.delivered = [0 for _ in self.hosts]
+
+        # the batch the source has not marked processed yet, with the rowcount
+        # of every destination that applied it and None for the rest
+        self.pending = None
+        self.applied = None
+
+    def has_lost_connections(self):
+        return any([conn.closed for conn in self.dst_conn.connections])
+
+    def reconnect_lost(self):
+        return self.dst_conn.reconnect_lost()
+
+    def new_buffer(self):
+        if self.shard_key is None:
+            return BoundedBuffer(self.max_buffer_bytes)
+        return ShardedBuffer(self.max_buffer_bytes, len(self.hosts))
+
+    def get_copy_query(self, select_list: str):
+        if self.shard_key is None:
+            return f"COPY (SELECT {select_list}) TO STDOUT"
+
+        shard_expr = utils.get_shard_expr(self.shard_key, len(self.hosts))
+        return (
+            f"COPY (SELECT b.*, {shard_expr} FROM (SELECT {select_list}) b) TO STDOUT"
+        )
+
+    def _copy_to(self, conn, data: bytes):
+        if not data:
+            return 0
+
+        copy_query = (
+            f"COPY {self.dst_table} ({utils.join_names(self.columns)}) FROM STDIN"
+        )
+        with conn.cursor() as cur:
+            cur.copy_expert(copy_query, _ViewReader(data))
+            rowcount = cur.rowcount
+        if not conn.autocommit:
+            conn.commit()
+        return rowcount
+
+    def _try_copy_to(self, conn, data: bytes):
+        try:
+            return self._copy_to(conn, data), None
+        except psycopg2.Error as err:
+            return None, err
+
+    def deliver(self, buffer: BoundedBuffer):
+        if buffer.overflowed:
+            raise BufferOverflow(
+                f"A transformed row exceeds {self.max_buffer_bytes} bytes, "
+                f"increase max_buffer_bytes"
+            )
+        if not buffer.size:
+            return 0
+
+        if self.shard_key is None:
+            self.pending = [buffer.getvalue() for _ in self.dst_conn.connections]
+        else:
+            self.pending = buffer.get_shards()
+        self.applied = [None for _ in self.pending]
+
+        logger.debug(f"Batch of {buffer.size} bytes goes to {self.hosts}")
+        return self.resend_pending()
+
+    def has_pending(self):
+        return self.pending is not None
+
+    def acknowledge(self):
+        # the source marked the batch processed, it is never sent again
+        self.pending = None
+        self.applied = None
+
+    def resend_pending(self):
+        # each destination commits on its own, so after a failure the batch
+        # goes only to those that did not apply it, the rest keep one copy
+        calls = [
+            functools.partial(self._try_copy_to, conn, conn_data)
+            if rowcount is None
+            else (lambda: (None, None))
+            for conn, conn_data, rowcount in zip(
+                self.dst_conn.connections, self.pending, self.applied
+            )
+        ]
+        outcomes, timings = self.dst_conn.fan_out(calls)
+
+        errors = []
+        for dst, (rowcount, err) in enumerate(outcomes):
+            if err is not None:
+                errors.append(err)
+            elif rowcount is not None:
+                self.applied[dst] = rowcount
+                self.delivered[dst] += rowcount
+        metrics.add_metrics_array("total_cnt", self.delivered, self.hosts)
+        metrics.add_metrics_array("dst_query_time_s", timings, self.hosts)
+
+        if errors:
+            missing = [
+                host
+                for host, rowcount in zip(self.hosts, self.applied)
+                if rowcount is None
+            ]
+            logger.warning(f"Batch not applied on {missing}, keeping it to resend")
+            raise errors[0]
+
+        if self.shard_key is None:
+            return min(self.applied)
+        return sum(self.applied)
@@ -1,15 +1,115 @@
 import dash
 from dash import dcc, html
-from dash.dependencies import Input, Output
+from dash.dependencies import Input, Output, State, MATCH
 import dash_bootstrap_components as dbc
 import plotly.graph_objects as go
 import pandas as pd
 
-from src.monitoring.metrics import get_metrics_collector
+import math
+import os
+import threading
+
+from src.monitoring import downsampling, segment_store
+from src.monitoring.metrics import MetricsCollectorFactory, get_metrics_collector
+from src.monitoring.series_cache import SeriesCache
+from src.settings import get_settings
+
+
+MAX_POINTS = 2000
+PLOT_POINTS = int(
+    os.environ.get(
+        "DASHBOARD_PLOT_POINTS", get_settings().get("dashboard_plot_points", 1000)
+    )
+)
+
+collectors = threading.local()
+series_cache = SeriesCache(MAX_POINTS)
+segment_reader = None
+
+
+def get_segment_reader():
+    global segment_reader
+
+    segments_dir = os.environ.get("METRICS_SEGMENTS_DIR")
+    if segments_dir is None and MetricsCollectorFactory.segment_settings is not None:
+        segments_dir = MetricsCollectorFactory.segment_settings["dir"]
+    if segments_dir is None:
+        return None
+
+    if segment_reader is None:
+        segment_reader = segment_store.SegmentReader(segments_dir)
+    # the newest run is shown unless one is pinned, as with sqlite
+    segment_reader.run_id = (
+        os.environ.get("METRICS_RUN_ID") or segment_reader.get_latest_run()
+    )
+    return segment_reader
+
+
+def get_metrics_db_path():
+    db_path = os.environ.get("METRICS_DB_PATH", MetricsCollectorFactory.db_path)
+    if db_path is None:
+        raise Exception("Set METRICS_DB_PATH or metrics_dir in settings")
+    return db_path
 
 
 def get_metrics():
-    return get_metrics_collector("/home/ardooo/learning/diplom/metrics/metrics.db")
+    # sqlite connections are bound to a thread, callbacks run in a pool
+    if not hasattr(collectors, "metrics"):
+        collectors.metrics = get_metrics_collector(get_metrics_db_path())
+    metrics = collectors.metrics
+    # the newest run is shown unless one is pinned
+    metrics.run_id = os.environ.get("METRICS_RUN_ID") or metrics.get_latest_run()
+    return metrics
+
+
+def get_series(name, tag=None):
+    reader = get_segment_reader()
+    if reader is not None:
+        return reader.read_series(name, tag)
+    return series_cache.get(get_metrics(), name, [tag])[tag]
+
+
+def get_host_series(name, hosts):
+    reader = get_segment_reader()
+    if reader is not None:
+        return {host: reader.read_series(name, host) for host in hosts}
+    return series_cache.get(get_metrics(), name, hosts)
+
+
+def get_hosts():
+    reader = get_segment_reader()
+    if reader is not None:
+        return reader.get_hosts()
+    return get_metrics().get_hosts()
+
+
+def get_zoom_window(relayout_data):
+    if not relayout_data or "xaxis.range[0]" not in relayout_data:
+        return None
+
+    start = pd.Timestamp(relayout_data["xaxis.range[0]"]).timestamp()
+    end = pd.Timestamp(relayout_data["xaxis.range[1]"]).timestamp()
+    return math.floor(start), math.ceil(end)
+
+
+def get_plot_series(name, tag=None, relayout_data=None, series=None):
+    window = get_zoom_window(relayout_data)
+    reader = get_segment_reader()
+    if window is not None and reader is not None:
+        timestamps, values = reader.read_series(
+            name, tag, window[0] * 1_000_000_000, window[1] * 1_000_000_000
+        )
+    elif window is not None:
+        # the visible window is fetched again at the finest resolution that fits
+        timestamps, values, _ = get_metrics().get_metric_series(
+            name, tag, window[0], window[1], max_points=MAX_POINTS
+        )
+    elif series is not None:
+        timestamps, values = series
+    else:
+        timestamps, values = get_series(name, tag)
+
+    return downsampling.downsample(timestamps, values, PLOT_POINTS)
 
 
 def interpolate_and_difference(ts1, ts2):
@@ -111,6 +211,9 @@ app.layout = dbc.Container(
         dbc.Row(
             [dbc.Col(dcc.Graph(id="batch-time-graph"), width=12)], className="mt-2"
         ),
+        dbc.Row(
+            [dbc.Col(dcc.Graph(id="replication-lag-graph"), width=12)], className="mt-2"
+        ),
         dcc.Store(id="hosts-store", data=[]),
         html.Div(id="graphs-container"),
     ],
@@ -150,17 +253,25 @@ def update_interval(input_value):
     [Input("interval-component", "n_intervals")],
 )
 def update_graph(n_clicks, n_intervals):
-    ts1 = get_metrics().get_metric_by_name("total_mark_processed")
-    ts2 = get_metrics().get_metric_by_name("total_deleted")
+    timestamps, values = get_plot_series("transfer_backlog_rows")
+
+    if len(timestamps) == 0:
+        timestamps, values = get_plot_series("transfer_backlog")
 
-    difference = interpolate_and_difference(ts1, ts2)
-    difference = difference.where(difference >= 0, 0)
+    # databases written before the backlog was derived by the metrics writer
+    if len(timestamps) == 0:
+        ts1 = get_series("total_mark_processed")
+        ts2 = get_series("total_deleted")
+
+        difference = interpolate_and_difference(ts1, ts2)
+        difference = difference.where(difference >= 0, 0)
+        timestamps, values = difference.index, difference
 
     fig = go.Figure()
     fig.add_trace(
         go.Scatter(
-            x=difference.index,
-            y=difference,
+            x=timestamps,
+            y=values,
             mode="lines",
             name="Количество записей в трансферной таблице",
         )
@@ -183,13 +294,37 @@ def update_graph(n_clicks, n_intervals):
     Output("batch-time-graph", "figure"),
     [Input("update-button", "n_clicks")],
     [Input("interval-component", "n_intervals")],
+    [Input("batch-time-graph", "relayoutData")],
 )
-def update_batch_time_graph(n_clicks, n_intervals):
-    timestamps, values = get_metrics().get_metric_by_name("batch_time_execution_s")
+def update_batch_time_graph(n_clicks, n_intervals, relayout_data):
     fig = go.Figure()
-    fig.add_trace(
-        go.Scatter(x=timestamps, y=values, mode="lines", name="batch_time_execution_s")
-    )
+
+    # percentile snapshots are written by the metrics writer process
+    bands = [
+        (suffix, get_plot_series(f"batch_time_execution_s_{suffix}", None, relayout_data))
+        for suffix in ("p50", "p99", "max")
+    ]
+    if len(bands[0][1][0]) > 0:
+        for suffix, (timestamps, values) in bands:
+            fig.add_trace(
+                go.Scatter(
+                    x=timestamps,
+                    y=values,
+                    mode="lines",
+                    name=suffix,
+                    fill="tonexty" if suffix == "p99" else None,
+                    line={"dash": "dot"} if suffix == "max" else None,
+                )
+            )
+    else:
+        timestamps, values = get_plot_series(
+            "batch_time_execution_s", relayout_data=relayout_data
+        )
+        fig.add_trace(
+            go.Scatter(
+                x=timestamps, y=values, mode="lines", name="batch_time_execution_s"
+            )
+        )
 
     fig.update_layout(
         title="Время обработки одного батча",
@@ -200,6 +335,7 @@ def update_batch_time_graph(n_clicks, n_intervals):
         title_font_color="#FFA07A",
         font_color="#FFA07A",
         hovermode="x unified",
+        uirevision="batch-time",
     )
     return fig
 
@@ -210,31 +346,79 @@ def update_batch_time_graph(n_clicks, n_intervals):
     [Input("interval-component", "n_intervals")],
 )
 def update_hosts(n_clicks, n_intervals):
-    hosts = get_metrics().get_hosts()
+    hosts = get_hosts()
     return hosts
 
 
+@app.callback(
+    Output("replication-lag-graph", "figure"),
+    [Input("hosts-store", "data")],
+    [Input("replication-lag-graph", "relayoutData")],
+)
+def update_replication_lag_graph(hosts, relayout_data):
+    fig = go.Figure()
+
+    # lag is measured on the source, one line per destination
+    if hosts:
+        host_series = get_host_series("replication_confirmed_lag_bytes", hosts)
+        for host in hosts:
+            timestamps, values = get_plot_series(
+                "replication_confirmed_lag_bytes",
+                host,
+                relayout_data,
+                series=host_series[host],
+            )
+            fig.add_trace(go.Scatter(x=timestamps, y=values, mode="lines", name=host))
+
+    fig.update_layout(
+        title="Отставание реплик",
+        title_font_size=22,
+        yaxis_title="Байты WAL",
+        yaxis_title_font_size=18,
+        template="plotly_dark",
+        title_font_color="#FFA07A",
+        font_color="#FFA07A",
+        hovermode="x unified",
+        uirevision="replication-lag",
+    )
+    return fig
+
+
+def get_host_figure(host, timestamps, values):
+    fig = go.Figure()
+    fig.add_trace(go.Scatter(x=timestamps, y=values, mode="lines"))
+    fig.update_layout(
+        title=f"Динамика передачи записей {host}",
+        title_font_size=22,
+        yaxis_title="Количество",
+        yaxis_title_font_size=18,
+        template="plotly_dark",
+        title_font_color="#FFA07A",
+        font_color="#FFA07A",
+        hovermode="x unified",
+        uirevision=host,
+    )
+    return fig
+
+
 @app.callback(
     Output("graphs-container", "children"),
     [Input("hosts-store", "data")],
 )
 def update_graphs(hosts):
     rows = []
+    if not hosts:
+        return rows
+
+    host_series = get_host_series("total_cnt", hosts)
     for host in hosts:
-        timestamps, values = get_metrics().get_metric_by_tag_and_name(host, "total_cnt")
-        fig = go.Figure()
-        fig.add_trace(go.Scatter(x=timestamps, y=values, mode="lines"))
-        fig.update_layout(
-            title=f"Динамика передачи записей {host}",
-            title_font_size=22,
-            yaxis_title="Количество",
-            yaxis_title_font_size=18,
-            template="plotly_dark",
-            title_font_color="#FFA07A",
-            font_color="#FFA07A",
-            hovermode="x unified",
+        timestamps, values = get_plot_series(
+            "total_cnt", host, series=host_series[host]
+        )
+        graph = dcc.Graph(
+            id={"type": "host-graph", "host": host},
+            figure=get_host_figure(host, timestamps, values),
         )
-        graph = dcc.Graph(figure=fig)
         row = dbc.Row(
             [dbc.Col(graph, width=12)],
             className="my-2",
@@ -243,5 +427,17 @@ def update_graphs(hosts):
     return rows
 
 
+@app.callback(
+    Output({"type": "host-graph", "host": MATCH}, "figure"),
+    [Input({"type": "host-graph", "host": MATCH}, "relayoutData")],
+    [State({"type": "host-graph", "host": MATCH}, "id")],
+    prevent_initial_call=True,
+)
+def zoom_host_graph(relayout_data, graph_id):
+    host = graph_id["host"]
+    timestamps, values = get_plot_series("total_cnt", host, relayout_data)
+    return get_host_figure(host, timestamps, values)
+
+
 if __name__ == "__main__":
     app.run_server()
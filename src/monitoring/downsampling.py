@@ -0,0 +1,49 @@
+import numpy as np
+
+
+def lttb_indices(x: np.ndarray, y: np.ndarray, threshold: int):
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+
+    # first and last points are kept, the rest is split into threshold - 2 buckets
+    edges = np.linspace(1, n - 1, threshold - 1).astype(np.int64)
+
+    indices = np.empty(threshold, dtype=np.int64)
+    indices[0] = 0
+    indices[-1] = n - 1
+
+    selected = 0
+    for bucket in range(threshold - 2):
+        start, end = edges[bucket], edges[bucket + 1]
+        if bucket + 2 < len(edges):
+            next_start, next_end = edges[bucket + 1], edges[bucket + 2]
+        else:
+            next_start, next_end = n - 1, n
+
+        avg_x = x[next_start:next_end].mean()
+        avg_y = y[next_start:next_end].mean()
+
+        # doubled triangle areas between the selected point, each candidate
+        # and the average of the next bucket
+        areas = np.abs(
+            (x[selected] - avg_x) * (y[start:end] - y[selected])
+            - (x[selected] - x[start:end]) * (avg_y - y[selected])
+        )
+        selected = start + int(np.argmax(areas))
+        indices[bucket + 1] = selected
+
+    return indices
+
+
+def downsample(timestamps, values, threshold: int):
+    if len(timestamps) <= threshold:
+        return timestamps, values
+
+    x = np.array(timestamps, dtype="datetime64[ms]").astype(np.float64)
+    y = np.asarray(values, dtype=np.float64)
+
+    indices = lttb_indices(x, y, threshold)
+    if isinstance(timestamps, np.ndarray):
+        return timestamps[indices], y[indices]
+    return [timestamps[i] for i in indices], y[indices].tolist()
@@ -0,0 +1,87 @@
+import math
+
+
+# Sparse histogram with logarithmic buckets: every bucket is relative_error
+# wide relative to its value, so percentiles keep that error over any range.
+# Histograms with the same parameters merge by adding bucket counts.
+class LogHistogram:
+    def __init__(self, relative_error: float = 0.01, lowest: float = 1e-6):
+        self.relative_error = relative_error
+        self.lowest = lowest
+        self.log_base = math.log1p(2 * relative_error)
+        self.buckets = {}
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def _get_index(self, value: float):
+        if value <= self.lowest:
+            return -1
+        return int(math.log(value / self.lowest) / self.log_base)
+
+    def _get_value(self, index: int):
+        if index < 0:
+            return self.lowest
+        # middle of the bucket, so the error is at most relative_error
+        return self.lowest * math.exp((index + 0.5) * self.log_base)
+
+    def record(self, value: float, count: int = 1):
+        index = self._get_index(value)
+        self.buckets[index] = self.buckets.get(index, 0) + count
+        self.count += count
+        self.sum += value * count
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def merge(self, other: "LogHistogram"):
+        if (other.relative_error, other.lowest) != (self.relative_error, self.lowest):
+            raise Exception("Cannot merge histograms with different buckets")
+
+        for index, count in other.buckets.items():
+            self.buckets[index] = self.buckets.get(index, 0) + count
+        self.count += other.count
+        self.sum += other.sum
+        if other.count > 0:
+            self.min = other.min if self.min is None else min(self.min, other.min)
+            self.max = other.max if self.max is None else max(self.max, other.max)
+
+    def percentile(self, percent: float):
+        if self.count == 0:
+            return None
+
+        rank = max(math.ceil(self.count * percent / 100), 1)
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen >= rank:
+                return min(max(self._get_value(index), self.min), self.max)
+        return self.max
+
+    def reset(self):
+        self.buckets = {}
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def to_dict(self):
+        return {
+            "relative_error": self.relative_error,
+            "lowest": self.lowest,
+            "buckets": self.buckets,
+            "count": self.count,
+            "sum": self.sum,
+            "min": self.min,
+            "max": self.max,
+        }
+
+    @staticmethod
+    def from_dict(data: dict):
+        histogram = LogHistogram(data["relative_error"], data["lowest"])
+        histogram.buckets = {int(index): count for index, count in data["buckets"].items()}
+        histogram.count = data["count"]
+        histogram.sum = data["sum"]
+        histogram.min = data["min"]
+        histogram.max = data["max"]
+        return histogram
@@ -1,15 +1,42 @@
+import atexit
+import calendar
+import collections
+import datetime
+import multiprocessing.util
+import os
 import pathlib
+import queue
+import signal
 import sqlite3
+import threading
+import time
 from threading import Lock
 
+from src.monitoring import prometheus, segment_store
+from src.monitoring.histogram import LogHistogram
 from src.settings import get_settings
 
 
+ROLLUP_RESOLUTIONS = (1, 60, 3600)
+ROLLUP_AGGREGATES = ("count", "sum", "min", "max", "last", "avg")
+
+
+def get_timestamp(seconds_ago=0):
+    now = datetime.datetime.now(datetime.timezone.utc)
+    now -= datetime.timedelta(seconds=seconds_ago)
+    return now.strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]
+
+
+def create_run_id():
+    now = datetime.datetime.now(datetime.timezone.utc)
+    return now.strftime("%Y%m%dT%H%M%S") + f"-{os.getpid()}"
+
+
 class MetricsCollectorStub:
-    def add_metric(self, name, value):
+    def add_metric(self, name, value, tag=None):
         pass
 
-    def increment_metric(self, name, increment_value):
+    def increment_metric(self, name, increment_value, tag=None):
         pass
 
     def add_metrics_array(self, name, values, tags):
@@ -26,9 +53,13 @@ class MetricsCollector:
     __init_db = False
     __lock = Lock()
 
-    def __init__(self, db_path=None):
+    def __init__(self, db_path=None, run_id=None):
+        # run_id scopes both the written points and the queries, None reads all runs
         self.db_path = db_path
+        self.run_id = run_id
         self.conn = sqlite3.connect(db_path)
+        # freed pages are given back by the compaction, only for new databases
+        self.conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
         self.conn.execute('PRAGMA journal_mode=WAL')
         self.last_values = {}
 
@@ -38,7 +69,13 @@ class MetricsCollector:
                 MetricsCollector.__init_db = True
 
     def __del__(self):
-        self.conn.close()
+        if self.conn is not None:
+            self.conn.close()
+
+    @staticmethod
+    def _get_columns(cur, table):
+        cur.execute(f"PRAGMA table_info({table})")
+        return [row[1] for row in cur.fetchall()]
 
     def _initialize_db(self):
         cur = self.conn.cursor()
@@ -48,28 +85,151 @@ class MetricsCollector:
             name TEXT NOT NULL,
             value REAL NOT NULL,
             tag TEXT DEFAULT NULL,
-            timestamp DATETIME DEFAULT (strftime('%Y-%m-%d %H:%M:%f', 'now'))
+            timestamp DATETIME DEFAULT (strftime('%Y-%m-%d %H:%M:%f', 'now')),
+            run_id TEXT NOT NULL DEFAULT ''
         );
         """
         cur.execute(query)
+        # points written before run ids keep the empty run id
+        if "run_id" not in self._get_columns(cur, "metrics"):
+            cur.execute("ALTER TABLE metrics ADD COLUMN run_id TEXT NOT NULL DEFAULT ''")
+        cur.execute("DROP INDEX IF EXISTS idx_name_timestamp;")
         cur.execute(
-            "CREATE INDEX IF NOT EXISTS idx_name_timestamp ON metrics(name, timestamp);"
+            "CREATE INDEX IF NOT EXISTS idx_name_run_timestamp "
+            "ON metrics(name, run_id, timestamp);"
         )
         cur.execute(
             "CREATE INDEX IF NOT EXISTS idx_tag ON metrics(tag) WHERE tag is not NULL;"
         )
-        self.conn.commit()
-        cur.close()
 
-    def add_metric(self, name, value, tag=None):
-        cur = self.conn.cursor()
+        # the run id is part of the rollup key, so old rollups are copied over
+        rollup_columns = self._get_columns(cur, "metrics_rollup")
+        migrate_rollups = rollup_columns and "run_id" not in rollup_columns
+        if migrate_rollups:
+            cur.execute("ALTER TABLE metrics_rollup RENAME TO metrics_rollup_old")
+        query = """
+        CREATE TABLE IF NOT EXISTS metrics_rollup (
+            name TEXT NOT NULL,
+            tag TEXT NOT NULL DEFAULT '',
+            resolution INTEGER NOT NULL,
+            run_id TEXT NOT NULL DEFAULT '',
+            bucket INTEGER NOT NULL,
+            count INTEGER NOT NULL,
+            sum REAL NOT NULL,
+            min REAL NOT NULL,
+            max REAL NOT NULL,
+            last REAL NOT NULL,
+            last_timestamp TEXT NOT NULL,
+            PRIMARY KEY (name, tag, resolution, run_id, bucket)
+        );
+        """
+        cur.execute(query)
+        if migrate_rollups:
+            cur.execute(
+                """
+                INSERT INTO metrics_rollup
+                    (name, tag, resolution, bucket, count, sum, min, max, last, last_timestamp)
+                SELECT name, tag, resolution, bucket, count, sum, min, max, last, last_timestamp
+                FROM metrics_rollup_old
+                """
+            )
+            cur.execute("DROP TABLE metrics_rollup_old")
         cur.execute(
-            "INSERT INTO metrics (name, value, tag) VALUES (?, ?, ?)",
-            (name, value, tag),
+            "CREATE INDEX IF NOT EXISTS idx_rollup_resolution_bucket "
+            "ON metrics_rollup(resolution, bucket);"
         )
+
+        query = """
+        CREATE TABLE IF NOT EXISTS metrics_runs (
+            run_id TEXT PRIMARY KEY,
+            started TEXT NOT NULL,
+            last_timestamp TEXT NOT NULL
+        );
+        """
+        cur.execute(query)
         self.conn.commit()
         cur.close()
 
+    def _get_run_filter(self, column="run_id"):
+        if self.run_id is None:
+            return "", []
+        return f" AND {column} = ?", [self.run_id]
+
+    @staticmethod
+    def _aggregate_rollups(records, run_id=""):
+        rollups = {}
+        epochs = {}
+        for name, value, tag, timestamp in records:
+            second = timestamp[:19]
+            epoch = epochs.get(second)
+            if epoch is None:
+                epoch = calendar.timegm(time.strptime(second, "%Y-%m-%d %H:%M:%S"))
+                epochs[second] = epoch
+
+            for resolution in ROLLUP_RESOLUTIONS:
+                key = (name, tag or "", resolution, run_id, epoch - epoch % resolution)
+                rollup = rollups.get(key)
+                if rollup is None:
+                    rollups[key] = [1, value, value, value, value, timestamp]
+                    continue
+                rollup[0] += 1
+                rollup[1] += value
+                rollup[2] = min(rollup[2], value)
+                rollup[3] = max(rollup[3], value)
+                if timestamp >= rollup[5]:
+                    rollup[4] = value
+                    rollup[5] = timestamp
+
+        return [key + tuple(rollup) for key, rollup in rollups.items()]
+
+    @staticmethod
+    def _write_records(conn, records, run_id=""):
+        if not records:
+            return
+
+        cur = conn.cursor()
+        cur.executemany(
+            "INSERT INTO metrics (name, value, tag, timestamp, run_id) "
+            "VALUES (?, ?, ?, ?, ?)",
+            [record + (run_id,) for record in records],
+        )
+        cur.executemany(
+            """
+            INSERT INTO metrics_rollup
+                (name, tag, resolution, run_id, bucket,
+                 count, sum, min, max, last, last_timestamp)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (name, tag, resolution, run_id, bucket) DO UPDATE SET
+                count = count + excluded.count,
+                sum = sum + excluded.sum,
+                min = MIN(min, excluded.min),
+                max = MAX(max, excluded.max),
+                last = CASE WHEN excluded.last_timestamp >= last_timestamp
+                    THEN excluded.last ELSE last END,
+                last_timestamp = MAX(last_timestamp, excluded.last_timestamp)
+            """,
+            MetricsCollector._aggregate_rollups(records, run_id),
+        )
+        if run_id:
+            timestamps = [record[3] for record in records]
+            cur.execute(
+                """
+                INSERT INTO metrics_runs (run_id, started, last_timestamp)
+                VALUES (?, ?, ?)
+                ON CONFLICT (run_id) DO UPDATE SET
+                    started = MIN(started, excluded.started),
+                    last_timestamp = MAX(last_timestamp, excluded.last_timestamp)
+                """,
+                (run_id, min(timestamps), max(timestamps)),
+            )
+        conn.commit()
+        cur.close()
+
+    def add_metric(self, name, value, tag=None):
+        self._write_records(
+            self.conn, [(name, value, tag, get_timestamp())], self.run_id or ""
+        )
+
     def add_metrics_array(self, name, values, tags):
         for value, tag in zip(values, tags):
             self.add_metric(name, value, tag)
@@ -89,8 +249,9 @@ class MetricsCollector:
 
     def get_metric_by_name(self, name):
         cur = self.conn.cursor()
-        query = "SELECT value, timestamp FROM metrics WHERE name=?"
-        cur.execute(query, (name,))
+        run_filter, run_params = self._get_run_filter()
+        query = "SELECT value, timestamp FROM metrics WHERE name=?" + run_filter
+        cur.execute(query, [name] + run_params)
         results = cur.fetchall()
         cur.close()
 
@@ -101,8 +262,9 @@ class MetricsCollector:
 
     def get_metric_by_tag_and_name(self, tag, name):
         cur = self.conn.cursor()
-        query = "SELECT value, timestamp FROM metrics WHERE tag=? and name=?"
-        cur.execute(query, (tag, name))
+        run_filter, run_params = self._get_run_filter()
+        query = "SELECT value, timestamp FROM metrics WHERE tag=? and name=?" + run_filter
+        cur.execute(query, [tag, name] + run_params)
         results = cur.fetchall()
         cur.close()
 
@@ -111,11 +273,158 @@ class MetricsCollector:
 
         return timestamps, values
 
+    def get_raw_count(self, name, tag=None, start=None, end=None):
+        # hourly rollups give the count, second rollups the exact bounds,
+        # both are primary key lookups
+        run_filter, run_params = self._get_run_filter()
+        cur = self.conn.cursor()
+        cur.execute(
+            """
+            SELECT COALESCE(SUM(count), 0) FROM metrics_rollup
+            WHERE name = ? AND tag = ? AND resolution = ?
+                AND bucket >= COALESCE(? - ? + 1, bucket) AND bucket < COALESCE(?, bucket + 1)
+            """
+            + run_filter,
+            [
+                name,
+                tag or "",
+                ROLLUP_RESOLUTIONS[-1],
+                start,
+                ROLLUP_RESOLUTIONS[-1],
+                end,
+            ]
+            + run_params,
+        )
+        raw_count = cur.fetchone()[0]
+        cur.execute(
+            """
+            SELECT MIN(bucket), MAX(bucket) FROM metrics_rollup
+            WHERE name = ? AND tag = ? AND resolution = ?
+            """
+            + run_filter,
+            [name, tag or "", ROLLUP_RESOLUTIONS[0]] + run_params,
+        )
+        first_bucket, last_bucket = cur.fetchone()
+        cur.close()
+        return raw_count, first_bucket, last_bucket
+
+    def choose_resolution(self, name, tag=None, start=None, end=None, max_points=None):
+        if max_points is None:
+            return None
+
+        raw_count, first_bucket, last_bucket = self.get_raw_count(
+            name, tag, start, end
+        )
+        if raw_count <= max_points:
+            return None
+
+        start = first_bucket if start is None else start
+        end = last_bucket + 1 if end is None else end
+        for resolution in ROLLUP_RESOLUTIONS:
+            if (end - start) / resolution <= max_points:
+                return resolution
+        return ROLLUP_RESOLUTIONS[-1]
+
+    def get_metric_series(
+        self,
+        name,
+        tag=None,
+        start=None,
+        end=None,
+        max_points=None,
+        aggregate="max",
+    ):
+        # start and end are unix seconds, resolution None means raw points
+        if aggregate not in ROLLUP_AGGREGATES:
+            raise Exception(f"Unknown rollup aggregate '{aggregate}'")
+
+        resolution = self.choose_resolution(name, tag, start, end, max_points)
+        run_filter, run_params = self._get_run_filter()
+
+        if resolution is None:
+            query = (
+                "SELECT timestamp, value FROM metrics WHERE name = ? AND tag IS ?"
+                + run_filter
+            )
+            params = [name, tag] + run_params
+            time_column = "timestamp"
+            if start is not None:
+                query += " AND timestamp >= datetime(?, 'unixepoch')"
+            if end is not None:
+                query += " AND timestamp < datetime(?, 'unixepoch')"
+        else:
+            value = "sum / count" if aggregate == "avg" else aggregate
+            query = (
+                f"SELECT datetime(bucket, 'unixepoch'), {value} FROM metrics_rollup "
+                f"WHERE name = ? AND tag = ? AND resolution = ?" + run_filter
+            )
+            params = [name, tag or "", resolution] + run_params
+            time_column = "bucket"
+            if start is not None:
+                query += " AND bucket >= ?"
+            if end is not None:
+                query += " AND bucket < ?"
+
+        params += [bound for bound in (start, end) if bound is not None]
+
+        cur = self.conn.cursor()
+        cur.execute(query + f" ORDER BY {time_column}", params)
+        results = cur.fetchall()
+        cur.close()
+
+        timestamps = [timestamp for timestamp, _ in results]
+        values = [value for _, value in results]
+
+        return timestamps, values, resolution
+
+    def get_metric_updates(self, name, tags, resolution=None, after=None):
+        # returns (tag, position, timestamp, value) rows past the given position,
+        # position is the row id for raw points and the bucket for rollups,
+        # the last bucket is returned again since it may still be filling up
+        run_filter, run_params = self._get_run_filter()
+        if resolution is None:
+            query = (
+                "SELECT tag, id, timestamp, value FROM metrics WHERE name = ?"
+                + run_filter
+            )
+            params = [name] + run_params
+            if tags == [None]:
+                query += " AND tag IS NULL"
+            else:
+                query += f" AND tag IN ({', '.join(['?'] * len(tags))})"
+                params += tags
+            if after is not None:
+                query += " AND id > ?"
+                params.append(after)
+            query += " ORDER BY id"
+        else:
+            query = (
+                "SELECT NULLIF(tag, ''), bucket, datetime(bucket, 'unixepoch'), max "
+                "FROM metrics_rollup WHERE name = ? AND resolution = ?"
+                f" AND tag IN ({', '.join(['?'] * len(tags))})" + run_filter
+            )
+            params = [name, resolution] + [tag or "" for tag in tags] + run_params
+            if after is not None:
+                query += " AND bucket >= ?"
+                params.append(after)
+            query += " ORDER BY bucket"
+
+        cur = self.conn.cursor()
+        cur.execute(query, params)
+        results = cur.fetchall()
+        cur.close()
+        return results
+
     def get_all_tags(self):
         cur = self.conn.cursor()
 
-        query = "SELECT DISTINCT tag FROM metrics WHERE tag IS NOT NULL"
-        cur.execute(query)
+        # every tagged point lands in an hourly rollup, which is far smaller
+        run_filter, run_params = self._get_run_filter()
+        query = (
+            "SELECT DISTINCT tag FROM metrics_rollup "
+            f"WHERE resolution = {ROLLUP_RESOLUTIONS[-1]} AND tag != ''" + run_filter
+        )
+        cur.execute(query, run_params)
 
         tags = [row[0] for row in cur.fetchall()]
 
@@ -129,10 +438,398 @@ class MetricsCollector:
         hosts = [tag for tag in tags if tag[:5] == "host="]
         return hosts
 
+    def get_runs(self):
+        cur = self.conn.cursor()
+        cur.execute(
+            "SELECT run_id, started, last_timestamp FROM metrics_runs ORDER BY started"
+        )
+        runs = cur.fetchall()
+        cur.close()
+        return runs
+
+    def get_latest_run(self):
+        cur = self.conn.cursor()
+        cur.execute("SELECT run_id FROM metrics_runs ORDER BY started DESC LIMIT 1")
+        row = cur.fetchone()
+        cur.close()
+        return row[0] if row is not None else None
+
+
+BACKLOG_COUNTERS = ("total_mark_processed", "total_deleted")
+METRICS_BACKENDS = ("sqlite", "prometheus", "segments")
+LATENCY_METRICS = ("batch_time_execution_s", "stage_time_s", "dst_query_time_s")
+PERCENTILES = (50, 90, 99)
+
+
+class LatencySnapshots:
+    def __init__(self, interval_s: float):
+        self.interval_s = interval_s
+        self.histograms = {}
+        self.last_snapshot = time.monotonic()
+
+    def record(self, records):
+        for name, value, tag, _ in records:
+            if name in LATENCY_METRICS:
+                histogram = self.histograms.get((name, tag))
+                if histogram is None:
+                    histogram = LogHistogram()
+                    self.histograms[(name, tag)] = histogram
+                histogram.record(value)
+
+    def snapshot(self, force=False):
+        now = time.monotonic()
+        if not force and now - self.last_snapshot < self.interval_s:
+            return []
+        self.last_snapshot = now
+
+        timestamp = get_timestamp()
+        records = []
+        for (name, tag), histogram in self.histograms.items():
+            if histogram.count == 0:
+                continue
+            for percent in PERCENTILES:
+                records.append(
+                    (f"{name}_p{percent}", histogram.percentile(percent), tag, timestamp)
+                )
+            records.append((f"{name}_max", histogram.max, tag, timestamp))
+            histogram.reset()
+        return records
+
+
+class MetricsCompactor:
+    def __init__(
+        self,
+        raw_days=None,
+        rollup_days=None,
+        interval_s=600.0,
+        chunk_rows=5000,
+        step_budget_s=0.1,
+    ):
+        # raw points and second rollups follow raw_days, coarser rollups rollup_days
+        self.raw_days = raw_days
+        self.rollup_days = rollup_days
+        self.interval_s = interval_s
+        self.chunk_rows = chunk_rows
+        self.step_budget_s = step_budget_s
+        self.next_pass = time.monotonic()
+        self.tasks = []
+        self.raw_cursor = None
+
+    def _get_tasks(self):
+        self.raw_cursor = None
+        tasks = []
+        if self.raw_days is not None:
+            seconds = self.raw_days * 86400
+            tasks.append((self._delete_raw, get_timestamp(seconds)))
+            tasks.append(
+                (self._delete_rollups, (ROLLUP_RESOLUTIONS[0], time.time() - seconds))
+            )
+        if self.rollup_days is not None:
+            seconds = self.rollup_days * 86400
+            for resolution in ROLLUP_RESOLUTIONS[1:]:
+                tasks.append((self._delete_rollups, (resolution, time.time() - seconds)))
+            tasks.append((self._delete_runs, get_timestamp(seconds)))
+        if tasks:
+            tasks.append((self._vacuum, None))
+        return tasks
+
+    def _delete_raw(self, cur, cutoff):
+        # ids grow with time, so old points are walked in id ranges from the
+        # first id until a range has nothing to delete
+        if self.raw_cursor is None:
+            cur.execute("SELECT MIN(id) FROM metrics")
+            self.raw_cursor = cur.fetchone()[0]
+            if self.raw_cursor is None:
+                return 0, True
+
+        cur.execute(
+            "DELETE FROM metrics WHERE id >= ? AND id < ? AND timestamp < ?",
+            (self.raw_cursor, self.raw_cursor + self.chunk_rows, cutoff),
+        )
+        self.raw_cursor += self.chunk_rows
+        return cur.rowcount, cur.rowcount == 0
+
+    def _delete_rollups(self, cur, cutoff):
+        resolution, bucket = cutoff
+        cur.execute(
+            """
+            DELETE FROM metrics_rollup WHERE rowid IN (
+                SELECT rowid FROM metrics_rollup
+                WHERE resolution = ? AND bucket < ? LIMIT ?
+            )
+            """,
+            (resolution, int(bucket), self.chunk_rows),
+        )
+        return cur.rowcount, cur.rowcount < self.chunk_rows
+
+    def _delete_runs(self, cur, cutoff):
+        cur.execute("DELETE FROM metrics_runs WHERE last_timestamp < ?", (cutoff,))
+        return cur.rowcount, True
+
+    def _vacuum(self, cur, _):
+        # returns free pages to the file system for databases created with
+        # incremental auto vacuum, older databases reuse them for new points
+        cur.execute("PRAGMA freelist_count")
+        free_pages = cur.fetchone()[0]
+        cur.execute(f"PRAGMA incremental_vacuum({self.chunk_rows})")
+        cur.fetchall()
+        return 0, free_pages <= self.chunk_rows
+
+    def step(self, conn):
+        # every chunk is a short transaction and the step stops after its
+        # budget, so points written meanwhile wait for one chunk at most
+        if not self.tasks:
+            if time.monotonic() < self.next_pass:
+                return 0
+            self.next_pass = time.monotonic() + self.interval_s
+            self.tasks = self._get_tasks()
+
+        deleted = 0
+        deadline = time.monotonic() + self.step_budget_s
+        cur = conn.cursor()
+        try:
+            while self.tasks and time.monotonic() < deadline:
+                task, cutoff = self.tasks[0]
+                rows, finished = task(cur, cutoff)
+                conn.commit()
+                deleted += rows
+                if finished:
+                    self.tasks.pop(0)
+        finally:
+            cur.close()
+        return deleted
+
+
+def resolve_increments(records, last_values, with_backlog=False):
+    resolved = []
+    for kind, name, value, tag, timestamp in records:
+        if kind == "inc":
+            value = last_values.get((name, tag), 0) + value
+            last_values[(name, tag)] = value
+        resolved.append((name, value, tag, timestamp))
+
+        # only the single writer sees both counters, so only it can keep
+        # the transfer table backlog up to date point by point
+        if with_backlog and tag is None and name in BACKLOG_COUNTERS:
+            processed, deleted = [
+                last_values.get((counter, None), 0) for counter in BACKLOG_COUNTERS
+            ]
+            resolved.append(
+                ("transfer_backlog", max(processed - deleted, 0), None, timestamp)
+            )
+    return resolved
+
+
+class BufferedMetricsCollector(MetricsCollector):
+    def __init__(
+        self,
+        db_path=None,
+        flush_interval_s=1.0,
+        flush_size=512,
+        max_buffered=100000,
+        run_id=None,
+    ):
+        if db_path is not None:
+            super().__init__(db_path, run_id)
+        else:
+            # metrics only go to Prometheus through the writer process
+            self.db_path = None
+            self.run_id = run_id
+            self.conn = None
+        self.flush_interval_s = flush_interval_s
+        self.flush_size = flush_size
+        self.max_buffered = max_buffered
+        self.pid = None
+        self._start_writer()
+
+    def _start_writer(self):
+        # after fork the parent's buffer, lock and thread are not usable
+        self.pid = os.getpid()
+        self.buffer = collections.deque()
+        self.buffer_lock = Lock()
+        self.flush_event = threading.Event()
+        self.stop_event = threading.Event()
+        self.dropped = 0
+        self.reported_dropped = 0
+        self.last_values = {}
+
+        self.writer = threading.Thread(target=self._run_writer, daemon=True)
+        self.writer.start()
+
+        atexit.register(self.close)
+        # multiprocessing children leave through os._exit, skipping atexit
+        multiprocessing.util.Finalize(self, self.close, exitpriority=10)
+
+    def _run_writer(self):
+        conn = sqlite3.connect(self.db_path) if self.db_path is not None else None
+        try:
+            while not self.stop_event.is_set():
+                self.flush_event.wait(self.flush_interval_s)
+                self.flush_event.clear()
+                self._flush(conn)
+            self._flush(conn)
+        finally:
+            if conn is not None:
+                conn.close()
+
+    def _flush(self, conn):
+        with self.buffer_lock:
+            records = list(self.buffer)
+            self.buffer.clear()
+            dropped = self.dropped
+
+        if dropped != self.reported_dropped:
+            records.append(
+                (
+                    "inc",
+                    "metrics_dropped",
+                    dropped - self.reported_dropped,
+                    None,
+                    get_timestamp(),
+                )
+            )
+            self.reported_dropped = dropped
+
+        if not records:
+            return
+
+        # the sink is picked here, so a writer started after import is used
+        writer_queue = MetricsCollectorFactory.writer_queue
+        if writer_queue is not None:
+            try:
+                writer_queue.put_nowait(records)
+            except queue.Full:
+                with self.buffer_lock:
+                    self.dropped += len(records)
+        elif conn is not None:
+            self._write_records(
+                conn, resolve_increments(records, self.last_values), self.run_id or ""
+            )
+
+    def _append(self, kind, name, value, tag):
+        if self.pid != os.getpid():
+            self._start_writer()
+
+        with self.buffer_lock:
+            if len(self.buffer) >= self.max_buffered:
+                self.dropped += 1
+                return
+            self.buffer.append((kind, name, value, tag, get_timestamp()))
+            buffered = len(self.buffer)
+
+        if buffered >= self.flush_size:
+            self.flush_event.set()
+
+    def add_metric(self, name, value, tag=None):
+        self._append("set", name, value, tag)
+
+    def increment_metric(self, name, inc_value, tag=None):
+        # increments stay deltas until written, so every process adds
+        # to the same cumulative value
+        self._append("inc", name, inc_value, tag)
+
+    def close(self):
+        if self.pid != os.getpid() or self.stop_event.is_set():
+            return
+        self.stop_event.set()
+        self.flush_event.set()
+        self.writer.join()
+
+
+def run_metrics_writer(
+    writer_queue,
+    db_path,
+    flush_interval_s,
+    prometheus_settings=None,
+    percentile_interval_s=10.0,
+    segment_settings=None,
+    run_id="",
+    retention_settings=None,
+):
+    # the parent stops the writer after its own cleanup, keep draining till then
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    registry = None
+    if prometheus_settings is not None:
+        registry = prometheus.PrometheusRegistry()
+        prometheus.serve(
+            registry,
+            prometheus_settings.get("host", "127.0.0.1"),
+            prometheus_settings["port"],
+        )
+
+    segments = None
+    if segment_settings is not None:
+        segments = segment_store.SegmentWriter(
+            segment_settings["dir"],
+            segment_settings.get("segment_records", 1 << 20),
+            run_id or "",
+        )
+
+    conn = sqlite3.connect(db_path) if db_path is not None else None
+    compactor = None
+    if conn is not None and retention_settings is not None:
+        compactor = MetricsCompactor(**retention_settings)
+
+    last_values = {}
+    latencies = LatencySnapshots(percentile_interval_s)
+    stopped = False
+    try:
+        while not stopped:
+            records = []
+            deadline = time.monotonic() + flush_interval_s
+            while True:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch = writer_queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if batch is None:
+                    stopped = True
+                    break
+                records.extend(batch)
+
+            resolved = []
+            if records:
+                # batches from different processes interleave within a window
+                records.sort(key=lambda record: record[4])
+                resolved = resolve_increments(records, last_values, with_backlog=True)
+                latencies.record(resolved)
+            resolved += latencies.snapshot(force=stopped)
+
+            if resolved:
+                if registry is not None:
+                    for name, value, tag, _ in resolved:
+                        registry.add_metric(name, value, tag)
+                if segments is not None:
+                    segments.append(resolved)
+                if conn is not None:
+                    MetricsCollector._write_records(conn, resolved, run_id)
+
+            # compaction shares the connection, so it never competes for the lock
+            if compactor is not None and not stopped:
+                compactor.step(conn)
+    finally:
+        if segments is not None:
+            segments.close()
+        if conn is not None:
+            conn.close()
+
 
 class MetricsCollectorFactory:
     db_path = None
     disable_metrics = True
+    buffer_settings = {}
+    writer_settings = {}
+    prometheus_settings = None
+    segment_settings = None
+    retention_settings = None
+    run_id = None
+    instance = None
+    writer = None
+    writer_queue = None
 
     def __init__(self, db_path=None):
         settings = get_settings()
@@ -163,6 +860,41 @@ class MetricsCollectorFactory:
             cls.db_path = db_path
             cls.disable_metrics = False
 
+        cls.buffer_settings = settings.get("metrics_buffer", {})
+        cls.writer_settings = settings.get("metrics_writer", {})
+        cls.retention_settings = settings.get("metrics_retention")
+        # worker processes are forked after import and share the run id
+        cls.run_id = settings.get("metrics_run_id") or create_run_id()
+
+        backends = settings.get("metrics_backend", "sqlite")
+        if backends == "both":
+            backends = ["sqlite", "prometheus"]
+        if isinstance(backends, str):
+            backends = [backends]
+        for backend in backends:
+            if backend not in METRICS_BACKENDS:
+                raise Exception(f"Unknown metrics backend '{backend}'")
+
+        if "prometheus" in backends:
+            cls.prometheus_settings = settings.get("prometheus", {})
+            # no default, the well-known exporter ports belong to other exporters
+            if "port" not in cls.prometheus_settings:
+                raise Exception("Prometheus metrics backend requires prometheus.port")
+            cls.disable_metrics = False
+        if "segments" in backends:
+            cls.segment_settings = dict(settings.get("metrics_segments", {}))
+            if "dir" not in cls.segment_settings:
+                if "metrics_dir" not in settings:
+                    raise Exception("Segments metrics backend requires metrics_dir")
+                cls.segment_settings["dir"] = settings["metrics_dir"] + "/segments"
+            cls.disable_metrics = False
+        if "sqlite" not in backends:
+            cls.db_path = None
+
+    @classmethod
+    def requires_writer(cls):
+        return cls.prometheus_settings is not None or cls.segment_settings is not None
+
     @classmethod
     def get_instance(cls, db_path=None):
         if db_path is not None:
@@ -170,8 +902,61 @@ class MetricsCollectorFactory:
 
         if cls.disable_metrics:
             return MetricsCollectorStub()
-        else:
-            return MetricsCollector(cls.db_path)
+
+        if cls.buffer_settings is False and not cls.requires_writer():
+            return MetricsCollector(cls.db_path, cls.run_id)
+
+        # one buffer and writer thread per process, shared by all modules
+        if cls.instance is None:
+            cls.instance = BufferedMetricsCollector(
+                cls.db_path, run_id=cls.run_id, **(cls.buffer_settings or {})
+            )
+        return cls.instance
+
+    @classmethod
+    def start_writer(cls):
+        if cls.disable_metrics or cls.writer is not None:
+            return
+        # the registry and segments live in the writer, where every process reports
+        if cls.writer_settings is False and cls.requires_writer():
+            raise Exception("Metrics backends besides sqlite require the metrics writer")
+        if cls.writer_settings is False:
+            return
+        if cls.buffer_settings is False and not cls.requires_writer():
+            return
+
+        cls.writer_queue = multiprocessing.Queue(
+            cls.writer_settings.get("max_queued_batches", 1024)
+        )
+        cls.writer = multiprocessing.Process(
+            target=run_metrics_writer,
+            args=(
+                cls.writer_queue,
+                cls.db_path,
+                cls.writer_settings.get("flush_interval_s", 1.0),
+                cls.prometheus_settings,
+                cls.writer_settings.get("percentile_interval_s", 10.0),
+                cls.segment_settings,
+                cls.run_id,
+                cls.retention_settings,
+            ),
+            daemon=True,
+        )
+        cls.writer.start()
+
+    @classmethod
+    def stop_writer(cls):
+        if cls.writer is None:
+            return
+
+        if cls.instance is not None:
+            cls.instance.close()
+
+        cls.writer_queue.put(None)
+        cls.writer.join()
+        cls.writer_queue.close()
+        cls.writer = None
+        cls.writer_queue = None
 
 
 MetricsCollectorFactory.initialize()
@@ -179,3 +964,11 @@ MetricsCollectorFactory.initialize()
 
 def get_metrics_collector(db_path=None):
     return MetricsCollectorFactory.get_instance(db_path)
+
+
+def start_metrics_writer():
+    MetricsCollectorFactory.start_writer()
+
+
+def stop_metrics_writer():
+    MetricsCollectorFactory.stop_writer()
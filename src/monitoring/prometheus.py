@@ -0,0 +1,307 @@
+import bisect
+import http.server
+import logging
+import re
+import threading
+import typing
+
+
+logger = logging.getLogger(__name__)
+
+
+PREFIX = "anonymizepg_"
+
+DEFAULT_BUCKETS = (
+    0.001,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+)
+
+# collector metric name -> (type, exposed name, help)
+METRIC_TYPES = {
+    "total_selected_ctids": (
+        "counter",
+        "rows_selected_total",
+        "Rows selected from the source table",
+    ),
+    "total_converted": (
+        "counter",
+        "rows_converted_total",
+        "Rows produced by the transformer",
+    ),
+    "total_mark_processed": (
+        "counter",
+        "rows_processed_total",
+        "Source rows marked as processed",
+    ),
+    "total_deleted": (
+        "counter",
+        "rows_deleted_total",
+        "Replicated rows deleted from the transfer table",
+    ),
+    "total_reconnects": ("counter", "reconnects_total", "Reconnects after lost connections"),
+    "metrics_dropped": ("counter", "metrics_dropped_total", "Dropped metric records"),
+    # transfer_backlog is derived by the metrics writer from the processed and
+    # deleted counters on every point; the _rows and _bytes gauges are measured
+    # on the source by the transformer, only with backpressure in that unit
+    "transfer_backlog": (
+        "gauge",
+        "transfer_backlog",
+        "Rows in the transfer table, derived from the processed and deleted rows",
+    ),
+    "transfer_backlog_rows": (
+        "gauge",
+        "transfer_backlog_rows",
+        "Rows in the transfer table, measured for backpressure",
+    ),
+    "transfer_backlog_bytes": (
+        "gauge",
+        "transfer_backlog_bytes",
+        "Size of the transfer table, measured for backpressure",
+    ),
+    "total_cnt": ("gauge", "replicated_rows", "Rows replicated to a destination"),
+    "eta_s": ("gauge", "eta_seconds", "Estimated time until the source is processed"),
+    "replication_slot_active": (
+        "gauge",
+        "replication_slot_active",
+        "Whether all slots of a destination have a walsender",
+    ),
+    "replication_confirmed_lag_bytes": (
+        "gauge",
+        "replication_confirmed_lag_bytes",
+        "WAL between the current LSN and the slot confirmed flush LSN",
+    ),
+    "replication_write_lag_bytes": (
+        "gauge",
+        "replication_write_lag_bytes",
+        "WAL between the current LSN and the subscriber write LSN",
+    ),
+    "replication_flush_lag_bytes": (
+        "gauge",
+        "replication_flush_lag_bytes",
+        "WAL between the current LSN and the subscriber flush LSN",
+    ),
+    "replication_replay_lag_bytes": (
+        "gauge",
+        "replication_replay_lag_bytes",
+        "WAL between the current LSN and the subscriber replay LSN",
+    ),
+    "replication_write_lag_s": (
+        "gauge",
+        "replication_write_lag_seconds",
+        "Write lag reported by the walsender",
+    ),
+    "replication_flush_lag_s": (
+        "gauge",
+        "replication_flush_lag_seconds",
+        "Flush lag reported by the walsender",
+    ),
+    "replication_replay_lag_s": (
+        "gauge",
+        "replication_replay_lag_seconds",
+        "Replay lag reported by the walsender",
+    ),
+    "batch_time_execution_s": (
+        "histogram",
+        "batch_duration_seconds",
+        "Duration of one batch",
+    ),
+    "stage_time_s": ("histogram", "stage_duration_seconds", "Duration of a batch stage"),
+    "dst_query_time_s": (
+        "histogram",
+        "dst_query_duration_seconds",
+        "Duration of a destination query",
+    ),
+    "backpressure_pause_s": (
+        "histogram",
+        "backpressure_pause_seconds",
+        "Duration of a backpressure pause",
+    ),
+}
+
+
+def get_labels(tag: typing.Optional[str]):
+    if tag is None:
+        return ()
+    if "=" in tag:
+        key, value = tag.split("=", 1)
+        return ((re.sub(r"[^a-zA-Z0-9_]", "_", key), value),)
+    return (("tag", tag),)
+
+
+def escape_label_value(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(labels, extra=()):
+    labels = tuple(labels) + tuple(extra)
+    if not labels:
+        return ""
+    pairs = [f'{key}="{escape_label_value(value)}"' for key, value in labels]
+    return "{" + ",".join(pairs) + "}"
+
+
+class Counter:
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, value: float = 1, labels=()):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + value
+
+    def set_total(self, value: float, labels=()):
+        # the metrics writer already keeps cumulative values
+        with self.lock:
+            self.values[labels] = max(self.values.get(labels, 0), value)
+
+    def expose(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            for labels, value in self.values.items():
+                lines.append(f"{self.name}{format_labels(labels)} {value}")
+        return lines
+
+
+class Gauge:
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def set(self, value: float, labels=()):
+        with self.lock:
+            self.values[labels] = value
+
+    def expose(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge"]
+        with self.lock:
+            for labels, value in self.values.items():
+                lines.append(f"{self.name}{format_labels(labels)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value: float, labels=()):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            state = self.values.get(labels)
+            if state is None:
+                state = [[0] * (len(self.buckets) + 1), 0, 0.0]
+                self.values[labels] = state
+            state[0][index] += 1
+            state[1] += 1
+            state[2] += value
+
+    def expose(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            for labels, (counts, count, total) in self.values.items():
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets + ("+Inf",), counts):
+                    cumulative += bucket_count
+                    bucket_labels = format_labels(labels, (("le", bound),))
+                    lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+                lines.append(f"{self.name}_count{format_labels(labels)} {count}")
+                lines.append(f"{self.name}_sum{format_labels(labels)} {total}")
+        return lines
+
+
+class PrometheusRegistry:
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def _get_metric(self, name: str, default_type: str):
+        metric = self.metrics.get(name)
+        if metric is not None:
+            return metric
+
+        metric_type, exposed_name, help = METRIC_TYPES.get(
+            name, (default_type, re.sub(r"[^a-zA-Z0-9_]", "_", name), name)
+        )
+        with self.lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric_class = {"counter": Counter, "gauge": Gauge}.get(
+                    metric_type, Histogram
+                )
+                metric = metric_class(PREFIX + exposed_name, help)
+                self.metrics[name] = metric
+        return metric
+
+    def add_metric(self, name, value, tag=None):
+        metric = self._get_metric(name, "gauge")
+        labels = get_labels(tag)
+        if isinstance(metric, Histogram):
+            metric.observe(value, labels)
+        elif isinstance(metric, Counter):
+            metric.set_total(value, labels)
+        else:
+            metric.set(value, labels)
+
+    def increment_metric(self, name, inc_value, tag=None):
+        metric = self._get_metric(name, "counter")
+        if isinstance(metric, Counter):
+            metric.inc(inc_value, get_labels(tag))
+        else:
+            self.add_metric(name, inc_value, tag)
+
+    def add_metrics_array(self, name, values, tags):
+        for value, tag in zip(values, tags):
+            self.add_metric(name, value, tag)
+
+    def increment_metrics_array(self, name, increment_values, tags):
+        for inc_value, tag in zip(increment_values, tags):
+            self.increment_metric(name, inc_value, tag)
+
+    def expose(self):
+        lines = []
+        for metric in list(self.metrics.values()):
+            lines += metric.expose()
+        return "\n".join(lines) + "\n"
+
+
+def serve(registry: PrometheusRegistry, host: str, port: int):
+    class MetricsHandler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] not in ("/metrics", "/"):
+                self.send_error(404)
+                return
+
+            body = registry.expose().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logger.debug(format % args)
+
+    server = http.server.ThreadingHTTPServer((host, port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    logger.info(f"Serving Prometheus metrics on http://{host}:{port}/metrics")
+    return server
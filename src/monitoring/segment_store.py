@@ -0,0 +1,311 @@
+import calendar
+import json
+import mmap
+import os
+import pathlib
+import struct
+import threading
+import time
+import typing
+
+
+MAGIC = b"APGS"
+VERSION = 1
+HEADER_FORMAT = "<4sIIQQ"
+HEADER_SIZE = 64
+COUNT_OFFSET = struct.calcsize("<4sIIQ")
+RECORD_FORMAT = "<qdii"
+RECORD_SIZE = struct.calcsize(RECORD_FORMAT)
+CATALOG_NAME = "series.json"
+
+
+def get_record_dtype():
+    import numpy as np
+
+    return np.dtype(
+        [("timestamp", "<i8"), ("value", "<f8"), ("series", "<i4"), ("pad", "<i4")]
+    )
+
+
+def get_segment_name(number: int):
+    return f"segment_{number:06d}.bin"
+
+
+def parse_timestamp_ns(timestamp: str, epochs: dict):
+    second = timestamp[:19]
+    epoch = epochs.get(second)
+    if epoch is None:
+        epoch = calendar.timegm(time.strptime(second, "%Y-%m-%d %H:%M:%S"))
+        epochs[second] = epoch
+    fraction = timestamp[20:23] if len(timestamp) > 20 else "0"
+    return epoch * 1_000_000_000 + int(fraction.ljust(3, "0")) * 1_000_000
+
+
+class SeriesCatalog:
+    def __init__(self, path: pathlib.Path):
+        self.path = path
+        self.series = []
+        self.ids = {}
+        self.mtime = None
+        self.load()
+
+    def load(self):
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            return
+        if mtime == self.mtime:
+            return
+
+        # series are (name, tag, run_id), catalogs of older stores have no run
+        with open(self.path, "r") as f:
+            self.series = [
+                (series[0], series[1], series[2] if len(series) > 2 else "")
+                for series in json.load(f)
+            ]
+        self.ids = {series: number for number, series in enumerate(self.series)}
+        self.mtime = mtime
+
+    def get_ids(
+        self, name: str, tag: typing.Optional[str], run_id: typing.Optional[str]
+    ):
+        if run_id is not None:
+            series_id = self.ids.get((name, tag, run_id))
+            return [] if series_id is None else [series_id]
+        return [
+            number
+            for number, series in enumerate(self.series)
+            if series[:2] == (name, tag)
+        ]
+
+    def get_runs(self):
+        # in the order the runs first wrote a series
+        return list(dict.fromkeys(series[2] for series in self.series))
+
+    def intern(self, name: str, tag: typing.Optional[str], run_id: str = ""):
+        series_id = self.ids.get((name, tag, run_id))
+        if series_id is not None:
+            return series_id
+
+        series_id = len(self.series)
+        self.series.append((name, tag, run_id))
+        self.ids[(name, tag, run_id)] = series_id
+
+        # readers must never see a record whose series is not in the catalog
+        tmp_path = self.path.with_name(self.path.name + ".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(self.series, f)
+        os.replace(tmp_path, self.path)
+        return series_id
+
+
+class SegmentWriter:
+    def __init__(
+        self, store_dir: str, segment_records: int = 1 << 20, run_id: str = ""
+    ):
+        self.path = pathlib.Path(store_dir)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.segment_records = segment_records
+        self.run_id = run_id
+        self.catalog = SeriesCatalog(self.path / CATALOG_NAME)
+        self.epochs = {}
+
+        self.file = None
+        self.mm = None
+        self.count = 0
+        self.capacity = 0
+
+        numbers = sorted(
+            int(segment.stem.split("_")[1]) for segment in self.path.glob("segment_*.bin")
+        )
+        self.number = numbers[-1] if numbers else 0
+        self._open_segment(self.number)
+
+    def _open_segment(self, number: int):
+        self.close()
+        self.number = number
+        segment_path = self.path / get_segment_name(number)
+
+        if not segment_path.exists():
+            # readers pick segments up by name, so one appears only complete
+            tmp_path = segment_path.with_name(segment_path.name + ".tmp")
+            with open(tmp_path, "wb") as f:
+                f.write(
+                    struct.pack(
+                        HEADER_FORMAT, MAGIC, VERSION, RECORD_SIZE, self.segment_records, 0
+                    ).ljust(HEADER_SIZE, b"\0")
+                )
+                f.truncate(HEADER_SIZE + self.segment_records * RECORD_SIZE)
+            os.replace(tmp_path, segment_path)
+
+        self.file = open(segment_path, "r+b")
+        self.mm = mmap.mmap(self.file.fileno(), 0)
+        magic, version, record_size, self.capacity, self.count = struct.unpack_from(
+            HEADER_FORMAT, self.mm
+        )
+        if magic != MAGIC or version != VERSION or record_size != RECORD_SIZE:
+            raise Exception(f"'{segment_path}' is not a metrics segment")
+
+    def append(self, records):
+        # records are (name, value, tag, timestamp) as written to sqlite
+        for name, value, tag, timestamp in records:
+            if self.count == self.capacity:
+                self._open_segment(self.number + 1)
+
+            struct.pack_into(
+                RECORD_FORMAT,
+                self.mm,
+                HEADER_SIZE + self.count * RECORD_SIZE,
+                parse_timestamp_ns(timestamp, self.epochs),
+                value,
+                self.catalog.intern(name, tag, self.run_id),
+                0,
+            )
+            self.count += 1
+            # the count is published after the record, readers stop at it
+            struct.pack_into("<Q", self.mm, COUNT_OFFSET, self.count)
+
+    def close(self):
+        if self.mm is not None:
+            self.mm.flush()
+            self.mm.close()
+            self.file.close()
+            self.mm = None
+            self.file = None
+
+
+class SegmentReader:
+    def __init__(self, store_dir: str, run_id: typing.Optional[str] = None):
+        # run_id scopes the reads like in MetricsCollector, None reads all runs
+        self.path = pathlib.Path(store_dir)
+        self.run_id = run_id
+        self.catalog = SeriesCatalog(self.path / CATALOG_NAME)
+        self.segments = {}
+        self.sealed_positions = {}
+        self.lock = threading.Lock()
+
+    def _get_segment(self, segment_path: pathlib.Path):
+        import numpy as np
+
+        segment = self.segments.get(segment_path.name)
+        if segment is None:
+            with open(segment_path, "rb") as f:
+                _, _, _, capacity, _ = struct.unpack(
+                    HEADER_FORMAT, f.read(struct.calcsize(HEADER_FORMAT))
+                )
+            records = np.memmap(
+                segment_path,
+                dtype=get_record_dtype(),
+                mode="r",
+                offset=HEADER_SIZE,
+                shape=(capacity,),
+            )
+            segment = (records, capacity)
+            self.segments[segment_path.name] = segment
+        return segment
+
+    def _get_count(self, segment_path: pathlib.Path):
+        with open(segment_path, "rb") as f:
+            f.seek(COUNT_OFFSET)
+            return struct.unpack("<Q", f.read(8))[0]
+
+    def iter_segments(self):
+        # zero-copy views of the written part of every segment
+        for segment_path in sorted(self.path.glob("segment_*.bin")):
+            records, capacity = self._get_segment(segment_path)
+            count = self._get_count(segment_path)
+            yield segment_path.name, records[:count], count == capacity
+
+    def get_series_tags(self):
+        with self.lock:
+            self.catalog.load()
+            return list(self.catalog.series)
+
+    def get_runs(self):
+        with self.lock:
+            self.catalog.load()
+            return self.catalog.get_runs()
+
+    def get_latest_run(self):
+        runs = self.get_runs()
+        return runs[-1] if runs else None
+
+    def get_hosts(self):
+        return sorted(
+            {
+                tag
+                for _, tag, run_id in self.get_series_tags()
+                if tag is not None
+                and tag[:5] == "host="
+                and (self.run_id is None or run_id == self.run_id)
+            }
+        )
+
+    def read_series(
+        self,
+        name: str,
+        tag: typing.Optional[str] = None,
+        start_ns: typing.Optional[int] = None,
+        end_ns: typing.Optional[int] = None,
+    ):
+        import numpy as np
+
+        with self.lock:
+            self.catalog.load()
+            series_ids = self.catalog.get_ids(name, tag, self.run_id)
+            if not series_ids:
+                return np.empty(0, dtype="datetime64[ns]"), np.empty(0)
+
+            parts = []
+            for segment_name, records, sealed in self.iter_segments():
+                key = (segment_name, tuple(series_ids))
+                positions = self.sealed_positions.get(key)
+                if positions is None:
+                    positions = np.flatnonzero(np.isin(records["series"], series_ids))
+                    # full segments never change, their positions are kept
+                    if sealed:
+                        self.sealed_positions[key] = positions
+                if len(positions) > 0:
+                    parts.append(records[positions])
+
+        if not parts:
+            return np.empty(0, dtype="datetime64[ns]"), np.empty(0)
+
+        selected = np.concatenate(parts)
+        if start_ns is not None or end_ns is not None:
+            mask = np.ones(len(selected), dtype=bool)
+            if start_ns is not None:
+                mask &= selected["timestamp"] >= start_ns
+            if end_ns is not None:
+                mask &= selected["timestamp"] < end_ns
+            selected = selected[mask]
+
+        return selected["timestamp"].astype("datetime64[ns]"), selected["value"]
+
+
+def export_to_sqlite(store_dir: str, db_path: str, chunk_records: int = 100000):
+    from src.monitoring.metrics import MetricsCollector
+
+    reader = SegmentReader(store_dir)
+    series = reader.get_series_tags()
+    collector = MetricsCollector(db_path)
+
+    for _, records, _ in reader.iter_segments():
+        for start in range(0, len(records), chunk_records):
+            chunk = records[start : start + chunk_records]
+            timestamps = (
+                chunk["timestamp"]
+                .astype("datetime64[ns]")
+                .astype("datetime64[ms]")
+                .astype(str)
+            )
+            runs = {}
+            for timestamp, value, series_id in zip(
+                timestamps, chunk["value"], chunk["series"]
+            ):
+                name, tag, run_id = series[series_id]
+                runs.setdefault(run_id, []).append(
+                    (name, float(value), tag, timestamp.replace("T", " "))
+                )
+            for run_id, records in runs.items():
+                collector._write_records(collector.conn, records, run_id)
@@ -0,0 +1,82 @@
+import threading
+import typing
+
+
+class CachedSeries:
+    def __init__(self, resolution):
+        self.resolution = resolution
+        self.positions = []
+        self.timestamps = []
+        self.values = []
+
+    def get_cursor(self):
+        return self.positions[-1] if self.positions else None
+
+    def append(self, position, timestamp, value):
+        self.positions.append(position)
+        self.timestamps.append(timestamp)
+        self.values.append(value)
+
+    def drop_from(self, position):
+        while self.positions and self.positions[-1] >= position:
+            self.positions.pop()
+            self.timestamps.pop()
+            self.values.pop()
+
+
+def _resolution_order(resolution):
+    return 0 if resolution is None else resolution
+
+
+class SeriesCache:
+    def __init__(self, max_points: int):
+        self.max_points = max_points
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def _choose_resolution(self, metrics, name, tags):
+        resolutions = [
+            metrics.choose_resolution(name, tag, max_points=self.max_points)
+            for tag in tags
+        ]
+        return max(resolutions, key=_resolution_order)
+
+    def get(self, metrics, name: str, tags: typing.List[typing.Optional[str]]):
+        with self.lock:
+            return self._update(metrics, name, tags)
+
+    def _update(self, metrics, name, tags):
+        resolution = self._choose_resolution(metrics, name, tags)
+
+        cached = {}
+        for tag in tags:
+            key = (metrics.run_id, name, tag)
+            series = self.series.get(key)
+            # a coarser resolution is picked once the run outgrows the budget
+            if series is None or series.resolution != resolution:
+                series = CachedSeries(resolution)
+                self.series[key] = series
+            cached[tag] = series
+
+        cursors = [series.get_cursor() for series in cached.values()]
+        after = None if None in cursors else min(cursors)
+
+        rows = metrics.get_metric_updates(name, tags, resolution, after)
+
+        if resolution is not None:
+            for series in cached.values():
+                cursor = series.get_cursor()
+                if cursor is not None:
+                    series.drop_from(cursor)
+
+        for tag, position, timestamp, value in rows:
+            series = cached[tag]
+            cursor = series.get_cursor()
+            if cursor is not None and position <= cursor:
+                continue
+            series.append(position, timestamp, value)
+
+        return {
+            tag: (list(series.timestamps), list(series.values))
+            for tag, series in cached.items()
+        }
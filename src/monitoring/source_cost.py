@@ -0,0 +1,207 @@
+import logging
+import psycopg2
+import re
+import typing
+
+from src.monitoring.metrics import get_metrics_collector
+from src.utils import db_connector
+
+
+logger = logging.getLogger(__name__)
+metrics = get_metrics_collector()
+
+
+COST_SOURCES = ("statements", "wal", "io")
+
+
+def get_identifier_regex(name: str):
+    # whole identifiers only, so a name never matches inside a longer one
+    return "\\m" + re.escape(name) + "\\M"
+
+
+def get_statements_query(server_version: int):
+    if server_version >= 170000:
+        io_time = (
+            "shared_blk_read_time + shared_blk_write_time"
+            " + local_blk_read_time + local_blk_write_time"
+        )
+    else:
+        io_time = "blk_read_time + blk_write_time"
+
+    # only the tool's own statements, recognised by the generated temp table
+    # and functions they mention, the snapshot query is normalised and never matches
+    return f"""
+    SELECT
+        COALESCE(SUM(calls), 0) AS calls,
+        COALESCE(SUM(total_exec_time), 0) AS exec_time_ms,
+        COALESCE(SUM({io_time}), 0) AS io_time_ms,
+        COALESCE(SUM(shared_blks_hit), 0) AS shared_blks_hit,
+        COALESCE(SUM(shared_blks_read), 0) AS shared_blks_read,
+        COALESCE(SUM(shared_blks_dirtied), 0) AS shared_blks_dirtied,
+        COALESCE(SUM(shared_blks_written), 0) AS shared_blks_written,
+        COALESCE(SUM(temp_blks_written), 0) AS temp_blks_written,
+        COALESCE(SUM(wal_records), 0) AS wal_records,
+        COALESCE(SUM(wal_fpi), 0) AS wal_fpi,
+        COALESCE(SUM(wal_bytes), 0) AS wal_bytes
+    FROM pg_stat_statements
+    WHERE dbid = (SELECT oid FROM pg_database WHERE datname = current_database())
+        AND userid = (SELECT oid FROM pg_roles WHERE rolname = current_user)
+        AND query ~ ANY(%s::text[])
+    """
+
+
+def get_wal_query():
+    # cluster wide, includes every other writer on the primary
+    return """
+    SELECT
+        wal_records AS records,
+        wal_fpi AS fpi,
+        wal_bytes AS bytes,
+        wal_buffers_full AS buffers_full
+    FROM pg_stat_wal
+    """
+
+
+def get_io_query(server_version: int):
+    if server_version >= 180000:
+        io_bytes = "SUM(read_bytes) AS read_bytes, SUM(write_bytes) AS write_bytes"
+    else:
+        io_bytes = (
+            "SUM(reads * op_bytes) AS read_bytes, SUM(writes * op_bytes) AS write_bytes"
+        )
+
+    # all client backends of the cluster, not only the tool's connection
+    return f"""
+    SELECT
+        SUM(reads) AS reads,
+        SUM(writes) AS writes,
+        SUM(extends) AS extends,
+        SUM(hits) AS hits,
+        SUM(evictions) AS evictions,
+        SUM(read_time) AS read_time_ms,
+        SUM(write_time) AS write_time_ms,
+        {io_bytes}
+    FROM pg_stat_io
+    WHERE backend_type = 'client backend'
+    """
+
+
+class SourceCostCollector:
+    def __init__(
+        self,
+        method: str,
+        every_batches: int = 10,
+        sources: typing.Sequence[str] = COST_SOURCES,
+    ):
+        for source in sources:
+            if source not in COST_SOURCES:
+                raise Exception(f"Unknown source cost statistics '{source}'")
+
+        self.tag = f"method={method}"
+        self.every_batches = every_batches
+        self.requested_sources = list(sources)
+        self.sources = []
+        self.last_snapshot = None
+        self.batches = 0
+
+    def _get_sources(self, conn):
+        version = conn.server_version
+        with conn.cursor() as cur:
+            cur.execute(
+                "SELECT COUNT(*) FROM pg_extension WHERE extname = 'pg_stat_statements'"
+            )
+            has_statements = cur.fetchone()[0] > 0
+        conn.commit()
+
+        required = {
+            "statements": (130000, has_statements, "the pg_stat_statements extension"),
+            "wal": (140000, True, None),
+            "io": (160000, True, None),
+        }
+
+        sources = []
+        for source in self.requested_sources:
+            min_version, available, requirement = required[source]
+            if version < min_version:
+                logger.warning(
+                    f"Source cost statistics '{source}' need PostgreSQL "
+                    f"{min_version // 10000} or later, skipping"
+                )
+            elif not available:
+                logger.warning(
+                    f"Source cost statistics '{source}' need {requirement}, skipping"
+                )
+            else:
+                sources.append(source)
+        return sources
+
+    def _take_snapshot(self, conn, patterns: typing.List[str]):
+        version = conn.server_version
+        queries = {
+            "statements": (
+                get_statements_query(version),
+                ([get_identifier_regex(pattern) for pattern in patterns],),
+            ),
+            "wal": (get_wal_query(), None),
+            "io": (get_io_query(version), None),
+        }
+
+        snapshot = {}
+        with conn.cursor() as cur:
+            for source in self.sources:
+                query, params = queries[source]
+                cur.execute(query, params)
+                row = cur.fetchone()
+                for column, value in zip(cur.description, row):
+                    snapshot[f"{source}_{column[0]}"] = float(value or 0)
+        # a new transaction sees fresh statistics at the next snapshot
+        conn.commit()
+        return snapshot
+
+    def _try_snapshot(self, conn, patterns: typing.List[str]):
+        try:
+            return self._take_snapshot(conn, patterns)
+        except psycopg2.Error as err:
+            if db_connector.is_connection_lost(conn):
+                raise
+            conn.rollback()
+            logger.warning(f"Source cost accounting disabled: {err}")
+            self.sources = []
+            return None
+
+    def start(self, conn, patterns: typing.List[str]):
+        self.sources = self._get_sources(conn)
+        self.batches = 0
+        self.last_snapshot = None
+        if self.sources:
+            self.last_snapshot = self._try_snapshot(conn, patterns)
+
+    def on_batch(self, conn, patterns: typing.List[str]):
+        if self.last_snapshot is None:
+            return
+
+        self.batches += 1
+        if self.batches < self.every_batches:
+            return
+
+        snapshot = self._try_snapshot(conn, patterns)
+        if snapshot is None:
+            self.last_snapshot = None
+            return
+
+        # counters only grow, evicted statements would show up as negative
+        deltas = {
+            name: max(value - self.last_snapshot.get(name, 0), 0) / self.batches
+            for name, value in snapshot.items()
+        }
+        if "statements_exec_time_ms" in deltas:
+            # an estimate, I/O time is only known with track_io_timing enabled
+            deltas["statements_cpu_time_ms"] = max(
+                deltas["statements_exec_time_ms"] - deltas["statements_io_time_ms"], 0
+            )
+
+        for name, value in deltas.items():
+            metrics.add_metric(f"source_{name}", value, self.tag)
+
+        self.last_snapshot = snapshot
+        self.batches = 0
@@ -0,0 +1,258 @@
+import logging
+import math
+import psycopg2
+import time
+import typing
+
+from src.transform.transformer import Transformer
+
+
+logger = logging.getLogger(__name__)
+
+
+class ThroughputModel:
+    def __init__(
+        self,
+        total_rows: typing.Optional[int],
+        sleep_ms: int = 0,
+        smoothing: float = 0.2,
+    ):
+        self.total_rows = total_rows
+        self.sleep_s = sleep_ms / 1000
+        self.smoothing = smoothing
+        self.processed_rows = 0
+        self.seconds_per_row = None
+
+    def observe(self, rows: int, seconds: float):
+        if rows <= 0:
+            return
+
+        self.processed_rows += rows
+        rate = seconds / rows
+        if self.seconds_per_row is None:
+            self.seconds_per_row = rate
+        else:
+            self.seconds_per_row += self.smoothing * (rate - self.seconds_per_row)
+
+    def get_remaining_rows(self):
+        if self.total_rows is None:
+            return None
+        return max(self.total_rows - self.processed_rows, 0)
+
+    def estimate_runtime_s(self, batch_size: int, rows: typing.Optional[int] = None):
+        if rows is None:
+            rows = self.get_remaining_rows()
+        if self.seconds_per_row is None or rows is None:
+            return None
+
+        batches = math.ceil(rows / batch_size)
+        return rows * self.seconds_per_row + batches * self.sleep_s
+
+
+def get_table_stats(cur, table: str):
+    cur.execute(
+        "SELECT reltuples::bigint, relpages FROM pg_class WHERE oid = %s::regclass",
+        (table,),
+    )
+    reltuples, relpages = cur.fetchone()
+
+    # counting would scan the whole table, without ANALYZE the size is unknown
+    if reltuples < 0:
+        logger.warning(f"Table '{table}' was never analyzed, row count is unknown")
+        reltuples = None
+
+    return reltuples, relpages
+
+
+def get_wal_lsn(cur):
+    cur.execute("SELECT (pg_current_wal_insert_lsn() - '0/0'::pg_lsn)::BIGINT")
+    return cur.fetchone()[0]
+
+
+def get_sample_names(src_table: str, transfer_table: str):
+    # own names, so a deployment prepared on the same database does not clash
+    return "_sample_" + src_table, "_sample_" + transfer_table.lstrip("_")
+
+
+def prepare_sample(
+    conn: psycopg2.extensions.connection,
+    transformer: Transformer,
+    src_table: str,
+    transfer_table: str,
+    processed_column: str,
+    id_column: str,
+    sample_rows: int,
+    total_rows: int,
+):
+    sample_table, sample_transfer_table = get_sample_names(src_table, transfer_table)
+    src_columns = [
+        column for column in transformer.column_types if column != processed_column
+    ]
+    columns_str = ", ".join(
+        [f"{column[0]} {column[1]}" for column in transformer.get_transfer_table_schema()]
+    )
+    # whole pages are read, a few more than needed so LIMIT gets enough rows
+    percent = min(100.0, 200.0 * sample_rows / max(total_rows, 1))
+
+    # the sample is a copy, the source is only read; plain tables rather than
+    # temporary ones, so the WAL of the sample batches is like the real one
+    with conn.cursor() as cur:
+        cur.execute(
+            f"CREATE TABLE {sample_table} AS SELECT {', '.join(src_columns)} "
+            f"FROM {src_table} TABLESAMPLE SYSTEM ({percent}) LIMIT {sample_rows};"
+        )
+        cur.execute(
+            f"ALTER TABLE {sample_table} ADD COLUMN {processed_column} BOOLEAN;"
+        )
+        cur.execute(
+            f"CREATE TABLE {sample_transfer_table} ({columns_str}, "
+            f"{id_column} BIGSERIAL PRIMARY KEY)"
+        )
+
+    transformer.src_table = sample_table
+    transformer.transfer_table = sample_transfer_table
+    transformer.prepare()
+    transformer.create_temp_table()
+    return sample_transfer_table
+
+
+def run_sample_batches(
+    conn: psycopg2.extensions.connection,
+    transformer: Transformer,
+    transfer_table: str,
+    sample_batches: int,
+    model: ThroughputModel,
+):
+    selected_rows = 0
+    converted_rows = 0
+
+    with conn.cursor() as cur:
+        start_lsn = get_wal_lsn(cur)
+
+    for number in range(sample_batches):
+        start_time = time.time()
+
+        selected = transformer.select_ctids()
+        if selected == 0:
+            break
+        converted = transformer.insert_into_transfer_table()
+        transformer.mark_processed()
+        transformer.truncate_stids_table()
+
+        elapsed_time = time.time() - start_time
+        model.observe(selected, elapsed_time)
+        logger.debug(f"Sample batch {number}: {selected} rows in {elapsed_time:.3f} s")
+
+        selected_rows += selected
+        converted_rows += converted
+
+    with conn.cursor() as cur:
+        wal_bytes = get_wal_lsn(cur) - start_lsn
+        cur.execute("SELECT pg_total_relation_size(%s::regclass)", (transfer_table,))
+        transfer_bytes = cur.fetchone()[0]
+
+    return selected_rows, converted_rows, wal_bytes, transfer_bytes
+
+
+def build_plan(
+    conn: psycopg2.extensions.connection,
+    transformer: Transformer,
+    src_table: str,
+    transfer_table: str,
+    processed_column: str,
+    id_column: str,
+    sample_batches: int,
+    backlog_high: typing.Optional[int] = None,
+    backlog_unit: str = "rows",
+):
+    with conn.cursor() as cur:
+        total_rows, total_pages = get_table_stats(cur, src_table)
+
+    plan = {
+        "total_rows": total_rows,
+        "total_pages": total_pages,
+        "sampled_rows": 0,
+        "rows_per_s": None,
+        "runtime_s": None,
+        "wal_bytes": None,
+        "transfer_rows": None,
+        "peak_transfer_bytes": None,
+    }
+    if sample_batches == 0:
+        return plan
+    if total_rows is None:
+        logger.warning(f"Run ANALYZE on '{src_table}' to sample it")
+        return plan
+
+    model = ThroughputModel(total_rows, transformer.sleep_ms)
+    tables = (transformer.src_table, transformer.transfer_table)
+
+    conn.autocommit = False
+    try:
+        sample_transfer_table = prepare_sample(
+            conn,
+            transformer,
+            src_table,
+            transfer_table,
+            processed_column,
+            id_column,
+            sample_batches * transformer.batch_size,
+            total_rows,
+        )
+        selected, converted, wal_bytes, transfer_bytes = run_sample_batches(
+            conn, transformer, sample_transfer_table, sample_batches, model
+        )
+    finally:
+        # everything above, including the sample tables, is discarded
+        conn.rollback()
+        conn.autocommit = True
+        transformer.src_table, transformer.transfer_table = tables
+
+    if selected == 0:
+        raise Exception(f"Table '{src_table}' has no rows to sample")
+
+    converted_ratio = converted / selected
+    bytes_per_row = transfer_bytes / converted if converted > 0 else 0
+
+    peak_transfer_bytes = total_rows * converted_ratio * bytes_per_row
+    if backlog_high is not None:
+        if backlog_unit == "bytes":
+            peak_transfer_bytes = min(peak_transfer_bytes, backlog_high)
+        else:
+            peak_transfer_bytes = min(peak_transfer_bytes, backlog_high * bytes_per_row)
+
+    plan.update(
+        {
+            "sampled_rows": selected,
+            "rows_per_s": 1 / model.seconds_per_row if model.seconds_per_row else None,
+            "runtime_s": model.estimate_runtime_s(transformer.batch_size, total_rows),
+            "wal_bytes": int(wal_bytes / selected * total_rows),
+            "transfer_rows": int(total_rows * converted_ratio),
+            "peak_transfer_bytes": int(peak_transfer_bytes),
+        }
+    )
+    return plan
+
+
+def _format_value(value, template: str, scale: typing.Optional[float] = None):
+    if value is None:
+        return "unknown"
+    return template.format(value / scale if scale is not None else value)
+
+
+def format_plan(plan: dict):
+    lines = [
+        f"Rows in source table:      {_format_value(plan['total_rows'], '{}')} "
+        f"({plan['total_pages']} pages)",
+        f"Rows sampled:              {plan['sampled_rows']}",
+        f"Throughput:                "
+        + _format_value(plan["rows_per_s"], "{:.0f} rows/s"),
+        f"Estimated runtime:         " + _format_value(plan["runtime_s"], "{:.0f} s"),
+        f"Estimated WAL volume:      "
+        + _format_value(plan["wal_bytes"], "{:.1f} MiB", 2**20),
+        f"Rows in transfer table:    "
+        + _format_value(plan["transfer_rows"], "{}"),
+        f"Peak transfer table size:  "
+        + _format_value(plan["peak_transfer_bytes"], "{:.1f} MiB", 2**20),
+    ]
+    return "\n".join(lines)
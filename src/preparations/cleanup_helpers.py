@@ -2,12 +2,25 @@ import logging
 import psycopg2
 import typing
 
+from src.preparations.replication_layout import ReplicationLayout
 from src.utils import db_connector
 
 
 logger = logging.getLogger(__name__)
 
 
+def drop_processed_column(
+    cur, src_table: str, proccesed_column: str, ifExistsClause: str
+):
+    cur.execute(f"DROP INDEX CONCURRENTLY {ifExistsClause} {proccesed_column};")
+    logger.info(f"Dropped index for column '{proccesed_column}'")
+
+    cur.execute(
+        f"ALTER TABLE {src_table} DROP COLUMN {ifExistsClause} {proccesed_column};"
+    )
+    logger.info(f"Dropped column '{proccesed_column}' from table '{src_table}'")
+
+
 def src_cleanup_script_helpers(
     conn: psycopg2.extensions.connection,
     src_table: str,
@@ -17,6 +30,7 @@ def src_cleanup_script_helpers(
     publication: typing.Optional[str],
     with_replication: bool,
     after_except: bool,
+    layout: typing.Optional[ReplicationLayout] = None,
 ):
     if after_except:
         conn.rollback()
@@ -29,20 +43,19 @@ def src_cleanup_script_helpers(
 
     ifExistsClause = "IF EXISTS" if after_except else ""
     try:
-        cur.execute(f"DROP INDEX CONCURRENTLY {ifExistsClause} {proccesed_column};")
-        logger.info(f"Dropped index for column '{proccesed_column}'")
-
-        cur.execute(
-            f"ALTER TABLE {src_table} DROP COLUMN {ifExistsClause} {proccesed_column};"
-        )
-        logger.info(f"Dropped column '{proccesed_column}' from table '{src_table}'")
+        drop_processed_column(cur, src_table, proccesed_column, ifExistsClause)
 
         if with_replication:
             if publication is None:
                 raise Exception("Publication is None, but mode is with replication")
 
-            cur.execute(f"DROP PUBLICATION {ifExistsClause} {publication}")
-            logger.info(f"Dropped publication '{publication}'")
+            publications = [publication]
+            if layout is not None:
+                publications = [name for name, _ in layout.get_publications()]
+
+            for publication_name in publications:
+                cur.execute(f"DROP PUBLICATION {ifExistsClause} {publication_name}")
+                logger.info(f"Dropped publication '{publication_name}'")
 
             cur.execute(f"DROP TABLE {ifExistsClause} {transfer_table} CASCADE;")
             logger.info(f"Dropped table '{transfer_table}'")
@@ -70,7 +83,12 @@ def dst_cleanup_script_helpers(
     id_column: str,
     subscription: str,
     after_except: bool,
+    layout: typing.Optional[ReplicationLayout] = None,
+    bulk_load: bool = False,
 ):
+    if layout is None:
+        layout = ReplicationLayout(None, subscription, len(conn.get_hosts()))
+
     if after_except:
         conn.rollback()
 
@@ -82,12 +100,20 @@ def dst_cleanup_script_helpers(
 
     ifExistsClause = "IF EXISTS" if after_except else ""
     try:
-        cur.execute(
-            f"DROP SUBSCRIPTION {ifExistsClause} {subscription};"
+        cur.execute_each(
+            [
+                [
+                    f"DROP SUBSCRIPTION {ifExistsClause} {sub};"
+                    for sub, _, _ in layout.get_destination_subscriptions(dst)
+                ]
+                for dst in range(layout.destinations_count)
+            ]
         )
         logger.info(f"Dropped subscription '{subscription}'")
 
-        cur.execute(f"DROP INDEX CONCURRENTLY {ifExistsClause} {id_column};")
+        # in bulk load mode the index may not have been built yet
+        indexIfExistsClause = "IF EXISTS" if bulk_load else ifExistsClause
+        cur.execute(f"DROP INDEX CONCURRENTLY {indexIfExistsClause} {id_column};")
         logger.info(f"Dropped index for column '{id_column}'")
 
         cur.execute(f"ALTER TABLE {transfer_table} DROP COLUMN {ifExistsClause} {id_column} CASCADE;")
@@ -117,7 +143,21 @@ def cleanup_script_helpers(
     subscription: typing.Optional[str],
     with_replication: bool,
     after_except: bool = False,
+    shard_key: typing.Optional[str] = None,
+    apply_workers: int = 1,
+    bulk_load: bool = False,
 ):
+    layout = None
+    if with_replication and dst_conn is not None:
+        layout = ReplicationLayout(
+            publication,
+            subscription,
+            len(dst_conn.get_hosts()),
+            shard_key,
+            id_column,
+            apply_workers,
+        )
+
     src_cleanup_script_helpers(
         src_conn,
         src_table,
@@ -127,6 +167,7 @@ def cleanup_script_helpers(
         publication,
         with_replication,
         after_except,
+        layout,
     )
 
     if with_replication:
@@ -141,4 +182,36 @@ def cleanup_script_helpers(
             id_column,
             subscription,
             after_except,
+            layout,
+            bulk_load,
+        )
+
+
+def direct_cleanup_script_helpers(
+    conn: psycopg2.extensions.connection,
+    src_table: str,
+    proccesed_column: str,
+    after_except: bool,
+):
+    if after_except:
+        conn.rollback()
+
+    logger.info(
+        f"Starting cleanup for direct delivery script helpers, after exception: {after_except}"
+    )
+    conn.autocommit = True
+    cur = conn.cursor()
+
+    ifExistsClause = "IF EXISTS" if after_except else ""
+    try:
+        drop_processed_column(cur, src_table, proccesed_column, ifExistsClause)
+
+        logger.info("Successfully completed cleanup for direct delivery script helpers")
+    except psycopg2.Error as err:
+        logger.error(
+            f"An error occurred while cleaning up direct delivery script helpers: {err}"
         )
+        raise
+
+    finally:
+        cur.close()
@@ -1,7 +1,9 @@
 import logging
 import psycopg2
+import re
 import typing
 
+from src.preparations.replication_layout import ReplicationLayout
 from src.utils import db_connector
 
 
@@ -31,6 +33,89 @@ def prepare_src_table(
         cur.close()
 
 
+def get_partition_name(transfer_table: str, partition_number: int):
+    return f"{transfer_table}_p{partition_number}"
+
+
+def get_partition_number(transfer_table: str, partition_name: str):
+    match = re.fullmatch(re.escape(transfer_table) + r"_p(\d+)", partition_name)
+    if match:
+        return int(match.group(1))
+    return None
+
+
+def create_transfer_partitions(
+    cur, transfer_table: str, partition_size: int, first: int, last: int
+):
+    for number in range(first, last + 1):
+        partition = get_partition_name(transfer_table, number)
+        cur.execute(
+            f"CREATE TABLE IF NOT EXISTS {partition} PARTITION OF {transfer_table} "
+            f"FOR VALUES FROM ({number * partition_size + 1}) "
+            f"TO ({(number + 1) * partition_size + 1});"
+        )
+    logger.debug(f"Partitions {first}..{last} of '{transfer_table}' are present")
+
+
+def get_partition_numbers(cur, transfer_table: str):
+    cur.execute(
+        """
+        SELECT c.relname FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = %s::regclass
+        """,
+        (transfer_table,),
+    )
+    numbers = [get_partition_number(transfer_table, row[0]) for row in cur.fetchall()]
+    return sorted([number for number in numbers if number is not None])
+
+
+def get_current_partition_number(
+    cur, transfer_table: str, id_column: str, partition_size: int
+):
+    cur.execute("SELECT pg_get_serial_sequence(%s, %s)", (transfer_table, id_column))
+    sequence = cur.fetchone()[0]
+    cur.execute(f"SELECT last_value FROM {sequence}")
+    return cur.fetchone()[0] // partition_size
+
+
+def create_upcoming_partitions(
+    conn: psycopg2.extensions.connection,
+    transfer_table: str,
+    id_column: str,
+    partition_size: int,
+    partitions_ahead: int,
+):
+    # the cleanup loop and the transformer both create partitions, the lock is
+    # held until the new partitions are committed so they never race on one
+    cur = conn.cursor()
+    try:
+        cur.execute("SELECT pg_advisory_lock(hashtext(%s))", (transfer_table,))
+        try:
+            current_number = get_current_partition_number(
+                cur, transfer_table, id_column, partition_size
+            )
+            numbers = get_partition_numbers(cur, transfer_table)
+            first = numbers[-1] + 1 if numbers else current_number
+            last = current_number + partitions_ahead
+            if first <= last:
+                create_transfer_partitions(
+                    cur, transfer_table, partition_size, first, last
+                )
+            conn.commit()
+        except psycopg2.Error:
+            if not conn.closed:
+                conn.rollback()
+            raise
+        finally:
+            # a lost session releases the lock by itself
+            if not conn.closed:
+                cur.execute("SELECT pg_advisory_unlock(hashtext(%s))", (transfer_table,))
+                conn.commit()
+    finally:
+        cur.close()
+
+
 def prepare_transfer_table(
     conn: psycopg2.extensions.connection,
     src_table: str,
@@ -39,6 +124,9 @@ def prepare_transfer_table(
     publication: typing.Optional[str],
     table_schema,
     with_replication: bool,
+    partition_size: typing.Optional[int] = None,
+    partitions_ahead: int = 4,
+    layout: typing.Optional[ReplicationLayout] = None,
 ):
     logger.info(f"Starting to prepare '{transfer_table}' based on '{src_table}'.")
     cur = conn.cursor()
@@ -46,21 +134,43 @@ def prepare_transfer_table(
     try:
         columns_str = ", ".join([f"{column[0]} {column[1]}" for column in table_schema])
 
-        cur.execute(
-            f"CREATE TABLE {transfer_table} ({columns_str}, {id_column} BIGSERIAL PRIMARY KEY)"
-        )
+        if partition_size is not None:
+            if not with_replication:
+                raise Exception("Partitioned transfer table requires replication mode")
+
+            cur.execute(
+                f"CREATE TABLE {transfer_table} ({columns_str}, {id_column} BIGSERIAL, "
+                f"PRIMARY KEY ({id_column})) PARTITION BY RANGE ({id_column})"
+            )
+            create_transfer_partitions(
+                cur, transfer_table, partition_size, 0, partitions_ahead
+            )
+        else:
+            cur.execute(
+                f"CREATE TABLE {transfer_table} ({columns_str}, {id_column} BIGSERIAL PRIMARY KEY)"
+            )
         logger.info(f"Created table '{transfer_table}'")
 
         if with_replication:
             if publication is None:
                 raise Exception("Publication is None, but mode is with replication")
 
-            cur.execute(
-                f"CREATE PUBLICATION {publication} FOR TABLE {transfer_table} WITH (publish = 'insert')"
-            )
-            logger.info(
-                f"Created publication '{publication}' for table '{transfer_table}'"
-            )
+            publication_options = "publish = 'insert'"
+            if partition_size is not None:
+                publication_options += ", publish_via_partition_root = true"
+
+            publications = [(publication, None)]
+            if layout is not None:
+                publications = layout.get_publications()
+
+            for publication_name, row_filter in publications:
+                where_clause = f" WHERE ({row_filter})" if row_filter else ""
+                cur.execute(
+                    f"CREATE PUBLICATION {publication_name} FOR TABLE {transfer_table}{where_clause} WITH ({publication_options})"
+                )
+                logger.info(
+                    f"Created publication '{publication_name}' for table '{transfer_table}'"
+                )
 
         logger.info(f"Successfully completed preparation of '{transfer_table}'")
     except psycopg2.Error as err:
@@ -71,11 +181,23 @@ def prepare_transfer_table(
         cur.close()
 
 
-def slot_name_generator():
-    i = 1
-    while True:
-        yield (f"transfer_slot_replica_{i}",)
-        i += 1
+def get_subscription_options(
+    slot: str, layout: ReplicationLayout, conn: psycopg2.extensions.connection
+):
+    options = f"slot_name = '{slot}'"
+    if layout.apply_workers > 1 and conn.server_version >= 160000:
+        options += ", streaming = parallel"
+    return options
+
+
+def create_dst_id_index(
+    dst_cur, transfer_table: str, id_column: str, concurrently: bool = False
+):
+    concurrentlyClause = "CONCURRENTLY" if concurrently else ""
+    dst_cur.execute(
+        f"CREATE INDEX {concurrentlyClause} IF NOT EXISTS {id_column} ON {transfer_table}({id_column});"
+    )
+    logger.info(f"Created index for column '{id_column}' on '{transfer_table}'")
 
 
 def prepare_dst_table(
@@ -86,7 +208,12 @@ def prepare_dst_table(
     publication: str,
     subscription: str,
     table_schema,
+    layout: typing.Optional[ReplicationLayout] = None,
+    bulk_load: bool = False,
 ):
+    if layout is None:
+        layout = ReplicationLayout(publication, subscription, len(dst_conn.get_hosts()))
+
     logger.info(f"Starting to prepare destination table '{transfer_table}'")
     dst_cur = dst_conn.cursor()
     try:
@@ -99,18 +226,23 @@ def prepare_dst_table(
 
         logger.info(f"Created table '{transfer_table}' in destination database")
 
-        dst_cur.execute(
-            f"CREATE INDEX IF NOT EXISTS {id_column} ON {transfer_table}({id_column});"
-        )
-        logger.info(f"Created index for column '{id_column}' on '{transfer_table}'")
+        if bulk_load:
+            logger.info(
+                f"Bulk load mode, index for column '{id_column}' will be built after catch-up"
+            )
+        else:
+            create_dst_id_index(dst_cur, transfer_table, id_column)
 
-        dst_cur.execute(
-            f"CREATE SUBSCRIPTION {subscription} CONNECTION '{src_conn_string}' PUBLICATION {publication} WITH (slot_name = %s);",
-            slot_name_generator(),
-        )
-        logger.info(
-            f"Created subscription '{subscription}' for publication '{publication}'"
+        dst_cur.execute_each(
+            [
+                [
+                    f"CREATE SUBSCRIPTION {sub} CONNECTION '{src_conn_string}' PUBLICATION {pub} WITH ({get_subscription_options(slot, layout, conn)});"
+                    for sub, pub, slot in layout.get_destination_subscriptions(dst)
+                ]
+                for dst, conn in enumerate(dst_conn.connections)
+            ]
         )
+        logger.info(f"Created subscriptions for publications {layout.get_publications()}")
 
         logger.info(
             f"Successfully completed preparation of destination table '{transfer_table}'"
@@ -123,6 +255,38 @@ def prepare_dst_table(
         dst_cur.close()
 
 
+def prepare_direct_dst_table(
+    dst_conn: db_connector.MultiClusterConnection,
+    dst_table: str,
+    table_schema,
+):
+    logger.info(f"Starting to prepare destination table '{dst_table}'")
+    dst_cur = dst_conn.cursor()
+    try:
+        columns_str = ", ".join([f"{column[0]} {column[1]}" for column in table_schema])
+
+        dst_cur.execute(f"CREATE TABLE IF NOT EXISTS {dst_table} ({columns_str});")
+        logger.info(f"Created table '{dst_table}' in destination database")
+    except psycopg2.Error as err:
+        logger.error(f"Failed to prepare destination table '{dst_table}': {err}")
+        raise
+
+    finally:
+        dst_cur.close()
+
+
+def prepare_direct_tables(
+    src_conn: psycopg2.extensions.connection,
+    dst_conn: db_connector.MultiClusterConnection,
+    src_table: str,
+    dst_table: str,
+    proccesed_column: str,
+    table_schema,
+):
+    prepare_src_table(src_conn, src_table, proccesed_column)
+    prepare_direct_dst_table(dst_conn, dst_table, table_schema)
+
+
 def prepare_all_tables(
     src_conn: psycopg2.extensions.connection,
     dst_conn: typing.Optional[db_connector.MultiClusterConnection],
@@ -135,7 +299,35 @@ def prepare_all_tables(
     subscription: typing.Optional[str],
     transfer_table_schema,
     with_replication: bool,
+    partition_size: typing.Optional[int] = None,
+    partitions_ahead: int = 4,
+    shard_key: typing.Optional[str] = None,
+    apply_workers: int = 1,
+    bulk_load: bool = False,
 ):
+    layout = None
+    if with_replication:
+        if dst_conn is None:
+            raise Exception("Dst_conn is None, but mode is with replication")
+        if src_conn_string is None:
+            raise Exception("Src_conn_string is None, but mode is with replication")
+        if publication is None:
+            raise Exception("Publication is None, but mode is with replication")
+        if subscription is None:
+            raise Exception("Subscription is None, but mode is with replication")
+
+        layout = ReplicationLayout(
+            publication,
+            subscription,
+            len(dst_conn.get_hosts()),
+            shard_key,
+            id_column,
+            apply_workers,
+        )
+        if layout.uses_row_filters() and src_conn.server_version < 150000:
+            raise Exception(
+                "Sharding and parallel apply require PostgreSQL 15 or later on source"
+            )
 
     prepare_src_table(src_conn, src_table, proccesed_column)
     prepare_transfer_table(
@@ -146,18 +338,12 @@ def prepare_all_tables(
         publication,
         transfer_table_schema,
         with_replication,
+        partition_size,
+        partitions_ahead,
+        layout,
     )
 
     if with_replication:
-        if dst_conn is None:
-            raise Exception("Dst_conn is None, but mode is with replication")
-        if src_conn_string is None:
-            raise Exception("Src_conn_string is None, but mode is with replication")
-        if publication is None:
-            raise Exception("Publication is None, but mode is with replication")
-        if subscription is None:
-            raise Exception("Subscription is None, but mode is with replication")
-
         prepare_dst_table(
             dst_conn,
             src_conn_string,
@@ -166,4 +352,6 @@ def prepare_all_tables(
             publication,
             subscription,
             transfer_table_schema,
+            layout,
+            bulk_load,
         )
@@ -0,0 +1,89 @@
+import typing
+
+from src.utils import utils
+
+
+def get_slot_name(replica_number: int, worker: typing.Optional[int] = None):
+    if worker is None:
+        return f"transfer_slot_replica_{replica_number}"
+    return f"transfer_slot_replica_{replica_number}_{worker}"
+
+
+class ReplicationLayout:
+    def __init__(
+        self,
+        publication: str,
+        subscription: str,
+        destinations_count: int,
+        shard_key: typing.Optional[str] = None,
+        id_column: typing.Optional[str] = None,
+        apply_workers: int = 1,
+    ):
+        if apply_workers > 1 and id_column is None:
+            raise Exception("Parallel apply requires the id column")
+
+        self.publication = publication
+        self.subscription = subscription
+        self.destinations_count = destinations_count
+        self.shard_key = shard_key
+        self.id_column = id_column
+        self.apply_workers = apply_workers
+
+    def uses_row_filters(self):
+        return self.shard_key is not None or self.apply_workers > 1
+
+    def get_shard_filter(self, shard: int):
+        shard_expr = utils.get_shard_expr(self.shard_key, self.destinations_count)
+        return f"{shard_expr} = {shard}"
+
+    def get_worker_filter(self, worker: int):
+        return f"{self.id_column} % {self.apply_workers} = {worker}"
+
+    def _get_publication(self, shard: typing.Optional[int], worker: int):
+        name = self.publication
+        filters = []
+        if shard is not None:
+            name += f"_shard_{shard}"
+            filters.append(self.get_shard_filter(shard))
+        if self.apply_workers > 1:
+            name += f"_part_{worker}"
+            filters.append(self.get_worker_filter(worker))
+
+        row_filter = " AND ".join([f"({f})" for f in filters]) if filters else None
+        return name, row_filter
+
+    def _get_shards(self):
+        if self.shard_key is None:
+            return [None]
+        return list(range(self.destinations_count))
+
+    def get_publications(self):
+        return [
+            self._get_publication(shard, worker)
+            for shard in self._get_shards()
+            for worker in range(self.apply_workers)
+        ]
+
+    def get_destination_subscriptions(self, destination: int):
+        shard = destination if self.shard_key is not None else None
+
+        if self.apply_workers == 1:
+            return [
+                (
+                    self.subscription,
+                    self._get_publication(shard, 0)[0],
+                    get_slot_name(destination + 1),
+                )
+            ]
+
+        return [
+            (
+                f"{self.subscription}_{worker}",
+                self._get_publication(shard, worker)[0],
+                get_slot_name(destination + 1, worker),
+            )
+            for worker in range(self.apply_workers)
+        ]
+
+    def get_destination_slots(self, destination: int):
+        return [slot for _, _, slot in self.get_destination_subscriptions(destination)]
@@ -1,8 +1,13 @@
+import collections
+import functools
 import logging
 import psycopg2
 import time
+import typing
 
 from src.monitoring.metrics import get_metrics_collector
+from src.preparations import preparations
+from src.preparations.replication_layout import ReplicationLayout
 from src.utils import db_connector
 
 
@@ -10,6 +15,272 @@ logger = logging.getLogger(__name__)
 metrics = get_metrics_collector()
 
 
+class SlotLsnTracker:
+    def __init__(self, slots_by_destination: typing.List[typing.List[str]]):
+        self.slots_by_destination = slots_by_destination
+        self.slot_names = [slot for slots in slots_by_destination for slot in slots]
+        self.samples = collections.deque()
+        self.last_max_id = None
+
+    def sample(self, src_cur, transfer_table: str, id_column: str):
+        src_cur.execute(
+            f"""
+            SELECT MAX({id_column}),
+                (pg_current_wal_insert_lsn() - '0/0'::pg_lsn)::BIGINT
+            FROM {transfer_table}
+            """
+        )
+        max_id, lsn = src_cur.fetchone()
+        self.last_max_id = max_id
+        if max_id is not None:
+            self.samples.append((lsn, max_id))
+        return max_id
+
+    def get_confirmed_lsns(self, src_cur):
+        src_cur.execute(
+            """
+            SELECT slot_name, (confirmed_flush_lsn - '0/0'::pg_lsn)::BIGINT
+            FROM pg_replication_slots WHERE slot_name = ANY(%s)
+            """,
+            (self.slot_names,),
+        )
+        confirmed = dict(src_cur.fetchall())
+
+        destination_lsns = []
+        for slots in self.slots_by_destination:
+            lsns = [confirmed.get(slot_name) for slot_name in slots]
+            if any([lsn is None for lsn in lsns]):
+                destination_lsns.append(None)
+            else:
+                destination_lsns.append(min(lsns))
+        return destination_lsns
+
+    def replicated_id(self, confirmed_lsn: typing.Optional[int]):
+        if confirmed_lsn is None:
+            return None
+
+        replicated = None
+        for lsn, max_id in self.samples:
+            if lsn > confirmed_lsn:
+                break
+            replicated = max_id
+        return replicated
+
+    def forget_until(self, confirmed_lsn: int):
+        while len(self.samples) > 1 and self.samples[1][0] <= confirmed_lsn:
+            self.samples.popleft()
+
+
+LAG_COLUMNS = (
+    "replication_slot_active",
+    "replication_confirmed_lag_bytes",
+    "replication_write_lag_bytes",
+    "replication_flush_lag_bytes",
+    "replication_replay_lag_bytes",
+    "replication_write_lag_s",
+    "replication_flush_lag_s",
+    "replication_replay_lag_s",
+)
+
+
+def get_replication_lag(src_cur, slots_by_destination: typing.List[typing.List[str]]):
+    src_cur.execute(
+        """
+        SELECT s.slot_name, s.active::INT,
+            (pg_current_wal_lsn() - s.confirmed_flush_lsn)::BIGINT,
+            (pg_current_wal_lsn() - r.write_lsn)::BIGINT,
+            (pg_current_wal_lsn() - r.flush_lsn)::BIGINT,
+            (pg_current_wal_lsn() - r.replay_lsn)::BIGINT,
+            EXTRACT(EPOCH FROM r.write_lag)::FLOAT,
+            EXTRACT(EPOCH FROM r.flush_lag)::FLOAT,
+            EXTRACT(EPOCH FROM r.replay_lag)::FLOAT,
+            r.pid IS NOT NULL
+        FROM pg_replication_slots s
+        LEFT JOIN pg_stat_replication r ON r.pid = s.active_pid
+        WHERE s.slot_name = ANY(%s)
+        """,
+        ([slot for slots in slots_by_destination for slot in slots],),
+    )
+
+    lags = {}
+    for slot_name, *values, has_sender in src_cur.fetchall():
+        # the walsender resets the lag times once the subscriber caught up
+        if has_sender:
+            values[-3:] = [lag if lag is not None else 0.0 for lag in values[-3:]]
+        lags[slot_name] = values
+
+    # a destination is as far behind as its slowest apply worker
+    # and is active only while all of its slots are
+    destination_lags = []
+    for slots in slots_by_destination:
+        slot_lags = [lags[slot] for slot in slots if slot in lags]
+        if not slot_lags:
+            destination_lags.append([None] * len(LAG_COLUMNS))
+            continue
+        destination_lags.append(
+            [
+                (min if number == 0 else max)(
+                    [lag for lag in column if lag is not None], default=None
+                )
+                for number, column in enumerate(zip(*slot_lags))
+            ]
+        )
+    return destination_lags
+
+
+def record_replication_lag(
+    src_cur,
+    dst_conn: db_connector.MultiClusterConnection,
+    slots_by_destination: typing.List[typing.List[str]],
+):
+    hosts = dst_conn.get_hosts()
+    try:
+        destination_lags = get_replication_lag(src_cur, slots_by_destination)
+    except psycopg2.Error as err:
+        # lag is only monitoring, cleanup goes on without it
+        if db_connector.is_connection_lost(src_cur.connection):
+            raise
+        src_cur.connection.rollback()
+        logger.warning(f"Failed to read replication lag: {err}")
+        return
+    for column, name in enumerate(LAG_COLUMNS):
+        values = [lags[column] for lags in destination_lags]
+        metrics.add_metrics_array(
+            name,
+            [value for value in values if value is not None],
+            [host for host, value in zip(hosts, values) if value is not None],
+        )
+
+
+def get_max_id_query(transfer_table: str, id_column: str, apply_workers: int):
+    if apply_workers == 1:
+        return f"SELECT MAX({id_column}) FROM {transfer_table}"
+
+    # parts are applied independently, so only the slowest part is safe
+    return f"""
+        SELECT CASE WHEN bool_or(part_max IS NULL) THEN NULL ELSE MIN(part_max) END
+        FROM (
+            SELECT (
+                SELECT MAX({id_column}) FROM {transfer_table}
+                WHERE {id_column} % {apply_workers} = part
+            ) AS part_max
+            FROM generate_series(0, {apply_workers - 1}) part
+        ) parts
+    """
+
+
+def get_replicated_id_by_destinations(
+    dst_conn: db_connector.MultiClusterConnection,
+    transfer_table: str,
+    id_column: str,
+    apply_workers: int = 1,
+):
+    dst_cur = dst_conn.cursor()
+    try:
+        dst_cur.execute(get_max_id_query(transfer_table, id_column, apply_workers))
+        rpl_cnts = dst_cur.fetchone()
+        timings = dst_cur.timings
+    finally:
+        dst_cur.close()
+
+    hosts = dst_conn.get_hosts()
+    metrics_array = [cnt[0] if cnt[0] is not None else 0 for cnt in rpl_cnts]
+    metrics.add_metrics_array("total_cnt", metrics_array, hosts)
+    metrics.add_metrics_array("dst_query_time_s", timings, hosts)
+
+    if all([cnt[0] is not None for cnt in rpl_cnts]):
+        return min([cnt[0] for cnt in rpl_cnts])
+    return None
+
+
+def get_replicated_id_by_slots(
+    src_cur,
+    dst_conn: db_connector.MultiClusterConnection,
+    tracker: SlotLsnTracker,
+    transfer_table: str,
+    id_column: str,
+):
+    tracker.sample(src_cur, transfer_table, id_column)
+    confirmed_lsns = tracker.get_confirmed_lsns(src_cur)
+
+    replicated_ids = [tracker.replicated_id(lsn) for lsn in confirmed_lsns]
+
+    metrics_array = [rid if rid is not None else 0 for rid in replicated_ids]
+    metrics.add_metrics_array("total_cnt", metrics_array, dst_conn.get_hosts())
+
+    if all([lsn is not None for lsn in confirmed_lsns]):
+        tracker.forget_until(min(confirmed_lsns))
+
+    if all([rid is not None for rid in replicated_ids]):
+        return min(replicated_ids)
+    return None
+
+
+def is_caught_up(
+    tracker: SlotLsnTracker, replicated_id: typing.Optional[int], catchup_rows: int
+):
+    if tracker.last_max_id is None or replicated_id is None:
+        return False
+    return tracker.last_max_id - replicated_id <= catchup_rows
+
+
+def build_dst_index(conn, transfer_table: str, id_column: str):
+    with conn.cursor() as cur:
+        cur.execute(
+            "SELECT indisvalid FROM pg_index WHERE indexrelid = to_regclass(%s)",
+            (id_column,),
+        )
+        row = cur.fetchone()
+        # an interrupted concurrent build leaves an invalid index behind,
+        # IF NOT EXISTS would keep it, so it is dropped and built again
+        if row is not None and not row[0]:
+            logger.warning(f"Index '{id_column}' is invalid, rebuilding")
+            cur.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {id_column};")
+        preparations.create_dst_id_index(cur, transfer_table, id_column, True)
+
+
+def build_deferred_index(
+    dst_conn: db_connector.MultiClusterConnection, transfer_table: str, id_column: str
+):
+    logger.info(f"Destinations caught up, building index on '{transfer_table}'")
+    # the build takes as long as the table needs, dst_timeout_s would cancel it
+    calls = [
+        functools.partial(build_dst_index, conn, transfer_table, id_column)
+        for conn in dst_conn.connections
+    ]
+    _, timings = dst_conn.fan_out(calls, with_timeout=False)
+    metrics.add_metrics_array("dst_index_build_s", timings, dst_conn.get_hosts())
+
+
+def delete_replicated_rows(src_cur, transfer_table: str, id_column: str, max_id: int):
+    src_cur.execute(f"DELETE FROM {transfer_table} WHERE {id_column} <= {max_id}")
+    deleted_count = src_cur.rowcount
+    logger.debug(
+        f"Records in {transfer_table} with {id_column} <= {max_id} deleted. Count: {deleted_count}"
+    )
+    return deleted_count
+
+
+def drop_replicated_partitions(
+    src_cur, transfer_table: str, partition_size: int, max_id: int
+):
+    dropped_count = 0
+    for number in preparations.get_partition_numbers(src_cur, transfer_table):
+        if (number + 1) * partition_size > max_id:
+            break
+
+        partition = preparations.get_partition_name(transfer_table, number)
+        src_cur.execute(f"ALTER TABLE {transfer_table} DETACH PARTITION {partition};")
+        # ids have gaps and the final drain may have deleted rows already,
+        # so the partition's id range says nothing about the rows it held
+        src_cur.execute(f"SELECT COUNT(*) FROM {partition};")
+        dropped_count += src_cur.fetchone()[0]
+        src_cur.execute(f"DROP TABLE {partition};")
+        logger.debug(f"Partition {partition} of {transfer_table} dropped")
+
+    return dropped_count
+
+
 def remove_replicated_records(
     src_conn: psycopg2.extensions.connection,
     dst_conn: db_connector.MultiClusterConnection,
@@ -17,30 +288,73 @@ def remove_replicated_records(
     id_column: str,
     period_s: int,
     stop_event,
+    cleanup_mode: str = "max_id",
+    partition_size: typing.Optional[int] = None,
+    partitions_ahead: int = 4,
+    connector: typing.Optional[db_connector.DatabaseConnector] = None,
+    apply_workers: int = 1,
+    bulk_load: bool = False,
+    catchup_rows: int = 0,
 ):
+    if cleanup_mode not in ("max_id", "slot_lsn"):
+        raise Exception(f"Unknown cleanup mode '{cleanup_mode}'")
+
+    # slots are created per destination in the order of get_hosts()
+    layout = ReplicationLayout(
+        None, None, len(dst_conn.get_hosts()), None, id_column, apply_workers
+    )
+    slots_by_destination = [
+        layout.get_destination_slots(dst) for dst in range(layout.destinations_count)
+    ]
+
+    tracker = None
+    # without the destination index MAX(id) is a full scan, use slots instead
+    if cleanup_mode == "slot_lsn" or bulk_load:
+        tracker = SlotLsnTracker(slots_by_destination)
+    index_pending = bulk_load
+
     while True:
         try:
-            dst_cur = dst_conn.cursor()
             src_cur = src_conn.cursor()
 
-            dst_cur.execute(f"SELECT MAX({id_column}) FROM {transfer_table}")
-            rpl_cnts = dst_cur.fetchone()
+            if partition_size is not None:
+                preparations.create_upcoming_partitions(
+                    src_conn,
+                    transfer_table,
+                    id_column,
+                    partition_size,
+                    partitions_ahead,
+                )
 
-            metrics_array = [cnt[0] if cnt[0] is not None else 0 for cnt in rpl_cnts]
-            metrics.add_metrics_array("total_cnt", metrics_array, dst_conn.get_hosts())
+            if tracker is not None:
+                max_id = get_replicated_id_by_slots(
+                    src_cur, dst_conn, tracker, transfer_table, id_column
+                )
+            else:
+                max_id = get_replicated_id_by_destinations(
+                    dst_conn, transfer_table, id_column, apply_workers
+                )
+            record_replication_lag(src_cur, dst_conn, slots_by_destination)
 
-            max_id = None
-            if all([cnt[0] is not None for cnt in rpl_cnts]):
-                max_id = min([cnt[0] for cnt in rpl_cnts])
+            if index_pending and is_caught_up(tracker, max_id, catchup_rows):
+                build_deferred_index(dst_conn, transfer_table, id_column)
+                index_pending = False
+                if cleanup_mode == "max_id":
+                    tracker = None
 
             if max_id is not None:
-                src_cur.execute(
-                    f"DELETE FROM {transfer_table} WHERE {id_column} <= {max_id}"
-                )
-                deleted_count = src_cur.rowcount
-                logger.debug(
-                    f"Records in {transfer_table} with {id_column} <= {max_id} deleted. Count: {deleted_count}"
-                )
+                if partition_size is not None:
+                    deleted_count = drop_replicated_partitions(
+                        src_cur, transfer_table, partition_size, max_id
+                    )
+                    if stop_event.is_set():
+                        deleted_count += delete_replicated_rows(
+                            src_cur, transfer_table, id_column, max_id
+                        )
+                else:
+                    deleted_count = delete_replicated_rows(
+                        src_cur, transfer_table, id_column, max_id
+                    )
                 metrics.increment_metric("total_deleted", deleted_count)
 
                 if deleted_count == 0 and stop_event.is_set():
@@ -51,6 +365,17 @@ def remove_replicated_records(
             if period_s > 0:
                 time.sleep(period_s)
         except psycopg2.Error as err:
+            dst_lost = any([conn.closed for conn in dst_conn.connections])
+            if connector is not None and (
+                db_connector.is_connection_lost(src_conn) or dst_lost
+            ):
+                logger.warning(f"Connection lost while deleting records: {err}")
+                if src_conn.closed:
+                    src_conn = connector.reconnect(src_conn)
+                dst_conn.reconnect_lost()
+                metrics.increment_metric("total_reconnects", 1)
+                continue
+
             logger.error(f"Error deleting records: {err}")
             raise
         except KeyboardInterrupt as err:
@@ -58,5 +383,15 @@ def remove_replicated_records(
             break
 
         finally:
-            dst_cur.close()
             src_cur.close()
+
+
+def run_remove_replicated_records(connector_settings: dict, *args, **kwargs):
+    connector = db_connector.DatabaseConnector(**connector_settings)
+    remove_replicated_records(
+        connector.get_src_connection(),
+        connector.get_dst_connection(),
+        *args,
+        connector=connector,
+        **kwargs,
+    )
@@ -1,7 +1,9 @@
 from . import aggregator
 from . import copier
+from . import masker
 from . import random_selector
 from . import reduce_aggregator
 from . import shuffler
+from . import synthesizer
 from . import transformer
 from . import uuid_replacer
\ No newline at end of file
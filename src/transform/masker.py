@@ -0,0 +1,181 @@
+import logging
+import psycopg2
+import re
+import typing
+
+from src.utils import utils
+from src.transform.transformer import Transformer
+
+
+logger = logging.getLogger(__name__)
+
+
+PRESET_PATTERNS = {
+    "email": {"regex": "^(.)[^@]*@", "replacement": "\\1***@"},
+    "phone": {"mask": "[0-9]", "keep_last": 4},
+    "card": {"mask": "[0-9]", "keep_last": 4},
+    "iban": {"mask": "[0-9A-Za-z]", "keep_first": 4, "keep_last": 4},
+}
+
+
+def _quote(value: str):
+    return "'" + value.replace("'", "''") + "'"
+
+
+def _resolve_pattern(column: str, pattern: typing.Union[str, dict]):
+    if isinstance(pattern, str):
+        if pattern == "echo":
+            return None
+        if pattern not in PRESET_PATTERNS:
+            raise Exception(f"Unknown mask pattern '{pattern}' for column '{column}'")
+        return PRESET_PATTERNS[pattern]
+    return pattern
+
+
+def compile_mask_expression(column: str, pattern: typing.Union[str, dict]):
+    pattern = _resolve_pattern(column, pattern)
+    value = f"s.{column}::text"
+
+    if pattern is None:
+        return f"s.{column}"
+
+    if "regex" in pattern:
+        flags = pattern.get("flags", "")
+        return (
+            f"regexp_replace({value}, {_quote(pattern['regex'])}, "
+            f"{_quote(pattern['replacement'])}, {_quote(flags)})"
+        )
+
+    char_class = pattern.get("mask", "[0-9A-Za-z]")
+    if not re.fullmatch(r"\[[^\[\]^][^\[\]]*\]", char_class):
+        raise Exception(
+            f"Mask for column '{column}' must be a bracket expression, got '{char_class}'"
+        )
+    other_class = "[^" + char_class[1:]
+
+    mask_char = pattern.get("char", "*")
+    if len(mask_char) != 1:
+        raise Exception(f"Mask char for column '{column}' must be a single character")
+
+    keep_first = int(pattern.get("keep_first", 0))
+    keep_last = int(pattern.get("keep_last", 0))
+
+    regex = char_class
+    if keep_last > 0:
+        regex += f"(?=(?:{other_class}*{char_class}){{{keep_last}}})"
+
+    if keep_first == 0:
+        return f"regexp_replace({value}, {_quote(regex)}, {_quote(mask_char)}, 'g')"
+
+    return (
+        f"(left({value}, {keep_first}) || "
+        f"regexp_replace(substr({value}, {keep_first + 1}), {_quote(regex)}, "
+        f"{_quote(mask_char)}, 'g'))"
+    )
+
+
+class Masker(Transformer):
+    def __init__(
+        self,
+        conn: psycopg2.extensions.connection,
+        src_table: str,
+        transfer_table: str,
+        processed_column: str,
+        continuous_mode: bool,
+        batch_size: int,
+        sleep_ms: int,
+        column_patterns: typing.Dict[str, typing.Union[str, dict]],
+    ):
+        super().__init__(
+            conn,
+            src_table,
+            transfer_table,
+            processed_column,
+            continuous_mode,
+            batch_size,
+            sleep_ms,
+        )
+        self.column_patterns = column_patterns
+
+        self.column_exprs = {}
+        self.regexes = []
+        for column, pattern in column_patterns.items():
+            expr = compile_mask_expression(column, pattern)
+            resolved = _resolve_pattern(column, pattern)
+            if resolved is not None:
+                expr = f"{expr}::{self.column_types[column]}"
+                if "regex" in resolved:
+                    self.regexes.append(
+                        (column, resolved["regex"], resolved.get("flags", ""))
+                    )
+            self.column_exprs[column] = expr
+
+        self.new_types = []
+        self.new_funcs = []
+
+    def get_transfer_table_schema(self):
+        column_names = self.column_patterns.keys()
+        return [(column, self.column_types[column]) for column in column_names]
+
+    def get_funcs(self):
+        return self.new_funcs
+
+    def validate_regexes(self):
+        # the patterns run as PostgreSQL AREs, which Python re does not accept
+        # in the same way, so the server checks them before the function is made
+        with self.conn.cursor() as cur:
+            for column, regex, flags in self.regexes:
+                try:
+                    cur.execute("SELECT regexp_replace('', %s, '', %s)", (regex, flags))
+                except psycopg2.Error as err:
+                    raise Exception(f"Invalid regex for column '{column}': {err}")
+
+    def prepare(self):
+        self.validate_regexes()
+        columns = list(self.column_patterns.keys())
+
+        type_name = "_mask_" + utils.join_names(columns, "_") + "_type"
+        self.new_types.append(type_name)
+
+        fields = [f"{column} {self.column_types[column]}" for column in columns]
+        fields_str = ",\n".join(fields)
+
+        create_type_query = f"CREATE TYPE {type_name} AS (\n{fields_str}\n);"
+        with self.conn.cursor() as cur:
+            cur.execute(create_type_query)
+
+        func_name = "_mask_" + utils.join_names(columns, "_")
+        self.new_funcs.append(func_name)
+
+        exprs = [self.column_exprs[column] for column in columns]
+
+        create_func_query = f"""
+            CREATE OR REPLACE FUNCTION {func_name}()
+            RETURNS SETOF {type_name} AS $$
+            BEGIN
+                RETURN QUERY SELECT {utils.join_names(exprs)} FROM {self.src_table} s
+                JOIN {self.temp_table_name} t ON s.ctid = t._ctid_;
+            END;
+            $$ LANGUAGE plpgsql;"""
+
+        with self.conn.cursor() as cur:
+            cur.execute(create_func_query)
+
+        logger.debug("Masker preparation successfully completed")
+
+    def cleanup(self):
+        # prepare may fail before anything was created
+        if not self.new_types:
+            return
+
+        type_str = ", ".join(self.new_types)
+        drop_types_query = f"DROP TYPE IF EXISTS {type_str} CASCADE;"
+
+        funcs_str = ", ".join(self.new_funcs)
+        drop_funcs_query = f"DROP FUNCTION IF EXISTS {funcs_str} CASCADE;"
+
+        with self.conn.cursor() as cur:
+            cur.execute(drop_types_query)
+            cur.execute(drop_funcs_query)
+
+        logger.debug("Masker cleanup successfully completed")
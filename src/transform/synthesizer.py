@@ -0,0 +1,174 @@
+import csv
+import io
+import logging
+import psycopg2
+import typing
+
+from src.utils import synthetic_pools, utils
+from src.transform.transformer import Transformer
+
+
+logger = logging.getLogger(__name__)
+
+
+class Synthesizer(Transformer):
+    def __init__(
+        self,
+        conn: psycopg2.extensions.connection,
+        src_table: str,
+        transfer_table: str,
+        processed_column: str,
+        continuous_mode: bool,
+        batch_size: int,
+        sleep_ms: int,
+        column_operations: typing.Dict[str, str],
+        pools_dir: str,
+        pool_size: int,
+        build_processes: int,
+        key: str,
+        locale: str = "en_US",
+    ):
+        super().__init__(
+            conn,
+            src_table,
+            transfer_table,
+            processed_column,
+            continuous_mode,
+            batch_size,
+            sleep_ms,
+        )
+        self.column_operations = column_operations
+        self.pools_dir = pools_dir
+        self.pool_size = pool_size
+        self.build_processes = build_processes
+        self.key = key
+        self.locale = locale
+
+        self.kinds = [
+            kind for kind in dict.fromkeys(column_operations.values()) if kind != "echo"
+        ]
+        for kind in self.kinds:
+            if kind not in synthetic_pools.POOL_KINDS:
+                raise Exception(f"Unknown synthesize operation '{kind}'")
+
+        self.new_types = []
+        self.new_funcs = []
+        self.new_tables = []
+
+    def get_transfer_table_schema(self):
+        column_names = self.column_operations.keys()
+        return [(column, self.column_types[column]) for column in column_names]
+
+    def get_funcs(self):
+        return self.new_funcs
+
+    def get_pool_table(self, kind: str):
+        return f"{self.transfer_table}_pool_{kind}"
+
+    def prepare(self):
+        synthetic_pools.ensure_pools(
+            self.pools_dir,
+            self.kinds,
+            self.pool_size,
+            self.build_processes,
+            self.locale,
+        )
+
+        for kind in self.kinds:
+            self.load_pool_table(kind)
+
+        self.create_synthesize_func()
+
+        logger.info("Synthesizer preparation successfully completed")
+
+    def load_pool_table(self, kind: str):
+        table_name = self.get_pool_table(kind)
+        path = synthetic_pools.get_pool_path(
+            self.pools_dir, kind, self.pool_size, self.locale
+        )
+
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        with synthetic_pools.SyntheticPool(path) as pool:
+            for idx, value in enumerate(pool):
+                writer.writerow((idx, value))
+        buffer.seek(0)
+
+        with self.conn.cursor() as cur:
+            cur.execute(
+                f"CREATE TABLE {table_name} (idx INTEGER PRIMARY KEY, value TEXT NOT NULL);"
+            )
+            self.new_tables.append(table_name)
+            cur.copy_expert(
+                f"COPY {table_name} (idx, value) FROM STDIN WITH (FORMAT csv)", buffer
+            )
+            cur.execute(f"ANALYZE {table_name};")
+
+        logger.debug(f"Synthetic pool '{kind}' loaded into '{table_name}'")
+
+    def get_hash_expr(self, column: str):
+        key = self.key.replace("'", "''")
+        return (
+            f"(('x' || substr(md5('{key}' || s.{column}::text), 1, 8))::bit(32)::bigint"
+            f" % {self.pool_size})"
+        )
+
+    def create_synthesize_func(self):
+        columns = list(self.column_operations.keys())
+
+        type_name = "_synthesize_" + utils.join_names(columns, "_") + "_type"
+        self.new_types.append(type_name)
+
+        fields = [f"{column} {self.column_types[column]}" for column in columns]
+        fields_str = ",\n".join(fields)
+
+        create_type_query = f"CREATE TYPE {type_name} AS (\n{fields_str}\n);"
+        with self.conn.cursor() as cur:
+            cur.execute(create_type_query)
+
+        select_items = []
+        joins = []
+        for column, kind in self.column_operations.items():
+            if kind == "echo":
+                select_items.append(f"s.{column}")
+                continue
+
+            alias = f"p_{column}"
+            select_items.append(f"{alias}.value::{self.column_types[column]}")
+            joins.append(
+                f"LEFT JOIN {self.get_pool_table(kind)} {alias} "
+                f"ON {alias}.idx = {self.get_hash_expr(column)}"
+            )
+        joins_str = "\n".join(joins)
+
+        func_name = "_synthesize_" + utils.join_names(columns, "_")
+        self.new_funcs.append(func_name)
+
+        create_func_query = f"""
+            CREATE OR REPLACE FUNCTION {func_name}()
+            RETURNS SETOF {type_name} AS $$
+            BEGIN
+                RETURN QUERY SELECT {utils.join_names(select_items)} FROM {self.src_table} s
+                JOIN {self.temp_table_name} t ON s.ctid = t._ctid_
+                {joins_str};
+            END;
+            $$ LANGUAGE plpgsql;"""
+
+        with self.conn.cursor() as cur:
+            cur.execute(create_func_query)
+
+    def cleanup(self):
+        type_str = ", ".join(self.new_types)
+        drop_types_query = f"DROP TYPE IF EXISTS {type_str} CASCADE;"
+
+        funcs_str = ", ".join(self.new_funcs)
+        drop_funcs_query = f"DROP FUNCTION IF EXISTS {funcs_str} CASCADE;"
+
+        with self.conn.cursor() as cur:
+            cur.execute(drop_types_query)
+            cur.execute(drop_funcs_query)
+            if self.new_tables:
+                tables_str = ", ".join(self.new_tables)
+                cur.execute(f"DROP TABLE IF EXISTS {tables_str};")
+
+        logger.info("Synthesizer cleanup successfully completed")
@@ -1,10 +1,13 @@
 import logging
+import math
 import psycopg2
 import time
+import typing
 from abc import ABC, abstractmethod
 
 from src.monitoring.metrics import get_metrics_collector
-from src.utils import utils
+from src.preparations import preparations
+from src.utils import db_connector, utils
 
 
 logger = logging.getLogger(__name__)
@@ -38,6 +41,26 @@ class Transformer(ABC):
 
         self.func_names = None
 
+        self.reconnect = None
+        self.max_reconnect_attempts = 0
+
+        self.delivery = None
+        self.batch_ctids = None
+
+        self.id_column = None
+        self.backlog_high = None
+        self.backlog_low = None
+        self.backlog_unit = "rows"
+        self.backpressure_poll_ms = 1000
+        self.max_pause_s = None
+        self.pause_warning_s = 60
+
+        self.partition_size = None
+        self.partitions_ahead = 4
+
+        self.eta_model = None
+        self.cost_collector = None
+
     def __del__(self):
         if not self.conn.closed:
             self.conn.autocommit = True
@@ -45,6 +68,144 @@ class Transformer(ABC):
     def skip_process_last_batch(self):
         return False
 
+    def set_reconnect(self, reconnect, max_attempts: int = 5):
+        self.reconnect = reconnect
+        self.max_reconnect_attempts = max_attempts
+
+    def set_delivery(self, delivery):
+        self.delivery = delivery
+
+    def set_eta_model(self, eta_model):
+        self.eta_model = eta_model
+
+    def set_cost_collector(self, cost_collector):
+        self.cost_collector = cost_collector
+
+    def get_cost_patterns(self):
+        # names generated by the tool itself, every statement of a batch
+        # mentions one of them while user table names may be too short to tell
+        return [self.temp_table_name] + list(self.get_funcs())
+
+    def set_backpressure(
+        self,
+        id_column: str,
+        high: int,
+        low: int,
+        unit: str = "rows",
+        poll_ms: int = 1000,
+        partitioned: bool = False,
+        max_pause_s: typing.Optional[float] = None,
+    ):
+        if unit not in ("rows", "bytes"):
+            raise Exception(f"Unknown backlog unit '{unit}'")
+        # deleted rows keep their space until vacuum, only dropped partitions
+        # make the table smaller, so the size would never fall to low watermark
+        if unit == "bytes" and not partitioned:
+            raise Exception("Backlog in bytes requires a partitioned transfer table")
+        if low > high:
+            raise Exception("Backlog low watermark is above the high watermark")
+
+        self.id_column = id_column
+        self.backlog_high = high
+        self.backlog_low = low
+        self.backlog_unit = unit
+        self.backpressure_poll_ms = poll_ms
+        self.max_pause_s = max_pause_s
+
+    def set_partitioning(
+        self, id_column: str, partition_size: int, partitions_ahead: int = 4
+    ):
+        self.id_column = id_column
+        self.partition_size = partition_size
+        self.partitions_ahead = partitions_ahead
+
+    def ensure_partitions(self):
+        # the cleanup loop keeps partitions ahead of the inserts, this only
+        # keeps the inserts going when the cleanup loop stalls or dies
+        if self.partition_size is None:
+            return
+
+        with self.conn.cursor() as cur:
+            current_number = preparations.get_current_partition_number(
+                cur, self.transfer_table, self.id_column, self.partition_size
+            )
+            numbers = preparations.get_partition_numbers(cur, self.transfer_table)
+        self.conn.commit()
+
+        needed = current_number + math.ceil(self.batch_size / self.partition_size)
+        if numbers and numbers[-1] >= needed:
+            return
+
+        logger.warning(
+            f"Partitions of '{self.transfer_table}' run out, creating them from the "
+            "transformer"
+        )
+        preparations.create_upcoming_partitions(
+            self.conn,
+            self.transfer_table,
+            self.id_column,
+            self.partition_size,
+            self.partitions_ahead,
+        )
+
+    def get_backlog(self):
+        with self.conn.cursor() as cur:
+            if self.backlog_unit == "bytes":
+                cur.execute(
+                    "SELECT COALESCE(SUM(pg_total_relation_size(relid)), 0) "
+                    "FROM pg_partition_tree(%s::regclass)",
+                    (self.transfer_table,),
+                )
+            else:
+                id_column = self.id_column
+                cur.execute(
+                    f"SELECT COALESCE(MAX({id_column}) - MIN({id_column}) + 1, 0) "
+                    f"FROM {self.transfer_table}"
+                )
+            backlog = cur.fetchone()[0]
+        self.conn.commit()
+
+        metrics.add_metric(f"transfer_backlog_{self.backlog_unit}", backlog)
+        return backlog
+
+    def wait_for_backlog(self):
+        if self.backlog_high is None:
+            return
+
+        backlog = self.get_backlog()
+        if backlog < self.backlog_high:
+            return
+
+        logger.info(
+            f"Transfer backlog {backlog} {self.backlog_unit} reached high watermark "
+            f"{self.backlog_high}, pausing"
+        )
+        pause_start = time.time()
+        last_warning = pause_start
+        while backlog > self.backlog_low:
+            time.sleep(self.backpressure_poll_ms / 1000)
+            backlog = self.get_backlog()
+
+            now = time.time()
+            if self.max_pause_s is not None and now - pause_start > self.max_pause_s:
+                raise Exception(
+                    f"Transfer backlog {backlog} {self.backlog_unit} stayed above low "
+                    f"watermark {self.backlog_low} for {self.max_pause_s} s"
+                )
+            if now - last_warning >= self.pause_warning_s:
+                logger.warning(
+                    f"Paused for {now - pause_start:.0f} s, transfer backlog {backlog} "
+                    f"{self.backlog_unit} is above low watermark {self.backlog_low}"
+                )
+                last_warning = now
+
+        pause_time = time.time() - pause_start
+        metrics.add_metric("backpressure_pause_s", pause_time)
+        logger.info(
+            f"Transfer backlog {backlog} {self.backlog_unit} is below low watermark "
+            f"{self.backlog_low}, resuming after {pause_time:.1f} s"
+        )
+
     @abstractmethod
     def get_transfer_table_schema(self):
         pass
@@ -99,6 +260,9 @@ class Transformer(ABC):
             func_names = [f"({name}()).*" for name in self.get_funcs()]
             funcs_str = utils.join_names(func_names, ", ")
 
+            if self.delivery is not None:
+                return self.deliver_directly(funcs_str)
+
             insert_query = f"""
                 INSERT INTO {self.transfer_table}
                 SELECT {funcs_str};
@@ -113,6 +277,67 @@ class Transformer(ABC):
             logger.error(f"Error transferring data to '{self.transfer_table}': {err}")
             raise
 
+    def deliver_directly(self, funcs_str: str):
+        with self.conn.cursor() as cur:
+            # kept to mark the same rows if the batch has to be resent
+            cur.execute(f"SELECT _ctid_ FROM {self.temp_table_name};")
+            self.batch_ctids = [row[0] for row in cur.fetchall()]
+            while True:
+                buffer = self.delivery.new_buffer()
+                cur.copy_expert(self.delivery.get_copy_query(funcs_str), buffer)
+                if not buffer.overflowed or len(self.batch_ctids) <= 1:
+                    break
+                self.split_batch()
+        return self.delivery.deliver(buffer)
+
+    def split_batch(self):
+        # the transformed batch did not fit the delivery buffer, the second
+        # half stays unprocessed for the next batches, which are smaller now
+        half = len(self.batch_ctids) // 2
+        dropped = self.batch_ctids[half:]
+        self.batch_ctids = self.batch_ctids[:half]
+        try:
+            delete_query = f"""
+            DELETE FROM {self.temp_table_name}
+            WHERE _ctid_ = ANY(%s::tid[]);
+            """
+            with self.conn.cursor() as cur:
+                cur.execute(delete_query, (dropped,))
+        except psycopg2.Error as err:
+            logger.error(f"Error splitting batch in '{self.temp_table_name}': {err}")
+            raise
+
+        self.batch_size = min(self.batch_size, half)
+        logger.warning(
+            f"Transformed batch exceeds the delivery buffer, "
+            f"batch_size lowered to {self.batch_size}"
+        )
+
+    def restore_batch_ctids(self):
+        try:
+            restore_query = f"""
+            INSERT INTO {self.temp_table_name} (_ctid_)
+            SELECT unnest(%s::tid[]);
+            """
+            with self.conn.cursor() as cur:
+                cur.execute(restore_query, (self.batch_ctids,))
+        except psycopg2.Error as err:
+            logger.error(f"Error restoring CTIDs into '{self.temp_table_name}': {err}")
+            raise
+
+    def finish_pending_batch(self):
+        # the batch reached some destinations before the failure, transforming
+        # its rows again could give other values, so the kept batch goes to the
+        # rest and the same source rows are marked
+        start_time = time.time()
+        self.restore_batch_ctids()
+
+        converted = self.delivery.resend_pending()
+        metrics.increment_metric("total_converted", converted)
+        stage_start = self.record_stage_time("convert", start_time)
+
+        self.complete_batch(stage_start)
+
     def mark_processed(self):
         try:
             update_query = f"""
@@ -144,6 +369,100 @@ class Transformer(ABC):
             )
             raise
 
+    def record_stage_time(self, stage: str, stage_start: float):
+        now = time.time()
+        metrics.add_metric("stage_time_s", now - stage_start, f"stage={stage}")
+        return now
+
+    def complete_batch(self, stage_start: float):
+        processed = self.mark_processed()
+        self.conn.commit()
+        if self.delivery is not None:
+            self.delivery.acknowledge()
+        metrics.increment_metric("total_mark_processed", processed)
+        stage_start = self.record_stage_time("mark", stage_start)
+
+        self.truncate_stids_table()
+        self.conn.commit()
+        self.record_stage_time("truncate", stage_start)
+        logger.debug("Completed iteration")
+
+    def process_iteration(self):
+        if self.delivery is not None and self.delivery.has_pending():
+            self.finish_pending_batch()
+            return True
+
+        self.wait_for_backlog()
+        self.ensure_partitions()
+
+        start_time = time.time()
+
+        selected = self.select_ctids()
+        metrics.increment_metric("total_selected_ctids", selected)
+        stage_start = self.record_stage_time("select", start_time)
+
+        if (selected == 0) or (
+            selected < self.batch_size and self.skip_process_last_batch()
+        ):
+            if self.continuous_mode:
+                if self.sleep_ms > 0:
+                    logger.debug(f"Sleep {self.sleep_ms} ms")
+                    time.sleep(self.sleep_ms / 1000)
+                return True
+            else:
+                self.conn.commit()
+                return False
+
+        converted = self.insert_into_transfer_table()
+        metrics.increment_metric("total_converted", converted)
+        stage_start = self.record_stage_time("convert", stage_start)
+
+        self.complete_batch(stage_start)
+
+        end_time = time.time()
+        elapsed_time = end_time - start_time
+        metrics.add_metric("batch_time_execution_s", elapsed_time)
+
+        if self.cost_collector is not None:
+            self.cost_collector.on_batch(self.conn, self.get_cost_patterns())
+
+        if self.eta_model is not None:
+            self.eta_model.observe(selected, elapsed_time)
+            eta_s = self.eta_model.estimate_runtime_s(self.batch_size)
+            if eta_s is not None:
+                metrics.add_metric("eta_s", eta_s)
+
+        if self.sleep_ms > 0:
+            logger.debug(f"Sleep {self.sleep_ms} ms")
+            time.sleep(self.sleep_ms / 1000)
+
+        return True
+
+    def recover_connection(self, err: psycopg2.Error, attempt: int):
+        if self.reconnect is None or attempt > self.max_reconnect_attempts:
+            return False
+        src_lost = db_connector.is_connection_lost(self.conn)
+        # with direct delivery the failed connection may be a destination one,
+        # the source stays connected then and only the batch is rolled back
+        dst_lost = self.delivery is not None and self.delivery.has_lost_connections()
+        if not src_lost and not dst_lost:
+            return False
+
+        logger.warning(
+            f"Connection lost during batch ({err}), reconnect attempt {attempt}"
+        )
+        if dst_lost:
+            self.delivery.reconnect_lost()
+        if src_lost:
+            self.conn = self.reconnect(self.conn)
+            self.conn.autocommit = False
+            self.create_temp_table()
+            self.conn.commit()
+        else:
+            self.conn.rollback()
+        metrics.increment_metric("total_reconnects", 1)
+        return True
+
     def process(self):
         logger.info("Data transform process started")
 
@@ -154,44 +473,23 @@ class Transformer(ABC):
             self.create_temp_table()
             self.conn.commit()
 
+            if self.cost_collector is not None:
+                self.cost_collector.start(self.conn, self.get_cost_patterns())
+
+            attempt = 0
             while True:
-                start_time = time.time()
-
-                selected = self.select_ctids()
-                metrics.increment_metric("total_selected_ctids", selected)
-
-                if (selected == 0) or (
-                    selected < self.batch_size and self.skip_process_last_batch()
-                ):
-                    if self.continuous_mode:
-                        if self.sleep_ms > 0:
-                            logger.debug(f"Sleep {self.sleep_ms} ms")
-                            time.sleep(self.sleep_ms / 1000)
-                        continue
-                    else:
-                        self.conn.commit()
+                try:
+                    if not self.process_iteration():
                         break
-
-                converted = self.insert_into_transfer_table()
-                metrics.increment_metric("total_converted", converted)
-
-                processed = self.mark_processed()
-                self.conn.commit()
-                metrics.increment_metric("total_mark_processed", processed)
-
-                self.truncate_stids_table()
-                self.conn.commit()
-                logger.debug("Completed iteration")
-
-                end_time = time.time()
-                elapsed_time = end_time - start_time
-                metrics.add_metric("batch_time_execution_s", elapsed_time)
-
-                if self.sleep_ms > 0:
-                    logger.debug(f"Sleep {self.sleep_ms} ms")
-                    time.sleep(self.sleep_ms / 1000)
-
-        except psycopg2.Error as err:
+                    attempt = 0
+                except psycopg2.Error as err:
+                    attempt += 1
+                    if not self.recover_connection(err, attempt):
+                        raise
+
+        except Exception:
+            # not only database errors, a delivery buffer overflow also leaves
+            # the batch transaction open
             self.conn.rollback()
             self.conn.autocommit = True
             self.cleanup()
@@ -1,2 +1,4 @@
 from . import db_connector
+from . import introspection
+from . import synthetic_pools
 from . import utils
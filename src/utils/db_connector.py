@@ -6,6 +6,9 @@ import logging
 import enum
 import typing
 import re
+import time
+import functools
+import concurrent.futures
 
 logger = logging.getLogger(__name__)
 
@@ -15,17 +18,86 @@ class ConnStringType(enum.Enum):
     DESTINATION = "DST_CONN_STRINGS"
 
 
+def _timed_call(func):
+    start_time = time.monotonic()
+    result = func()
+    return result, time.monotonic() - start_time
+
+
+def _fan_out(
+    executor: concurrent.futures.ThreadPoolExecutor,
+    calls: typing.List[typing.Callable],
+    hosts: typing.List[str],
+    timeout_s: typing.Optional[float],
+    cancels: typing.List[typing.Callable],
+):
+    futures = [executor.submit(_timed_call, call) for call in calls]
+
+    _, not_done = concurrent.futures.wait(futures, timeout=timeout_s)
+    if not_done:
+        slow_hosts = [host for host, f in zip(hosts, futures) if f in not_done]
+        logger.warning(
+            f"Destinations {slow_hosts} did not answer in {timeout_s} s, cancelling"
+        )
+        for cancel, future in zip(cancels, futures):
+            if future in not_done:
+                cancel()
+        concurrent.futures.wait(futures)
+
+    # timings are in the order of calls, several destinations may share a host
+    results = []
+    timings = []
+    for future in futures:
+        result, elapsed = future.result()
+        results.append(result)
+        timings.append(elapsed)
+
+    return results, timings
+
+
 class MultiClusterCursor:
-    def __init__(self, cursors: typing.List[psycopg2.extensions.cursor]):
+    def __init__(
+        self,
+        cursors: typing.List[psycopg2.extensions.cursor],
+        connection: typing.Optional["MultiClusterConnection"] = None,
+    ):
         self.cursors = cursors
+        self.connection = connection
+        self.timings = [0 for _ in cursors]
+
+    def _execute_all(self, query, params_list):
+        if self.connection is None:
+            for cursor, params in zip(self.cursors, params_list):
+                cursor.execute(query, params)
+            return
+
+        calls = [
+            functools.partial(cursor.execute, query, params)
+            for cursor, params in zip(self.cursors, params_list)
+        ]
+        _, self.timings = self.connection.fan_out(calls)
 
     def execute(self, query, params=None):
         if isinstance(params, types.GeneratorType):
-            for cursor in self.cursors:
-                cursor.execute(query, next(params))
+            params_list = [next(params) for _ in self.cursors]
         else:
-            for cursor in self.cursors:
-                cursor.execute(query, params)
+            params_list = [params for _ in self.cursors]
+        self._execute_all(query, params_list)
+
+    def execute_each(self, queries: typing.List[typing.List[str]]):
+        def execute_queries(cursor, cursor_queries):
+            for query in cursor_queries:
+                cursor.execute(query)
+
+        calls = [
+            functools.partial(execute_queries, cursor, cursor_queries)
+            for cursor, cursor_queries in zip(self.cursors, queries)
+        ]
+        if self.connection is None:
+            for call in calls:
+                call()
+            return
+        _, self.timings = self.connection.fan_out(calls)
 
     def fetchall(self):
         return [cursor.fetchall() for cursor in self.cursors]
@@ -38,17 +110,79 @@ class MultiClusterCursor:
             cursor.close()
 
 
+def _get_conn_label(conn_string):
+    # only where the connection goes, a URI carries the password inside it
+    try:
+        params = psycopg2.extensions.parse_dsn(conn_string)
+    except psycopg2.ProgrammingError:
+        return "database"
+    keys = ("host", "port", "dbname")
+    parts = [f"{key}={params[key]}" for key in keys if key in params]
+    return " ".join(parts) or "database"
+
+
 def _create_connection(conn_string):
     try:
         conn = psycopg2.connect(conn_string)
         conn.autocommit = True
-        logger.info(f"Connected to {conn_string.split()[0]}")
+        logger.info(f"Connected to {_get_conn_label(conn_string)}")
         return conn
     except psycopg2.OperationalError as e:
         logger.error(f"Error occurred while connecting to database: {e}")
         raise
 
 
+def is_connection_lost(conn: psycopg2.extensions.connection):
+    # psycopg2 marks the connection closed once the server is gone, errors of a
+    # healthy connection or of another one leave it open
+    return conn.closed != 0
+
+
+class RetryPolicy:
+    def __init__(
+        self, retries: int = 5, backoff_s: float = 0.5, max_backoff_s: float = 30
+    ):
+        self.retries = retries
+        self.backoff_s = backoff_s
+        self.max_backoff_s = max_backoff_s
+
+    def delays(self):
+        delay = self.backoff_s
+        for _ in range(self.retries):
+            yield delay
+            delay = min(delay * 2, self.max_backoff_s)
+
+
+def _create_connection_with_retry(
+    conn_string,
+    retry_policy: typing.Optional[RetryPolicy] = None,
+    session_setup: typing.Sequence[typing.Callable] = (),
+):
+    delays = retry_policy.delays() if retry_policy is not None else iter(())
+    while True:
+        try:
+            conn = _create_connection(conn_string)
+            for setup in session_setup:
+                setup(conn)
+            return conn
+        except psycopg2.OperationalError:
+            delay = next(delays, None)
+            if delay is None:
+                raise
+            logger.warning(
+                f"Reconnecting to {_get_conn_label(conn_string)} in {delay} s"
+            )
+            time.sleep(delay)
+
+
+def _run_session_sql(queries: typing.List[str], conn):
+    if not queries:
+        return
+    with conn.cursor() as cur:
+        for query in queries:
+            cur.execute(query)
+
+
 def _close_connection_impl(conn):
     if conn is not None and not conn.closed:
         try:
@@ -71,27 +205,80 @@ def _extract_host(dsn):
 
 
 class MultiClusterConnection:
-    def __init__(self, conn_strs: typing.List[str]):
-        self.connections = [_create_connection(conn_str) for conn_str in conn_strs]
+    def __init__(
+        self,
+        conn_strs: typing.List[str],
+        timeout_s: typing.Optional[float] = None,
+        retry_policy: typing.Optional[RetryPolicy] = None,
+        session_setup_sql: typing.Sequence[str] = (),
+    ):
+        self.conn_strs = conn_strs
+        self.timeout_s = timeout_s
+        self.retry_policy = retry_policy
+        self.session_setup = [
+            functools.partial(_run_session_sql, list(session_setup_sql))
+        ]
         self.closed = False
 
+        self._executor = None
+        self._executor_pid = None
+
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=max(1, len(conn_strs))
+        ) as executor:
+            self.connections = list(executor.map(self._connect, conn_strs))
+
+    def _connect(self, conn_str):
+        return _create_connection_with_retry(
+            conn_str, self.retry_policy, self.session_setup
+        )
+
+    def reconnect_lost(self):
+        lost = [ind for ind, conn in enumerate(self.connections) if conn.closed]
+        for ind in lost:
+            conn_label = _get_conn_label(self.conn_strs[ind])
+            logger.warning(f"Connection to {conn_label} lost, reconnecting")
+            self.connections[ind] = self._connect(self.conn_strs[ind])
+        return len(lost)
+
+    def _get_executor(self):
+        # threads do not survive fork, so each process gets its own pool
+        if self._executor is None or self._executor_pid != os.getpid():
+            self._executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=max(1, len(self.connections)),
+                thread_name_prefix="dst_fan_out",
+            )
+            self._executor_pid = os.getpid()
+        return self._executor
+
+    def fan_out(self, calls: typing.List[typing.Callable], with_timeout: bool = True):
+        return _fan_out(
+            self._get_executor(),
+            calls,
+            self.get_hosts(),
+            self.timeout_s if with_timeout else None,
+            [conn.cancel for conn in self.connections],
+        )
+
     def cursor(self):
         cursors = [conn.cursor() for conn in self.connections]
-        return MultiClusterCursor(cursors)
+        return MultiClusterCursor(cursors, self)
 
     def commit(self):
-        for conn in self.connections:
-            conn.commit()
+        self.fan_out([conn.commit for conn in self.connections])
 
     def rollback(self):
-        for conn in self.connections:
-            conn.rollback()
+        self.fan_out([conn.rollback for conn in self.connections])
 
     def close(self):
         for conn in self.connections:
             _close_connection_impl(conn)
         self.closed = True
 
+        if self._executor is not None and self._executor_pid == os.getpid():
+            self._executor.shutdown(wait=False)
+        self._executor = None
+
     def set_autocommit(self, option: bool):
         for conn in self.connections:
             conn.autocommit = option
@@ -110,31 +297,93 @@ def _close_connection(
 
 
 class DatabaseConnector:
-    def __init__(self, only_src: bool = False):
-        self.conn_strings = {
-            ConnStringType.SOURCE: os.getenv("SRC_CONN_STRING"),
-        }
-        if not only_src:
-            self.conn_strings[ConnStringType.DESTINATION] = json.loads(
-                os.getenv("DST_CONN_STRINGS").replace("\n", "")
+    def __init__(
+        self,
+        only_src: bool = False,
+        dst_timeout_s: typing.Optional[float] = None,
+        connection_settings: typing.Optional[dict] = None,
+        conn_strings: typing.Optional[dict] = None,
+    ):
+        self.only_src = only_src
+        self.dst_timeout_s = dst_timeout_s
+        self.connection_settings = (
+            connection_settings if connection_settings is not None else {}
+        )
+        self.session_setup = [
+            functools.partial(
+                _run_session_sql, list(self.connection_settings.get("session_setup", []))
             )
+        ]
+
+        if conn_strings is not None:
+            self.conn_strings = dict(conn_strings)
+        else:
+            self.conn_strings = {
+                ConnStringType.SOURCE: os.getenv("SRC_CONN_STRING"),
+            }
+            if not only_src:
+                self.conn_strings[ConnStringType.DESTINATION] = json.loads(
+                    os.getenv("DST_CONN_STRINGS").replace("\n", "")
+                )
 
         self.connections: typing.List[
             typing.Union[psycopg2.extensions.connection, MultiClusterConnection]
         ] = []
 
+    def _get_retry_policy(self):
+        return RetryPolicy(
+            self.connection_settings.get("retries", 5),
+            self.connection_settings.get("backoff_s", 0.5),
+            self.connection_settings.get("max_backoff_s", 30),
+        )
+
+    def _connect_src(self, session_setup: typing.Sequence[typing.Callable] = ()):
+        return _create_connection_with_retry(
+            self.conn_strings[ConnStringType.SOURCE],
+            self._get_retry_policy(),
+            self.session_setup + list(session_setup),
+        )
+
     def get_src_connection(self):
-        conn_str = self.conn_strings[ConnStringType.SOURCE]
-        conn = _create_connection(conn_str)
+        conn = self._connect_src()
         self.connections.append(conn)
         return conn
 
     def get_dst_connection(self):
         conn_strs = self.conn_strings[ConnStringType.DESTINATION]
-        conn = MultiClusterConnection(conn_strs)
+        conn = MultiClusterConnection(
+            conn_strs,
+            self.dst_timeout_s,
+            self._get_retry_policy(),
+            self.connection_settings.get("session_setup", []),
+        )
         self.connections.append(conn)
         return conn
 
+    def reconnect(
+        self,
+        conn: psycopg2.extensions.connection,
+        session_setup: typing.Sequence[typing.Callable] = (),
+    ):
+        src_label = _get_conn_label(self.conn_strings[ConnStringType.SOURCE])
+        logger.warning(f"Connection to {src_label} lost, reconnecting")
+        if not conn.closed:
+            try:
+                conn.close()
+            except psycopg2.Error:
+                pass
+        new_conn = self._connect_src(session_setup)
+        self.connections = [new_conn if c is conn else c for c in self.connections]
+        return new_conn
+
+    def get_settings(self):
+        return {
+            "only_src": self.only_src,
+            "dst_timeout_s": self.dst_timeout_s,
+            "connection_settings": self.connection_settings,
+            "conn_strings": self.conn_strings,
+        }
+
     def get_src_conn_string(self):
         return self.conn_strings[ConnStringType.SOURCE]
 
@@ -0,0 +1,153 @@
+import collections
+import json
+import logging
+import os
+import pathlib
+import typing
+
+from src.settings import get_settings
+
+
+logger = logging.getLogger(__name__)
+
+
+ColumnInfo = collections.namedtuple(
+    "ColumnInfo", ["name", "type", "not_null", "is_primary_key"]
+)
+ForeignKeyInfo = collections.namedtuple(
+    "ForeignKeyInfo", ["name", "columns", "ref_table", "ref_columns"]
+)
+
+
+class TableInfo:
+    def __init__(
+        self,
+        oid: int,
+        columns: typing.List[ColumnInfo],
+        foreign_keys: typing.List[ForeignKeyInfo],
+    ):
+        self.oid = oid
+        self.columns = columns
+        self.foreign_keys = foreign_keys
+
+    def get_primary_key(self):
+        return [column.name for column in self.columns if column.is_primary_key]
+
+    def to_dict(self):
+        return {
+            "oid": self.oid,
+            "columns": [list(column) for column in self.columns],
+            "foreign_keys": [list(fk) for fk in self.foreign_keys],
+        }
+
+    @staticmethod
+    def from_dict(data: dict):
+        return TableInfo(
+            data["oid"],
+            [ColumnInfo(*column) for column in data["columns"]],
+            [ForeignKeyInfo(*fk) for fk in data["foreign_keys"]],
+        )
+
+
+# Any DDL on the relation touches at least one of these catalog rows:
+# pg_class for rewrites and added columns, pg_attribute for type and
+# nullability changes, pg_constraint for keys. Dropped rows lower no max(xmin),
+# so the live rows are counted as well.
+MARKERS_QUERY = """
+    SELECT c.oid::bigint, current_database(), json_build_array(
+        c.xmin::text, c.relfilenode::bigint, c.relnatts,
+        (SELECT max(a.xmin::text::bigint) FROM pg_attribute a WHERE a.attrelid = c.oid),
+        (SELECT count(*) FROM pg_attribute a
+            WHERE a.attrelid = c.oid AND a.attnum > 0 AND NOT a.attisdropped),
+        (SELECT max(k.xmin::text::bigint) FROM pg_constraint k
+            WHERE k.conrelid = c.oid),
+        (SELECT count(*) FROM pg_constraint k WHERE k.conrelid = c.oid)
+    )::text
+    FROM pg_class c WHERE c.oid = %s::regclass
+"""
+
+COLUMNS_QUERY = """
+    SELECT a.attname, format_type(a.atttypid, a.atttypmod), a.attnotnull,
+        COALESCE(a.attnum = ANY(pk.conkey), false)
+    FROM pg_attribute a
+    LEFT JOIN pg_constraint pk ON pk.conrelid = a.attrelid AND pk.contype = 'p'
+    WHERE a.attrelid = %s AND a.attnum > 0 AND NOT a.attisdropped
+    ORDER BY a.attnum
+"""
+
+FOREIGN_KEYS_QUERY = """
+    SELECT k.conname, k.confrelid::regclass::text,
+        ARRAY(SELECT a.attname FROM unnest(k.conkey) WITH ORDINALITY u(attnum, ord)
+            JOIN pg_attribute a ON a.attrelid = k.conrelid AND a.attnum = u.attnum
+            ORDER BY u.ord),
+        ARRAY(SELECT a.attname FROM unnest(k.confkey) WITH ORDINALITY u(attnum, ord)
+            JOIN pg_attribute a ON a.attrelid = k.confrelid AND a.attnum = u.attnum
+            ORDER BY u.ord)
+    FROM pg_constraint k
+    WHERE k.conrelid = %s AND k.contype = 'f'
+    ORDER BY k.conname
+"""
+
+
+def get_cache_dir():
+    return get_settings().get("introspection_cache_dir")
+
+
+def _get_cache_path(cache_dir: str, database: str, oid: int):
+    return pathlib.Path(cache_dir) / f"{database}_{oid}.json"
+
+
+def _read_cache(path: pathlib.Path, markers: str):
+    try:
+        with open(path, "r") as f:
+            cached = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    if cached.get("markers") != markers:
+        return None
+    return TableInfo.from_dict(cached["table"])
+
+
+def _write_cache(path: pathlib.Path, markers: str, table_info: TableInfo):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(path.name + f".{os.getpid()}.tmp")
+    try:
+        with open(tmp_path, "w") as f:
+            json.dump({"markers": markers, "table": table_info.to_dict()}, f)
+        os.replace(tmp_path, path)
+    except OSError as err:
+        logger.warning(f"Failed to write introspection cache '{path}': {err}")
+
+
+def load_table_info(cur, oid: int):
+    cur.execute(COLUMNS_QUERY, (oid,))
+    columns = [ColumnInfo(*row) for row in cur.fetchall()]
+
+    cur.execute(FOREIGN_KEYS_QUERY, (oid,))
+    foreign_keys = [
+        ForeignKeyInfo(name, list(columns_), ref_table, list(ref_columns))
+        for name, ref_table, columns_, ref_columns in cur.fetchall()
+    ]
+    return TableInfo(oid, columns, foreign_keys)
+
+
+def get_table_info(cur, table_name: str, cache_dir: typing.Optional[str] = None):
+    if cache_dir is None:
+        cache_dir = get_cache_dir()
+
+    cur.execute(MARKERS_QUERY, (table_name,))
+    oid, database, markers = cur.fetchone()
+
+    path = None
+    if cache_dir is not None:
+        path = _get_cache_path(cache_dir, database, oid)
+        table_info = _read_cache(path, markers)
+        if table_info is not None:
+            logger.debug(f"Loaded '{table_name}' schema from cache '{path}'")
+            return table_info
+
+    table_info = load_table_info(cur, oid)
+    if path is not None:
+        _write_cache(path, markers, table_info)
+    return table_info
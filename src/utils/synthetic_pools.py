@@ -0,0 +1,167 @@
+import logging
+import mmap
+import multiprocessing
+import os
+import pathlib
+import struct
+import typing
+import zlib
+
+
+logger = logging.getLogger(__name__)
+
+POOL_MAGIC = b"APGP"
+POOL_VERSION = 1
+
+# magic, version, number of values; followed by (count + 1) uint64 offsets
+# into the utf-8 blob that holds the values back to back
+_HEADER = struct.Struct("<4sII")
+_OFFSET = struct.Struct("<Q")
+
+POOL_KINDS = {
+    "name": "name",
+    "first_name": "first_name",
+    "last_name": "last_name",
+    "address": "address",
+    "city": "city",
+    "email": "email",
+    "phone": "phone_number",
+    "company": "company",
+}
+
+
+def get_pool_path(pools_dir: str, kind: str, size: int, locale: str):
+    return str(pathlib.Path(pools_dir) / f"{kind}_{locale}_{size}.pool")
+
+
+def _generate_chunk(task):
+    from faker import Faker
+
+    kind, locale, seed, count = task
+
+    fake = Faker(locale)
+    fake.seed_instance(seed)
+    generator = getattr(fake, POOL_KINDS[kind])
+
+    return [generator().replace("\n", " ") for _ in range(count)]
+
+
+def _write_pool(path: str, values: typing.List[str]):
+    encoded = [value.encode("utf-8") for value in values]
+
+    offsets = [0]
+    for value in encoded:
+        offsets.append(offsets[-1] + len(value))
+
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(_HEADER.pack(POOL_MAGIC, POOL_VERSION, len(encoded)))
+        f.write(struct.pack(f"<{len(offsets)}Q", *offsets))
+        for value in encoded:
+            f.write(value)
+
+    os.replace(tmp_path, path)
+
+
+def build_pools(
+    pools_dir: str,
+    kinds: typing.List[str],
+    size: int,
+    processes: int,
+    locale: str = "en_US",
+):
+    pathlib.Path(pools_dir).mkdir(parents=True, exist_ok=True)
+
+    for kind in kinds:
+        if kind not in POOL_KINDS:
+            raise Exception(f"Unknown synthetic pool kind '{kind}'")
+
+    processes = max(1, processes)
+    chunk_size = (size + processes - 1) // processes
+
+    tasks = []
+    for kind in kinds:
+        kind_seed = zlib.crc32(f"{kind}_{locale}".encode()) * 1000
+        remaining = size
+        for chunk in range(processes):
+            count = min(chunk_size, remaining)
+            if count <= 0:
+                break
+            tasks.append((kind, locale, kind_seed + chunk, count))
+            remaining -= count
+
+    logger.info(
+        f"Building synthetic pools {kinds} of size {size} with {processes} processes"
+    )
+    with multiprocessing.Pool(processes) as pool:
+        chunks = pool.map(_generate_chunk, tasks)
+
+    values_by_kind = {kind: [] for kind in kinds}
+    for task, values in zip(tasks, chunks):
+        values_by_kind[task[0]].extend(values)
+
+    for kind, values in values_by_kind.items():
+        path = get_pool_path(pools_dir, kind, size, locale)
+        _write_pool(path, values)
+        logger.info(f"Synthetic pool '{kind}' written to {path}")
+
+
+def ensure_pools(
+    pools_dir: str,
+    kinds: typing.List[str],
+    size: int,
+    processes: int,
+    locale: str = "en_US",
+):
+    missing = [
+        kind
+        for kind in dict.fromkeys(kinds)
+        if not os.path.exists(get_pool_path(pools_dir, kind, size, locale))
+    ]
+    if missing:
+        build_pools(pools_dir, missing, size, processes, locale)
+
+
+class SyntheticPool:
+    def __init__(self, path: str):
+        self.path = path
+        self._file = open(path, "rb")
+        self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, count = _HEADER.unpack_from(self._mm, 0)
+        if magic != POOL_MAGIC or version != POOL_VERSION:
+            self.close()
+            raise Exception(
+                f"File {path} is not a synthetic pool of version {POOL_VERSION}"
+            )
+
+        self.count = count
+        self._data_start = _HEADER.size + (count + 1) * _OFFSET.size
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index: int):
+        if index < 0 or index >= self.count:
+            raise IndexError(index)
+        start, end = struct.unpack_from(
+            "<2Q", self._mm, _HEADER.size + index * _OFFSET.size
+        )
+        return self._mm[self._data_start + start : self._data_start + end].decode(
+            "utf-8"
+        )
+
+    def __iter__(self):
+        for index in range(self.count):
+            yield self[index]
+
+    def close(self):
+        if not self._mm.closed:
+            self._mm.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
@@ -1,14 +1,19 @@
 import typing
 
+from src.utils import introspection
+
 
 def get_columns(cur, table_name: str):
-    cur.execute(
-        f"SELECT column_name, data_type FROM information_schema.columns "
-        f"WHERE table_name = '{table_name}' ORDER BY ordinal_position"
-    )
-    columns = cur.fetchall()
-    return columns
+    table_info = introspection.get_table_info(cur, table_name)
+    return [(column.name, column.type) for column in table_info.columns]
 
 
 def join_names(columns: typing.List[str], delimiter: str = ", "):
     return delimiter.join(columns)
+
+
+def get_shard_expr(key_column: str, shard_count: int):
+    return (
+        f"((hashtext(COALESCE({key_column}::text, '')) & 2147483647) "
+        f"% {shard_count})"
+    )
@@ -0,0 +1,97 @@
+import pytest
+
+
+# unit tests need no databases, so the docker environment is not started
+@pytest.fixture(scope="session", autouse=True)
+def prepare_env():
+    yield
+
+
+class FakeCursor:
+    def __init__(self, conn):
+        self.conn = conn
+        self.connection = conn
+        self.rowcount = None
+        self.description = None
+        self.result = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def _raise_error(self, query):
+        for text, error in self.conn.errors.items():
+            if text in query:
+                raise error
+
+    def execute(self, query, params=None):
+        self.conn.queries.append((query, params))
+        self._raise_error(query)
+
+        # the last matching fragment wins, rowcount sticks to the last result
+        self.result = None
+        self.description = None
+        for text, result in self.conn.results.items():
+            if text in query:
+                self.result = result(query, params) if callable(result) else result
+                self.description = self.conn.descriptions.get(text)
+                self.conn.rowcount = len(self.result)
+        self.rowcount = self.conn.rowcount
+
+    def copy_expert(self, query, file):
+        self.conn.queries.append((query, None))
+        self._raise_error(query)
+
+        if "FROM STDIN" in query:
+            data = file.read()
+            self.conn.copied.append(data)
+            self.rowcount = data.count(b"\n")
+        else:
+            file.write(self.conn.copy_out)
+            self.rowcount = self.conn.copy_out.count(b"\n")
+
+    def fetchone(self):
+        return self.result[0] if self.result else None
+
+    def fetchall(self):
+        return self.result or []
+
+    def close(self):
+        pass
+
+
+class FakeConnection:
+    # results map a query fragment to its rows, or to a callable of the query
+    # and params returning them; errors map a fragment to the raised exception
+    def __init__(self, results=None, descriptions=None, errors=None):
+        self.results = dict(results or {})
+        self.descriptions = dict(descriptions or {})
+        self.errors = dict(errors or {})
+        self.server_version = 160000
+        self.queries = []
+        self.copied = []
+        self.copy_out = b""
+        self.rowcount = 0
+        self.commits = 0
+        self.rollbacks = 0
+        self.autocommit = True
+        self.closed = 0
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def commit(self):
+        self.commits += 1
+
+    def rollback(self):
+        self.rollbacks += 1
+
+    def get_queries(self, text=""):
+        return [query for query, _ in self.queries if text in query]
+
+
+@pytest.fixture
+def fake_connection():
+    return FakeConnection
@@ -0,0 +1,80 @@
+import psycopg2
+import pytest
+
+from src.delivery import copy_fanout
+from src.utils import utils
+
+
+class FakeDestinations:
+    def __init__(self, connections):
+        self.connections = connections
+
+    def get_hosts(self):
+        return [f"host=dst{ind}" for ind in range(len(self.connections))]
+
+    def fan_out(self, calls):
+        return [call() for call in calls], [0 for _ in calls]
+
+
+def write_batch(delivery, data):
+    buffer = delivery.new_buffer()
+    buffer.write(data)
+    return buffer
+
+
+def test_failed_destination_gets_only_the_resend(fake_connection):
+    healthy = fake_connection()
+    failing = fake_connection(errors={"COPY": psycopg2.OperationalError("gone")})
+    delivery = copy_fanout.CopyFanOut(
+        FakeDestinations([healthy, failing]), "transfer", ["id"], 1024
+    )
+
+    with pytest.raises(psycopg2.OperationalError):
+        delivery.deliver(write_batch(delivery, b"1\n2\n"))
+    assert delivery.has_pending()
+    assert healthy.copied == [b"1\n2\n"]
+
+    failing.errors = {}
+    assert delivery.resend_pending() == 2
+    assert healthy.copied == [b"1\n2\n"]
+    assert failing.copied == [b"1\n2\n"]
+    assert delivery.delivered == [2, 2]
+
+    delivery.acknowledge()
+    assert not delivery.has_pending()
+
+
+def test_overflow_drains_copy_and_fails_delivery(fake_connection):
+    delivery = copy_fanout.CopyFanOut(
+        FakeDestinations([fake_connection()]), "transfer", ["id"], 4
+    )
+    buffer = write_batch(delivery, b"1\n2\n")
+    assert buffer.write(b"3\n") == 2
+    assert buffer.overflowed and not buffer.getvalue()
+
+    with pytest.raises(copy_fanout.BufferOverflow):
+        delivery.deliver(buffer)
+    assert not delivery.has_pending()
+
+
+def test_null_shard_keys_hash_as_empty_text():
+    expr = utils.get_shard_expr("email", 3)
+    assert "COALESCE(email::text, '')" in expr
+    assert expr.endswith("% 3)")
+
+
+def test_rows_routed_by_the_hash_column(fake_connection):
+    dsts = [fake_connection(), fake_connection()]
+    delivery = copy_fanout.CopyFanOut(
+        FakeDestinations(dsts), "transfer", ["id", "note"], 1024, "id"
+    )
+    assert "% 2) FROM (SELECT f()) b" in delivery.get_copy_query("f()")
+
+    buffer = delivery.new_buffer()
+    # a row may arrive in pieces, escaped tabs and newlines stay in the value
+    buffer.write(b"1\ta\\tb\t1\n2\tc\\nd")
+    buffer.write(b"\t0\n3\t\\N\t1\n")
+    assert delivery.deliver(buffer) == 3
+
+    assert dsts[0].copied == [b"2\tc\\nd\n"]
+    assert dsts[1].copied == [b"1\ta\\tb\n3\t\\N\n"]
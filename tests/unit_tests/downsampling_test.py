@@ -0,0 +1,53 @@
+import numpy as np
+import pandas as pd
+
+from src.monitoring import downsampling
+
+
+def test_short_series_is_kept():
+    x = np.arange(5, dtype=np.float64)
+    assert list(downsampling.lttb_indices(x, x, 10)) == [0, 1, 2, 3, 4]
+    assert list(downsampling.lttb_indices(x, x, 2)) == [0, 1, 2, 3, 4]
+
+
+def test_indices_keep_ends_and_are_increasing():
+    x = np.arange(1000, dtype=np.float64)
+    y = np.sin(x / 20)
+    indices = downsampling.lttb_indices(x, y, 50)
+
+    assert len(indices) == 50
+    assert indices[0] == 0
+    assert indices[-1] == 999
+    assert np.all(np.diff(indices) > 0)
+
+
+def test_spike_is_kept():
+    x = np.arange(1000, dtype=np.float64)
+    y = np.zeros(1000)
+    y[437] = 100.0
+
+    assert 437 in downsampling.lttb_indices(x, y, 20)
+
+
+def test_downsample_returns_lists():
+    timestamps = pd.date_range("2024-01-01", periods=100, freq="s")
+    values = list(range(100))
+
+    sampled_ts, sampled_values = downsampling.downsample(list(timestamps), values, 10)
+    assert isinstance(sampled_ts, list) and isinstance(sampled_values, list)
+    assert len(sampled_ts) == 10
+    assert sampled_ts[0] == timestamps[0] and sampled_values[-1] == 99
+
+
+def test_downsample_below_threshold_is_unchanged():
+    timestamps, values = [1, 2, 3], [4, 5, 6]
+    assert downsampling.downsample(timestamps, values, 10) == (timestamps, values)
+
+
+def test_downsample_keeps_arrays():
+    timestamps = pd.date_range("2024-01-01", periods=100, freq="s")
+    array_ts = np.array(timestamps, dtype="datetime64[ns]")
+
+    sampled_ts, sampled_values = downsampling.downsample(array_ts, range(100), 10)
+    assert sampled_ts.dtype == np.dtype("datetime64[ns]")
+    assert len(sampled_values) == 10
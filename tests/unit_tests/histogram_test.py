@@ -0,0 +1,78 @@
+import json
+import random
+
+import pytest
+
+from src.monitoring.histogram import LogHistogram
+
+
+def exact_percentile(values, percent):
+    ordered = sorted(values)
+    return ordered[max(int(len(ordered) * percent / 100 + 0.999999), 1) - 1]
+
+
+@pytest.mark.parametrize("percent", [50, 90, 99])
+def test_percentiles_within_relative_error(percent):
+    rng = random.Random(1)
+    values = [rng.lognormvariate(-3, 1.5) for _ in range(10000)]
+    histogram = LogHistogram(0.01)
+    for value in values:
+        histogram.record(value)
+
+    expected = exact_percentile(values, percent)
+    assert histogram.percentile(percent) == pytest.approx(expected, rel=0.011)
+
+
+def test_merge_equals_single_histogram():
+    rng = random.Random(2)
+    values = [rng.expovariate(10) for _ in range(2000)]
+    whole = LogHistogram()
+    parts = [LogHistogram(), LogHistogram()]
+    for number, value in enumerate(values):
+        whole.record(value)
+        parts[number % 2].record(value)
+
+    merged = LogHistogram()
+    for part in parts:
+        merged.merge(part)
+
+    assert merged.buckets == whole.buckets
+    assert merged.count == whole.count
+    assert (merged.min, merged.max) == (whole.min, whole.max)
+    assert merged.sum == pytest.approx(whole.sum)
+    assert merged.percentile(99) == whole.percentile(99)
+
+
+def test_merge_of_empty_keeps_bounds():
+    histogram = LogHistogram()
+    histogram.record(0.5)
+    histogram.merge(LogHistogram())
+
+    assert (histogram.min, histogram.max, histogram.count) == (0.5, 0.5, 1)
+
+
+def test_merge_rejects_other_buckets():
+    with pytest.raises(Exception, match="different buckets"):
+        LogHistogram(0.01).merge(LogHistogram(0.05))
+
+
+def test_percentiles_stay_within_recorded_range():
+    histogram = LogHistogram()
+    assert histogram.percentile(50) is None
+
+    histogram.record(0)
+    histogram.record(2.0, count=3)
+    # values below lowest share one bucket reported as lowest
+    assert histogram.percentile(1) == pytest.approx(0, abs=histogram.lowest)
+    assert histogram.percentile(100) <= histogram.max
+    assert histogram.percentile(100) == pytest.approx(2.0, rel=0.01)
+
+
+def test_json_round_trip():
+    histogram = LogHistogram()
+    for value in (0.001, 0.02, 0.3, 4.0):
+        histogram.record(value)
+
+    restored = LogHistogram.from_dict(json.loads(json.dumps(histogram.to_dict())))
+    assert restored.buckets == histogram.buckets
+    assert restored.percentile(50) == histogram.percentile(50)
@@ -0,0 +1,40 @@
+from src.utils import introspection
+
+
+def build_connection(fake_connection, markers):
+    return fake_connection(
+        {
+            "json_build_array": lambda query, params: [(16384, "db", markers[0])],
+            "format_type": [
+                ("id", "integer", True, True),
+                ("name", "text", False, False),
+            ],
+            "confrelid": [("fk_team", "teams", ["team_id"], ["id"])],
+        }
+    )
+
+
+def test_cached_schema_is_reused(fake_connection, tmp_path):
+    markers = ["[1, 2]"]
+    conn = build_connection(fake_connection, markers)
+
+    first = introspection.get_table_info(conn.cursor(), "workers", str(tmp_path))
+    second = introspection.get_table_info(conn.cursor(), "workers", str(tmp_path))
+
+    assert (tmp_path / "db_16384.json").exists()
+    assert len(conn.get_queries("format_type")) == 1
+    assert second.to_dict() == first.to_dict()
+    assert second.get_primary_key() == ["id"]
+    assert second.foreign_keys[0].ref_table == "teams"
+
+
+def test_changed_markers_reload_schema(fake_connection, tmp_path):
+    markers = ["[1, 2]"]
+    conn = build_connection(fake_connection, markers)
+    introspection.get_table_info(conn.cursor(), "workers", str(tmp_path))
+
+    markers[0] = "[1, 3]"
+    introspection.get_table_info(conn.cursor(), "workers", str(tmp_path))
+    introspection.get_table_info(conn.cursor(), "workers", str(tmp_path))
+
+    assert len(conn.get_queries("format_type")) == 2
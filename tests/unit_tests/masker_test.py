@@ -0,0 +1,77 @@
+import psycopg2
+import psycopg2.errors
+import pytest
+
+from src.transform import masker
+from src.utils import utils
+
+
+def test_echo_keeps_the_column():
+    assert masker.compile_mask_expression("name", "echo") == "s.name"
+
+
+def test_regex_pattern():
+    expr = masker.compile_mask_expression(
+        "note", {"regex": "o'k", "replacement": "x", "flags": "gi"}
+    )
+    assert expr == "regexp_replace(s.note::text, 'o''k', 'x', 'gi')"
+
+
+def test_keep_first_and_last():
+    expr = masker.compile_mask_expression("iban", "iban")
+    assert expr.startswith("(left(s.iban::text, 4) || ")
+    assert "substr(s.iban::text, 5)" in expr
+    assert "(?=(?:[^0-9A-Za-z]*[0-9A-Za-z]){4})" in expr
+
+
+def test_mask_without_kept_characters():
+    expr = masker.compile_mask_expression("pin", {"mask": "[0-9]", "char": "#"})
+    assert expr == "regexp_replace(s.pin::text, '[0-9]', '#', 'g')"
+
+
+@pytest.mark.parametrize(
+    "pattern,message",
+    [
+        ("unknown", "Unknown mask pattern"),
+        ({"mask": "0-9"}, "must be a bracket expression"),
+        ({"mask": "[^0-9]"}, "must be a bracket expression"),
+        ({"mask": "[0-9]", "char": "**"}, "single character"),
+    ],
+)
+def test_invalid_patterns(pattern, message):
+    with pytest.raises(Exception, match=message):
+        masker.compile_mask_expression("col", pattern)
+
+
+def build_masker(monkeypatch, conn, column_patterns):
+    monkeypatch.setattr(
+        utils,
+        "get_columns",
+        lambda cur, table: [(column, "text") for column in column_patterns],
+    )
+    return masker.Masker(
+        conn, "src", "transfer", "processed", False, 10, 0, column_patterns
+    )
+
+
+def check_regex(query, params):
+    # the server rejects lookbehind, which Python re accepts
+    if "(?<=" in params[0]:
+        raise psycopg2.errors.InvalidRegularExpression("invalid regular expression")
+    return [("",)]
+
+
+def test_regexes_are_checked_by_the_server(monkeypatch, fake_connection):
+    conn = fake_connection({"regexp_replace": check_regex})
+    transform = build_masker(
+        monkeypatch,
+        conn,
+        {"email": "email", "note": {"regex": "(?<=a)b", "replacement": ""}},
+    )
+
+    with pytest.raises(Exception, match="Invalid regex for column 'note'"):
+        transform.prepare()
+    checked = [params[0] for query, params in conn.queries if "regexp_replace" in query]
+    assert checked == ["^(.)[^@]*@", "(?<=a)b"]
+
+    transform.cleanup()
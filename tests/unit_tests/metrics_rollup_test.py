@@ -0,0 +1,94 @@
+import time
+
+import pytest
+
+from src.monitoring import metrics
+
+
+@pytest.fixture
+def collector(tmp_path, monkeypatch):
+    # the schema is created once per process, every test has its own database
+    monkeypatch.setattr(metrics.MetricsCollector, "_MetricsCollector__init_db", False)
+    return metrics.MetricsCollector(str(tmp_path / "metrics.db"), "run1")
+
+
+def test_rollups_aggregate_per_bucket():
+    records = [
+        ("eta_s", 5.0, None, "2024-01-01 00:00:00.100"),
+        ("eta_s", 9.0, None, "2024-01-01 00:00:00.900"),
+        ("eta_s", 1.0, None, "2024-01-01 00:00:00.500"),
+        ("eta_s", 3.0, None, "2024-01-01 00:01:30.000"),
+    ]
+    aggregated = metrics.MetricsCollector._aggregate_rollups(records, "run1")
+    rollups = {
+        (resolution, bucket): rest
+        for _, _, resolution, _, bucket, *rest in aggregated
+    }
+
+    second = 1704067200
+    # count, sum, min, max, last and the timestamp of last
+    assert rollups[(1, second)] == [3, 15.0, 1.0, 9.0, 9.0, "2024-01-01 00:00:00.900"]
+    assert rollups[(60, second)][:5] == [3, 15.0, 1.0, 9.0, 9.0]
+    assert rollups[(60, second + 60)][:5] == [1, 3.0, 3.0, 3.0, 3.0]
+    assert rollups[(3600, second)][:5] == [4, 18.0, 1.0, 9.0, 3.0]
+
+
+def test_rollups_merge_across_writes(collector):
+    write = metrics.MetricsCollector._write_records
+    write(collector.conn, [("eta_s", 4.0, None, "2024-01-01 00:00:10.000")], "run1")
+    write(collector.conn, [("eta_s", 2.0, None, "2024-01-01 00:00:05.000")], "run1")
+
+    cur = collector.conn.cursor()
+    cur.execute(
+        "SELECT count, sum, min, max, last FROM metrics_rollup "
+        "WHERE name = 'eta_s' AND resolution = 60"
+    )
+    # the older point arrived last, but last follows the timestamps
+    assert cur.fetchall() == [(2, 6.0, 2.0, 4.0, 4.0)]
+
+
+def test_series_switch_to_rollups_over_max_points(collector):
+    records = []
+    for second in range(0, 600, 2):
+        timestamp = f"2024-01-01 00:{second // 60:02d}:{second % 60:02d}"
+        records.append(("eta_s", float(second), None, timestamp))
+    metrics.MetricsCollector._write_records(collector.conn, records, "run1")
+
+    _, values, resolution = collector.get_metric_series("eta_s")
+    assert resolution is None and len(values) == 300
+
+    _, values, resolution = collector.get_metric_series("eta_s", max_points=20)
+    assert resolution == 60
+    assert values[:2] == [58.0, 118.0]
+
+
+def test_compactor_keeps_recent_points(collector):
+    old = metrics.get_timestamp(3 * 86400)
+    recent = metrics.get_timestamp()
+    metrics.MetricsCollector._write_records(
+        collector.conn,
+        [("eta_s", float(number), None, old) for number in range(25)]
+        + [("eta_s", 1.0, None, recent)],
+        "run1",
+    )
+    metrics.MetricsCollector._write_records(
+        collector.conn, [("eta_s", 2.0, None, old)], "old_run"
+    )
+
+    compactor = metrics.MetricsCompactor(
+        raw_days=1, rollup_days=2, chunk_rows=10, step_budget_s=10
+    )
+    deleted = compactor.step(collector.conn)
+    assert not compactor.tasks
+    assert compactor.step(collector.conn) == 0
+
+    cur = collector.conn.cursor()
+    cur.execute("SELECT COUNT(*) FROM metrics")
+    assert cur.fetchone()[0] == 1
+    cur.execute("SELECT DISTINCT resolution FROM metrics_rollup ORDER BY resolution")
+    resolutions = [row[0] for row in cur.fetchall()]
+    assert resolutions == [1, 60, 3600]
+    cur.execute("SELECT MIN(bucket) FROM metrics_rollup")
+    assert cur.fetchone()[0] > time.time() - 86400 * 2
+    assert [run[0] for run in collector.get_runs()] == ["run1"]
+    assert deleted >= 26
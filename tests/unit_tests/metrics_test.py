@@ -0,0 +1,58 @@
+import pytest
+
+from src.monitoring import metrics, prometheus
+
+
+def test_increments_become_running_totals():
+    last_values = {("total_cnt", "host=a"): 5}
+    records = [
+        ("inc", "total_cnt", 2, "host=a", "t1"),
+        ("inc", "total_cnt", 3, "host=b", "t1"),
+        ("set", "eta_s", 10.0, None, "t1"),
+        ("inc", "total_cnt", 1, "host=a", "t2"),
+    ]
+
+    assert metrics.resolve_increments(records, last_values) == [
+        ("total_cnt", 7, "host=a", "t1"),
+        ("total_cnt", 3, "host=b", "t1"),
+        ("eta_s", 10.0, None, "t1"),
+        ("total_cnt", 8, "host=a", "t2"),
+    ]
+    assert last_values == {("total_cnt", "host=a"): 8, ("total_cnt", "host=b"): 3}
+
+
+def test_backlog_is_derived_from_both_counters():
+    last_values = {}
+    records = [
+        ("inc", "total_mark_processed", 10, None, "t1"),
+        ("inc", "total_deleted", 4, None, "t2"),
+        ("inc", "total_deleted", 8, None, "t3"),
+        ("inc", "total_cnt", 1, "host=a", "t3"),
+    ]
+
+    backlog = [
+        (value, timestamp)
+        for name, value, _, timestamp in metrics.resolve_increments(
+            records, last_values, with_backlog=True
+        )
+        if name == "transfer_backlog"
+    ]
+    # clamped at zero, the counters are reported by different processes
+    assert backlog == [(10, "t1"), (6, "t2"), (0, "t3")]
+
+
+def test_backlog_gauges_keep_collector_names():
+    for name in ("transfer_backlog", "transfer_backlog_rows", "transfer_backlog_bytes"):
+        assert prometheus.METRIC_TYPES[name][1] == name
+
+
+def test_prometheus_backend_requires_port(monkeypatch):
+    factory = metrics.MetricsCollectorFactory
+    for name in ("db_path", "disable_metrics", "prometheus_settings", "run_id"):
+        monkeypatch.setattr(factory, name, getattr(factory, name))
+    monkeypatch.setattr(
+        metrics, "get_settings", lambda: {"metrics_backend": "prometheus"}
+    )
+
+    with pytest.raises(Exception, match="prometheus.port"):
+        factory.initialize()
@@ -0,0 +1,112 @@
+import pytest
+
+from src.planning import planner
+
+
+def test_estimate_unknown_before_first_batch():
+    model = planner.ThroughputModel(1000)
+    assert model.estimate_runtime_s(100) is None
+
+
+def test_estimate_includes_sleep_between_batches():
+    model = planner.ThroughputModel(1000, sleep_ms=500)
+    model.observe(100, 1.0)
+
+    assert model.get_remaining_rows() == 900
+    # 900 rows at 10 ms and 9 sleeps of 0.5 s
+    assert model.estimate_runtime_s(100) == pytest.approx(9 + 4.5)
+
+
+def test_rate_is_smoothed():
+    model = planner.ThroughputModel(1000, smoothing=0.5)
+    model.observe(100, 1.0)
+    model.observe(100, 3.0)
+    model.observe(0, 10.0)
+
+    assert model.seconds_per_row == pytest.approx(0.02)
+    assert model.processed_rows == 200
+
+
+def test_unknown_table_size():
+    model = planner.ThroughputModel(None)
+    model.observe(100, 1.0)
+
+    assert model.get_remaining_rows() is None
+    assert model.estimate_runtime_s(100) is None
+    assert model.estimate_runtime_s(100, rows=200) == pytest.approx(2.0)
+
+
+def test_never_analyzed_table_is_not_counted(fake_connection):
+    conn = fake_connection({"reltuples": [(-1, 10)]})
+    assert planner.get_table_stats(conn.cursor(), "src") == (None, 10)
+    assert not conn.get_queries("COUNT(*)")
+
+
+def test_format_plan_without_sample():
+    plan = {
+        "total_rows": None,
+        "total_pages": 10,
+        "sampled_rows": 0,
+        "rows_per_s": None,
+        "runtime_s": None,
+        "wal_bytes": None,
+        "transfer_rows": None,
+        "peak_transfer_bytes": 3 * 2**20,
+    }
+    lines = planner.format_plan(plan).splitlines()
+    assert lines[0].endswith("unknown (10 pages)")
+    assert lines[-1].endswith("3.0 MiB")
+
+
+class SampledTransformer:
+    def __init__(self):
+        self.column_types = {"id": "integer", "__processed__": "boolean"}
+        self.src_table = "src"
+        self.transfer_table = "transfer"
+        self.batch_size = 10
+        self.sleep_ms = 0
+        self.batches = [10, 0]
+
+    def get_transfer_table_schema(self):
+        return [("id", "integer")]
+
+    def prepare(self):
+        self.prepared_on = (self.src_table, self.transfer_table)
+
+    def create_temp_table(self):
+        pass
+
+    def select_ctids(self):
+        return self.batches.pop(0)
+
+    def insert_into_transfer_table(self):
+        return 10
+
+    def mark_processed(self):
+        pass
+
+    def truncate_stids_table(self):
+        pass
+
+
+def test_sample_runs_on_a_copy(fake_connection):
+    conn = fake_connection(
+        {
+            "reltuples": [(1000, 10)],
+            "pg_current_wal_insert_lsn": [(0,)],
+            "pg_total_relation_size": [(8192,)],
+        }
+    )
+    transform = SampledTransformer()
+
+    plan = planner.build_plan(
+        conn, transform, "src", "transfer", "__processed__", "__id__", 2
+    )
+
+    assert plan["sampled_rows"] == 10
+    assert transform.prepared_on == ("_sample_src", "_sample_transfer")
+    assert (transform.src_table, transform.transfer_table) == ("src", "transfer")
+    assert not conn.get_queries("ALTER TABLE src")
+    copy = conn.get_queries("CREATE TABLE _sample_src")[0]
+    assert "SELECT id FROM src TABLESAMPLE SYSTEM (4.0) LIMIT 20" in copy
+    assert conn.rollbacks == 1
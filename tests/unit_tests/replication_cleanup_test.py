@@ -0,0 +1,36 @@
+import psycopg2
+import psycopg2.errors
+import pytest
+
+from src.monitoring import prometheus
+from src.replication_cleanup import replication_cleanup
+
+
+@pytest.mark.parametrize(
+    "index_row,dropped", [(None, False), ((True,), False), ((False,), True)]
+)
+def test_invalid_index_is_rebuilt(fake_connection, index_row, dropped):
+    conn = fake_connection({"pg_index": [index_row] if index_row else []})
+    replication_cleanup.build_dst_index(conn, "transfer", "id")
+
+    assert len(conn.get_queries("DROP INDEX")) == int(dropped)
+    assert "CREATE INDEX CONCURRENTLY" in conn.get_queries()[-1]
+
+
+class FakeDstConnection:
+    def get_hosts(self):
+        return ["host=a"]
+
+
+def test_replication_lag_errors_are_not_fatal(fake_connection):
+    denied = psycopg2.errors.InsufficientPrivilege("permission denied")
+    src_conn = fake_connection(errors={"pg_replication_slots": denied})
+    replication_cleanup.record_replication_lag(
+        src_conn.cursor(), FakeDstConnection(), [["slot"]]
+    )
+    assert src_conn.rollbacks == 1
+
+
+def test_every_lag_column_has_a_metric_type():
+    for name in replication_cleanup.LAG_COLUMNS:
+        assert name in prometheus.METRIC_TYPES
@@ -0,0 +1,62 @@
+import pytest
+
+from src.preparations import replication_layout
+
+
+def test_single_publication_without_filters():
+    layout = replication_layout.ReplicationLayout("pub", "sub", 2)
+
+    assert not layout.uses_row_filters()
+    assert layout.get_publications() == [("pub", None)]
+    assert layout.get_destination_subscriptions(1) == [
+        ("sub", "pub", "transfer_slot_replica_2")
+    ]
+
+
+def test_parallel_apply_splits_by_id():
+    layout = replication_layout.ReplicationLayout(
+        "pub", "sub", 1, id_column="__id__", apply_workers=2
+    )
+
+    assert layout.uses_row_filters()
+    assert layout.get_publications() == [
+        ("pub_part_0", "(__id__ % 2 = 0)"),
+        ("pub_part_1", "(__id__ % 2 = 1)"),
+    ]
+    assert layout.get_destination_subscriptions(0) == [
+        ("sub_0", "pub_part_0", "transfer_slot_replica_1_0"),
+        ("sub_1", "pub_part_1", "transfer_slot_replica_1_1"),
+    ]
+    assert layout.get_destination_slots(0) == [
+        "transfer_slot_replica_1_0",
+        "transfer_slot_replica_1_1",
+    ]
+
+
+def test_shards_combine_with_parallel_apply():
+    layout = replication_layout.ReplicationLayout(
+        "pub", "sub", 2, shard_key="email", id_column="__id__", apply_workers=2
+    )
+
+    publications = dict(layout.get_publications())
+    assert sorted(publications) == [
+        "pub_shard_0_part_0",
+        "pub_shard_0_part_1",
+        "pub_shard_1_part_0",
+        "pub_shard_1_part_1",
+    ]
+    row_filter = publications["pub_shard_1_part_0"]
+    assert row_filter.endswith("% 2) = 1) AND (__id__ % 2 = 0)")
+    assert "COALESCE(email::text, '')" in row_filter
+
+    # each destination subscribes only to its own shard
+    subscriptions = layout.get_destination_subscriptions(1)
+    assert [publication for _, publication, _ in subscriptions] == [
+        "pub_shard_1_part_0",
+        "pub_shard_1_part_1",
+    ]
+
+
+def test_parallel_apply_requires_id_column():
+    with pytest.raises(Exception, match="id column"):
+        replication_layout.ReplicationLayout("pub", "sub", 1, apply_workers=2)
@@ -0,0 +1,45 @@
+import numpy as np
+
+from src.monitoring import segment_store
+
+
+def write_records(store_dir, run_id, count, segment_records=4):
+    writer = segment_store.SegmentWriter(str(store_dir), segment_records, run_id)
+    writer.append(
+        [
+            ("total_cnt", float(number), "host=a", f"2024-01-01 00:00:{number:02d}.500")
+            for number in range(count)
+        ]
+    )
+    writer.close()
+
+
+def test_round_trip_with_rollover(tmp_path):
+    write_records(tmp_path, "run1", 10)
+
+    assert len(list(tmp_path.glob("segment_*.bin"))) == 3
+    assert not list(tmp_path.glob("*.tmp"))
+
+    reader = segment_store.SegmentReader(str(tmp_path))
+    timestamps, values = reader.read_series("total_cnt", "host=a")
+    assert list(values) == [float(number) for number in range(10)]
+    assert timestamps[1] == np.datetime64("2024-01-01T00:00:01.500")
+
+    timestamps, values = reader.read_series(
+        "total_cnt", "host=a", start_ns=int(timestamps[2].astype("int64"))
+    )
+    assert values[0] == 2.0
+    assert reader.read_series("total_cnt", "host=b")[1].size == 0
+
+
+def test_reads_are_scoped_to_run(tmp_path):
+    write_records(tmp_path, "run1", 3)
+    write_records(tmp_path, "run2", 2)
+
+    reader = segment_store.SegmentReader(str(tmp_path))
+    assert reader.get_runs() == ["run1", "run2"]
+    assert reader.read_series("total_cnt", "host=a")[1].size == 5
+
+    reader.run_id = reader.get_latest_run()
+    assert list(reader.read_series("total_cnt", "host=a")[1]) == [0.0, 1.0]
+    assert reader.get_hosts() == ["host=a"]
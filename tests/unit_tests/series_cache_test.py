@@ -0,0 +1,58 @@
+from src.monitoring import series_cache
+
+
+class FakeMetrics:
+    def __init__(self):
+        self.run_id = "run"
+        self.resolution = None
+        self.updates = []
+        self.calls = []
+
+    def choose_resolution(self, name, tag, max_points):
+        return self.resolution
+
+    def get_metric_updates(self, name, tags, resolution, after):
+        self.calls.append((resolution, after))
+        return self.updates
+
+
+def test_raw_points_fetched_past_cursor():
+    metrics = FakeMetrics()
+    cache = series_cache.SeriesCache(100)
+
+    metrics.updates = [("a", 1, "t1", 1.0), ("b", 2, "t2", 2.0)]
+    cache.get(metrics, "rows", ["a", "b"])
+    metrics.updates = [("a", 3, "t3", 3.0), ("b", 4, "t4", 4.0)]
+    series = cache.get(metrics, "rows", ["a", "b"])
+
+    # the earliest cursor, rows a tag already holds are skipped
+    assert metrics.calls == [(None, None), (None, 1)]
+    assert series == {"a": (["t1", "t3"], [1.0, 3.0]), "b": (["t2", "t4"], [2.0, 4.0])}
+
+
+def test_last_bucket_is_replaced():
+    metrics = FakeMetrics()
+    metrics.resolution = 60
+    cache = series_cache.SeriesCache(100)
+
+    metrics.updates = [("a", 0, "t0", 1.0), ("a", 60, "t60", 2.0)]
+    cache.get(metrics, "rows", ["a"])
+    metrics.updates = [("a", 60, "t60", 5.0), ("a", 120, "t120", 6.0)]
+    series = cache.get(metrics, "rows", ["a"])
+
+    assert metrics.calls[-1] == (60, 60)
+    assert series == {"a": (["t0", "t60", "t120"], [1.0, 5.0, 6.0])}
+
+
+def test_resolution_change_drops_series():
+    metrics = FakeMetrics()
+    cache = series_cache.SeriesCache(100)
+
+    metrics.updates = [("a", 1, "t1", 1.0)]
+    cache.get(metrics, "rows", ["a"])
+    metrics.resolution = 60
+    metrics.updates = [("a", 0, "t0", 3.0)]
+    series = cache.get(metrics, "rows", ["a"])
+
+    assert metrics.calls[-1] == (60, None)
+    assert series == {"a": (["t0"], [3.0])}
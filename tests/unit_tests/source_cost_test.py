@@ -0,0 +1,79 @@
+import pytest
+
+from src.monitoring import metrics, source_cost
+
+
+def build_connection(fake_connection):
+    # every statements snapshot grows the counters by the same amount
+    snapshots = []
+
+    def take_snapshot(query, params):
+        snapshots.append(query)
+        number = len(snapshots)
+        return [(number * 4, number * 100.0, number * 40.0)]
+
+    return fake_connection(
+        {
+            "pg_extension": [(1,)],
+            "FROM pg_stat_statements": take_snapshot,
+            "FROM pg_stat_wal": [(None,)],
+            "FROM pg_stat_io": [(None,)],
+        },
+        {
+            "FROM pg_stat_statements": [("calls",), ("exec_time_ms",), ("io_time_ms",)],
+            "FROM pg_stat_wal": [("bytes",)],
+            "FROM pg_stat_io": [("bytes",)],
+        },
+    )
+
+
+class RecordingMetrics:
+    def __init__(self):
+        self.records = []
+
+    def add_metric(self, name, value, tag=None):
+        self.records.append((name, value, tag))
+
+
+def test_identifier_regex_matches_whole_names():
+    assert source_cost.get_identifier_regex("temp_ctid_holder") == (
+        "\\mtemp_ctid_holder\\M"
+    )
+    assert source_cost.get_identifier_regex("a.b") == "\\ma\\.b\\M"
+
+
+def test_unknown_source():
+    with pytest.raises(Exception):
+        source_cost.SourceCostCollector("copy", sources=["locks"])
+
+
+def test_on_batch_with_metrics_disabled(fake_connection):
+    assert isinstance(source_cost.metrics, metrics.MetricsCollectorStub)
+
+    conn = build_connection(fake_connection)
+    collector = source_cost.SourceCostCollector("copy", every_batches=1)
+    collector.start(conn, ["temp_ctid_holder"])
+    collector.on_batch(conn, ["temp_ctid_holder"])
+    assert len(conn.get_queries("FROM pg_stat_statements")) == 2
+
+
+def test_on_batch_records_deltas_per_batch(monkeypatch, fake_connection):
+    recorded = RecordingMetrics()
+    monkeypatch.setattr(source_cost, "metrics", recorded)
+
+    conn = build_connection(fake_connection)
+    collector = source_cost.SourceCostCollector(
+        "mask", every_batches=2, sources=["statements"]
+    )
+    collector.start(conn, ["temp_ctid_holder", "_mask_name"])
+    for _ in range(4):
+        collector.on_batch(conn, ["temp_ctid_holder", "_mask_name"])
+
+    values = {name: value for name, value, _ in recorded.records}
+    assert values["source_statements_calls"] == 2
+    assert values["source_statements_exec_time_ms"] == 50
+    assert values["source_statements_cpu_time_ms"] == 30
+    assert {tag for _, _, tag in recorded.records} == {"method=mask"}
+
+    _, params = conn.queries[-1]
+    assert params == (["\\mtemp_ctid_holder\\M", "\\m_mask_name\\M"],)
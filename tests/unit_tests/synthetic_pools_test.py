@@ -0,0 +1,61 @@
+import pytest
+
+from src.utils import synthetic_pools
+
+
+def test_pool_round_trip(tmp_path):
+    path = str(tmp_path / "name.pool")
+    values = ["Anna", "", "Jürgen Müller", "李雷"]
+    synthetic_pools._write_pool(path, values)
+
+    with synthetic_pools.SyntheticPool(path) as pool:
+        assert len(pool) == len(values)
+        assert list(pool) == values
+        assert pool[2] == "Jürgen Müller"
+        with pytest.raises(IndexError):
+            pool[len(values)]
+
+
+def test_foreign_file_is_rejected(tmp_path):
+    path = tmp_path / "other.pool"
+    path.write_bytes(b"NOPE" + bytes(16))
+
+    with pytest.raises(Exception, match="is not a synthetic pool"):
+        synthetic_pools.SyntheticPool(str(path))
+
+
+def test_unknown_kind_is_rejected(tmp_path):
+    with pytest.raises(Exception, match="Unknown synthetic pool kind"):
+        synthetic_pools.build_pools(str(tmp_path), ["ssn"], 10, 1)
+
+
+def test_ensure_pools_builds_only_missing(tmp_path, monkeypatch):
+    pools_dir = str(tmp_path)
+    synthetic_pools._write_pool(
+        synthetic_pools.get_pool_path(pools_dir, "city", 2, "en_US"), ["a", "b"]
+    )
+    built = []
+    monkeypatch.setattr(
+        synthetic_pools,
+        "build_pools",
+        lambda pools_dir, kinds, size, processes, locale: built.extend(kinds),
+    )
+
+    synthetic_pools.ensure_pools(pools_dir, ["city", "email", "email"], 2, 1)
+    assert built == ["email"]
+
+
+def test_build_is_deterministic(tmp_path):
+    for pools_dir in (tmp_path / "a", tmp_path / "b"):
+        synthetic_pools.build_pools(str(pools_dir), ["city"], 5, 2)
+
+    pools = [
+        synthetic_pools.SyntheticPool(
+            synthetic_pools.get_pool_path(str(pools_dir), "city", 5, "en_US")
+        )
+        for pools_dir in (tmp_path / "a", tmp_path / "b")
+    ]
+    assert len(pools[0]) == 5
+    assert list(pools[0]) == list(pools[1])
+    for pool in pools:
+        pool.close()
@@ -0,0 +1,227 @@
+import psycopg2
+import pytest
+
+from src.delivery import copy_fanout
+from src.monitoring import metrics
+from src.transform import transformer
+from src.utils import utils
+
+
+class RecordingTransformer(transformer.Transformer):
+    def get_transfer_table_schema(self):
+        return [("id", "integer")]
+
+    def get_funcs(self):
+        return ["_test_func"]
+
+    def prepare(self):
+        self.prepared = True
+
+    def cleanup(self):
+        self.cleaned_up = True
+
+
+def get_batch(batches):
+    # the select of a batch reports as many rows as the next batch holds
+    return lambda query, params: [()] * (batches.pop(0) if batches else 0)
+
+
+@pytest.fixture
+def build_transformer(monkeypatch, fake_connection):
+    monkeypatch.setattr(utils, "get_columns", lambda cur, table: [("id", "integer")])
+
+    def _build(batches, batch_size=10):
+        conn = fake_connection({"SELECT ctid": get_batch(list(batches))})
+        return RecordingTransformer(
+            conn, "src", "transfer", "processed", False, batch_size, 0
+        )
+
+    return _build
+
+
+def test_metrics_disabled_by_default():
+    assert isinstance(transformer.metrics, metrics.MetricsCollectorStub)
+
+
+def test_stub_accepts_tags():
+    stub = metrics.MetricsCollectorStub()
+    stub.add_metric("stage_time_s", 0.1, "stage=select")
+    stub.increment_metric("total_converted", 1, "host=a")
+
+
+def test_process_with_metrics_disabled(build_transformer):
+    transform = build_transformer([10, 10, 3])
+    transform.process()
+
+    assert transform.prepared
+    assert transform.cleaned_up
+    assert transform.conn.rollbacks == 0
+    assert len(transform.conn.get_queries("SELECT ctid")) == 4
+
+
+def test_backlog_bytes_requires_partitions(build_transformer):
+    transform = build_transformer([])
+    with pytest.raises(Exception):
+        transform.set_backpressure("id", 100, 10, "bytes")
+    transform.set_backpressure("id", 100, 10, "bytes", partitioned=True)
+
+
+def test_pause_gives_up_after_max_pause(build_transformer, monkeypatch):
+    transform = build_transformer([])
+    transform.set_backpressure("id", 100, 10, poll_ms=0, max_pause_s=0)
+    monkeypatch.setattr(transform, "get_backlog", lambda: 200)
+
+    with pytest.raises(Exception, match="stayed above low watermark"):
+        transform.wait_for_backlog()
+
+
+def test_pause_ends_below_low_watermark(build_transformer, monkeypatch):
+    transform = build_transformer([])
+    transform.set_backpressure("id", 100, 10, poll_ms=0)
+    backlogs = [150, 50, 5]
+    monkeypatch.setattr(transform, "get_backlog", lambda: backlogs.pop(0))
+
+    transform.wait_for_backlog()
+    assert backlogs == []
+
+
+@pytest.mark.parametrize("last_partition,created", [(9, True), (12, False)])
+def test_partitions_created_when_cleanup_stalls(
+    build_transformer, last_partition, created
+):
+    transform = build_transformer([])
+    transform.set_partitioning("id", 10)
+    partitions = [(f"transfer_p{number}",) for number in range(last_partition + 1)]
+    transform.conn.results.update(
+        {
+            "pg_get_serial_sequence": [("transfer_id_seq",)],
+            "last_value": [(95,)],
+            "pg_inherits": partitions,
+        }
+    )
+
+    transform.ensure_partitions()
+
+    creates = transform.conn.get_queries("CREATE TABLE")
+    assert bool(creates) == created
+    if created:
+        assert "transfer_p10 PARTITION OF transfer" in creates[0]
+        assert transform.conn.get_queries("pg_advisory_unlock")
+
+
+class FakeDelivery:
+    def __init__(self, lost):
+        self.lost = lost
+        self.reconnects = 0
+
+    def has_lost_connections(self):
+        return self.lost
+
+    def reconnect_lost(self):
+        self.reconnects += 1
+
+
+@pytest.mark.parametrize("src_closed,dst_lost", [(True, False), (False, True)])
+def test_reconnects_only_the_lost_side(
+    build_transformer, fake_connection, src_closed, dst_lost
+):
+    transform = build_transformer([])
+    transform.conn.closed = src_closed
+    transform.set_delivery(FakeDelivery(dst_lost))
+    reconnected = []
+
+    def reconnect(conn):
+        reconnected.append(conn)
+        return fake_connection()
+
+    transform.set_reconnect(reconnect)
+    assert transform.recover_connection(psycopg2.InterfaceError(), 1)
+    assert len(reconnected) == int(src_closed)
+    assert transform.delivery.reconnects == int(dst_lost)
+
+
+def test_error_on_healthy_connections_is_not_recovered(build_transformer):
+    transform = build_transformer([])
+    transform.set_delivery(FakeDelivery(False))
+    transform.set_reconnect(lambda conn: pytest.fail("source reconnected"))
+    assert not transform.recover_connection(psycopg2.InterfaceError(), 1)
+
+
+def test_cleanup_after_buffer_overflow(build_transformer, monkeypatch):
+    transform = build_transformer([10])
+
+    def overflow():
+        raise copy_fanout.BufferOverflow("too large")
+
+    monkeypatch.setattr(transform, "insert_into_transfer_table", overflow)
+    with pytest.raises(copy_fanout.BufferOverflow):
+        transform.process()
+
+    assert transform.conn.rollbacks == 1
+    assert transform.cleaned_up
+
+
+class PendingDelivery(FakeDelivery):
+    def __init__(self):
+        super().__init__(True)
+        self.pending = True
+        self.resends = 0
+
+    def has_pending(self):
+        return self.pending
+
+    def resend_pending(self):
+        self.resends += 1
+        return 2
+
+    def acknowledge(self):
+        self.pending = False
+
+
+def test_pending_batch_is_resent_not_transformed_again(build_transformer):
+    transform = build_transformer([])
+    transform.set_delivery(PendingDelivery())
+    transform.batch_ctids = ["(0,1)", "(0,2)"]
+
+    assert transform.process_iteration()
+
+    assert transform.delivery.resends == 1
+    assert not transform.delivery.pending
+    assert not transform.conn.get_queries("SELECT ctid")
+    restore = transform.conn.queries[0]
+    assert "unnest" in restore[0] and restore[1] == (["(0,1)", "(0,2)"],)
+    assert transform.conn.get_queries("UPDATE src")
+
+
+class SplittingDelivery:
+    def __init__(self, overflows):
+        self.overflows = overflows
+        self.delivered = []
+
+    def new_buffer(self):
+        buffer = copy_fanout.BoundedBuffer(1024)
+        buffer.overflowed = self.overflows > 0
+        self.overflows -= 1
+        return buffer
+
+    def get_copy_query(self, select_list):
+        return f"COPY (SELECT {select_list}) TO STDOUT"
+
+    def deliver(self, buffer):
+        self.delivered.append(buffer)
+        return 2
+
+
+def test_overflowing_batch_is_split(build_transformer):
+    transform = build_transformer([])
+    ctids = [("(0,1)",), ("(0,2)",), ("(0,3)",), ("(0,4)",)]
+    transform.conn.results["SELECT _ctid_"] = ctids
+    transform.set_delivery(SplittingDelivery(1))
+
+    assert transform.insert_into_transfer_table() == 2
+
+    assert transform.batch_ctids == ["(0,1)", "(0,2)"]
+    assert transform.batch_size == 2
+    delete = transform.conn.queries[-2]
+    assert "DELETE" in delete[0] and delete[1] == (["(0,3)", "(0,4)"],)
+    assert len(transform.conn.get_queries("TO STDOUT")) == 2